@@ -0,0 +1,106 @@
+from sqlalchemy import delete, func, select
+from metrics import ADDRESS_POOL_CLAIMS, ADDRESS_POOL_REFILLED, ADDRESS_POOL_LAST_REFILL
+from models import db, DepositAddress
+from qr_support import get_renderer, get_logo_path
+from web3_support import get_web3_support
+
+
+def refill_address_pool(app):
+    """地址池低于下水位时, 补充到上水位"""
+    with app.app_context():
+        try:
+            available = db.session.query(func.count(DepositAddress.id)).scalar()
+            low = app.config.get('ADDRESS_POOL_LOW', 100)
+            high = app.config.get('ADDRESS_POOL_HIGH', 500)
+            if available >= low:
+                return
+
+            app.logger.info(f'Refilling address pool: {available}/{high}')
+
+            w3 = get_web3_support(app)
+            renderer = get_renderer(get_logo_path())
+            batch_size = app.config.get('ADDRESS_POOL_BATCH_SIZE', 50)
+            remaining = high - available
+            while remaining > 0:
+                count = min(batch_size, remaining)
+                accounts = w3.create_accounts(count)
+                qr_pngs = renderer.render_many([account['address'] for account in accounts])
+                for account in accounts:
+                    db.session.add(DepositAddress(
+                        address=account['address'],
+                        private_key=account['private_key'],
+                        derivation_index=account['derivation_index'],
+                        qr_png=qr_pngs[account['address']]
+                    ))
+                db.session.commit()
+                remaining -= count
+                ADDRESS_POOL_REFILLED.inc(count)
+
+            ADDRESS_POOL_LAST_REFILL.set_to_current_time()
+
+        except Exception as e:
+            db.session.rollback()
+            app.logger.exception(f'Error in refill_address_pool: {e}')
+
+
+def claim_address():
+    """从地址池领取一个地址, 删除操作随调用方的事务一起提交; 池为空时返回None"""
+    for _ in range(3):
+        candidate = DepositAddress.query.order_by(DepositAddress.id).first()
+        if candidate is None:
+            break
+
+        account = {
+            'address': candidate.address,
+            'private_key': candidate.private_key,
+            'derivation_index': candidate.derivation_index,
+            'qr_png': candidate.qr_png
+        }
+        # 以删除成功作为领取成功, 并发领取同一地址时只有一方能删除
+        result = db.session.execute(
+            delete(DepositAddress).where(DepositAddress.id == candidate.id),
+            execution_options={'synchronize_session': False}
+        )
+        db.session.expunge(candidate)
+        if result.rowcount == 1:
+            ADDRESS_POOL_CLAIMS.labels('hit').inc()
+            return account
+
+    ADDRESS_POOL_CLAIMS.labels('miss').inc()
+    return None
+
+
+def claim_addresses(count):
+    """从地址池批量领取最多count个地址, 删除操作随调用方的事务一起提交"""
+    if not db.engine.dialect.delete_returning:
+        accounts = []
+        for _ in range(count):
+            account = claim_address()
+            if account is None:
+                break
+            accounts.append(account)
+        return accounts
+
+    # 以一条DELETE ... RETURNING领取, 并发领取时被其他事务删除的行不会返回
+    candidates = select(DepositAddress.id).order_by(DepositAddress.id).limit(count).scalar_subquery()
+    rows = db.session.execute(
+        delete(DepositAddress).where(DepositAddress.id.in_(candidates)).returning(
+            DepositAddress.address, DepositAddress.private_key, DepositAddress.derivation_index, DepositAddress.qr_png
+        ),
+        execution_options={'synchronize_session': False}
+    ).all()
+    ADDRESS_POOL_CLAIMS.labels('hit').inc(len(rows))
+    ADDRESS_POOL_CLAIMS.labels('miss').inc(count - len(rows))
+    return [row._asdict() for row in rows]
+
+
+def pool_stats(app):
+    """
+    返回地址池的当前水位
+    领取与补充的次数分布在各个Web进程与调度器进程中, 由/metrics汇总
+    """
+    return {
+        'available': db.session.query(func.count(DepositAddress.id)).scalar(),
+        'low': app.config.get('ADDRESS_POOL_LOW', 100),
+        'high': app.config.get('ADDRESS_POOL_HIGH', 500)
+    }
@@ -0,0 +1,101 @@
+import random
+import threading
+from datetime import datetime
+from sqlalchemy import delete, insert, update
+from sqlalchemy.exc import IntegrityError
+from models import db, AmountSlot
+
+
+class AmountAllocator(object):
+    """
+    统一收款地址模式的金额分配器
+    在订单金额后附加尾数, 使每个未完成订单的支付金额唯一
+    进程内记录已分配的金额以减少冲突, 数据库主键保证多进程之间不会分配相同金额
+    """
+
+    # 每次分配最多尝试的候选金额数量
+    MAX_ATTEMPTS = 20
+
+    def __init__(self, decimals=6, max_suffix=9999):
+        self.decimals = decimals  # 支付金额的小数位数
+        self.max_suffix = max_suffix  # 尾数最大值, 即同一订单金额可同时存在的订单数
+        self._reserved = {}  # 进程内已知被占用的金额: {金额键: 占用截止时间}
+        self._lock = threading.Lock()
+
+    def to_key(self, amount):
+        """金额转换为以最小单位计的整数键"""
+        return int(round(amount * 10 ** self.decimals))
+
+    def from_key(self, key):
+        return key / 10 ** self.decimals
+
+    def transfer_key(self, value_wei):
+        """链上转账金额(18位小数)转换为金额键, 精度超出支付金额小数位数时返回None"""
+        unit = 10 ** (18 - self.decimals)
+        if value_wei % unit:
+            return None
+        return value_wei // unit
+
+    def reserve(self, amount, order_no, hold_until):
+        """
+        为订单分配唯一的支付金额, 由独立的短事务提交
+        :param hold_until: 金额占用截止时间, 之后可分配给其他订单
+        :return: 支付金额, 所有尾数都被占用时返回None
+        """
+        base = self.to_key(amount)
+        now = datetime.utcnow()
+        with self._lock:
+            candidates = [
+                base + suffix for suffix in range(1, self.max_suffix + 1)
+                if self._reserved.get(base + suffix, now) <= now
+            ]
+
+        for key in random.sample(candidates, min(len(candidates), self.MAX_ATTEMPTS)):
+            claimed = self._claim(key, order_no, hold_until, now)
+            with self._lock:
+                # 被其他进程占用的金额同样记录下来, 截止时间未知时按本订单估计
+                self._reserved[key] = hold_until
+            if claimed:
+                return self.from_key(key)
+        return None
+
+    def _claim(self, key, order_no, hold_until, now):
+        """在数据库中占用金额, 已过期的占用可以被接管"""
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(insert(AmountSlot).values(amount_key=key, order_no=order_no, hold_until=hold_until))
+            return True
+        except IntegrityError:
+            pass
+
+        with db.engine.begin() as connection:
+            result = connection.execute(
+                update(AmountSlot).where(
+                    AmountSlot.amount_key == key,
+                    AmountSlot.hold_until <= now
+                ).values(order_no=order_no, hold_until=hold_until)
+            )
+        return result.rowcount == 1
+
+    def purge(self):
+        """删除已过期的占用记录, 并清理进程内记录"""
+        now = datetime.utcnow()
+        db.session.execute(delete(AmountSlot).where(AmountSlot.hold_until <= now))
+        with self._lock:
+            self._reserved = {key: until for key, until in self._reserved.items() if until > now}
+
+
+_allocator = None
+_allocator_lock = threading.Lock()
+
+
+def get_amount_allocator(app):
+    """获取进程内共享的金额分配器"""
+    global _allocator
+    with _allocator_lock:
+        if _allocator is None:
+            _allocator = AmountAllocator(
+                decimals=app.config.get('AMOUNT_DECIMALS', 6),
+                max_suffix=app.config.get('AMOUNT_SUFFIX_MAX', 9999)
+            )
+        return _allocator
@@ -1,18 +1,25 @@
-from flask import Flask, render_template, jsonify, request, redirect, url_for
-from flask_apscheduler import APScheduler
+import click
+from flask import (
+    Blueprint, Flask, current_app, render_template, jsonify, request, redirect, url_for, abort, Response,
+    stream_with_context
+)
 from datetime import datetime, timedelta
 import uuid
-import os
-import qrcode
-from PIL import Image, ImageDraw
-from io import BytesIO
-import base64
+import json
+import queue
+import signal
+import threading
 import logging
 
 from config import Config
-from models import db, Order, OrderStatus
-from web3_support import Web3Support
-from scheduler import check_orders
+from models import db, Order, OrderStatus, QRCode, CollectJob, CollectStatus
+from qr_support import get_qr_png, qr_etag
+from order_events import event_bus
+from polling import mark_watched, touch_watched
+from metrics import render_metrics, start_metrics_server, ORDER_TRANSITIONS
+from order_export import parse_fields, parse_filters, list_orders, export_orders
+
+# 与节点交互的模块(web3等)导入较慢, 在用到的视图和命令中再导入, Web进程启动时不加载
 
 # 配置日志
 logging.basicConfig(
@@ -20,95 +27,47 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 
-# 创建Flask应用
-app = Flask(__name__)
-app.config.from_object(Config)
-
-# 初始化扩展
-db.init_app(app)
-w3 = Web3Support(app)
+bp = Blueprint('main', __name__, cli_group=None)
 
-# 初始化调度器
-scheduler = APScheduler()
 
-# 修改调度器配置，传入app实例
-if app.config['JOBS']:
-    app.config['JOBS'][0]['args'] = (app,)
-
-scheduler.init_app(app)
-scheduler.start()
-
-# 创建数据库表
-with app.app_context():
-    db.create_all()
-
-
-def generate_qr_with_logo(data: str, logo_path: str = None, logo_bg_shape: str = 'circle') -> str:
+def create_app(config=Config):
     """
-    生成一个二维码，并在中间添加带白色背景的Logo
-    :param data: 二维码内容
-    :param logo_path: Logo图片文件路径
-    :param logo_bg_shape: Logo背景形状, 'circle' 或 'square'
-    :return: Base64编码的二维码图片
+    创建Flask应用
+    只注册视图与命令, 不连接节点、不启动后台任务; 后台任务由 flask run-scheduler 在独立进程中运行
     """
-    # 设置二维码参数，使用最高容错率
-    qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_H,
-        box_size=10,
-        border=4,
-    )
-    qr.add_data(data)
-    qr.make(fit=True)
-
-    # 创建二维码图片
-    qr_img = qr.make_image(fill_color="black", back_color="white").convert('RGBA')
-
-    # 尝试添加Logo
-    if logo_path and os.path.exists(logo_path):
-        try:
-            # 打开Logo图片
-            logo = Image.open(logo_path).convert('RGBA')
-
-            # 计算Logo大小（二维码的1/5）
-            qr_width, qr_height = qr_img.size
-            logo_size = min(qr_width, qr_height) // 5
-
-            # 调整Logo大小
-            logo.thumbnail((logo_size, logo_size), Image.Resampling.LANCZOS)
-            logo_width, logo_height = logo.size
+    app = Flask(__name__)
+    app.config.from_object(config)
 
-            # 创建白色背景
-            bg_size = int(logo_size * 1.2)
-            bg_img = Image.new('RGBA', (bg_size, bg_size), (255, 255, 255, 255))
+    # 初始化扩展
+    db.init_app(app)
+    event_bus.init_app(app)
+    app.register_blueprint(bp)
+    return app
 
-            if logo_bg_shape == 'circle':
-                # 创建圆形遮罩
-                mask = Image.new('L', (bg_size, bg_size), 0)
-                draw = ImageDraw.Draw(mask)
-                draw.ellipse((0, 0, bg_size, bg_size), fill=255)
-                bg_img.putalpha(mask)
 
-            # 将Logo粘贴到白色背景中央
-            logo_pos = ((bg_size - logo_width) // 2, (bg_size - logo_height) // 2)
-            bg_img.paste(logo, logo_pos, logo)
+def start_background_tasks(app):
+    """启动调度器, 以及配置了的新区块订阅和通知分发, 返回调度器"""
+    from flask_apscheduler import APScheduler
+    from block_watcher import BlockWatcher
+    from notifier import notification_dispatcher
 
-            # 将带背景的Logo粘贴到二维码中央
-            qr_pos = ((qr_width - bg_size) // 2, (qr_height - bg_size) // 2)
-            qr_img.paste(bg_img, qr_pos, bg_img)
+    # 调度任务的参数替换为app实例, 不修改配置类中共享的任务列表
+    app.config['JOBS'] = [dict(job, args=(app,)) for job in app.config['JOBS']]
+    scheduler = APScheduler()
+    scheduler.init_app(app)
+    scheduler.start()
 
-        except Exception as e:
-            app.logger.warning(f"Failed to add logo to QR code: {e}")
+    # 配置了WebSocket节点时由新区块驱动订单检查
+    if app.config.get('BSC_WS_ENDPOINT'):
+        BlockWatcher(app, scheduler).start()
 
-    # 转换为Base64
-    buffered = BytesIO()
-    qr_img.save(buffered, format="PNG")
-    img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
+    # 配置了通知地址时在后台投递支付通知
+    if app.config.get('WEBHOOK_URLS'):
+        notification_dispatcher.start(app)
+    return scheduler
 
-    return img_str
 
-
-@app.route('/')
+@bp.route('/')
 def index():
     """首页"""
     return '''
@@ -213,75 +172,247 @@ def index():
     '''
 
 
-@app.route('/create_order', methods=['POST'])
+@bp.route('/create_order', methods=['POST'])
 def create_order():
     """创建订单"""
+    from address_pool import claim_address
+    from amount_allocator import get_amount_allocator
+    from web3_support import get_web3_support
+
+    app = current_app._get_current_object()
+    w3 = get_web3_support(app)
     try:
         # 获取金额
         amount = float(request.form.get('amount', 0))
         if amount <= 0:
             return "Invalid amount", 400
 
-        # 创建新的收款地址
-        account = w3.create_account()
-        if not account:
-            return "Failed to create payment address", 500
-
-        # 生成二维码
-        logo_path = os.path.join(app.root_path, 'static', 'img', 'usdt-bsc.png')
-        qr_code = generate_qr_with_logo(account['address'], logo_path)
+        order_no = str(uuid.uuid4())
+        expire_time = datetime.utcnow() + timedelta(hours=2)  # 2小时过期
+        pay_amount = None
+
+        if app.config.get('PAYMENT_MODE') == 'amount':
+            # 统一收款到归集地址，以唯一的支付金额识别订单，无需归集
+            if not w3.collect_address:
+                return "Collection address not configured", 500
+            hold_until = expire_time + timedelta(seconds=app.config.get('AMOUNT_HOLD_SECONDS', 3600))
+            pay_amount = get_amount_allocator(app).reserve(amount, order_no, hold_until)
+            if pay_amount is None:
+                return "Too many pending orders with this amount, please try again later", 503
+            account = {'address': w3.collect_address, 'private_key': None}
+        else:
+            # 优先从地址池领取预先生成的地址和二维码
+            account = claim_address()
+            if account:
+                db.session.add(QRCode(address=account['address'], png=account['qr_png']))
+            else:
+                # 地址池为空，现场创建新的收款地址，二维码在首次访问时生成
+                account = w3.create_account()
+                if not account:
+                    return "Failed to create payment address", 500
 
         # 创建订单
         order = Order(
-            order_no=str(uuid.uuid4()),
+            order_no=order_no,
             amount=amount,
+            pay_amount=pay_amount,
             status=OrderStatus.UNPAID,
             address=account['address'],
             private_key=account['private_key'],
-            qr_code=qr_code,
-            expire_time=datetime.utcnow() + timedelta(hours=2)  # 2小时过期
+            derivation_index=account.get('derivation_index'),
+            expire_time=expire_time
         )
 
         db.session.add(order)
         db.session.commit()
+        ORDER_TRANSITIONS.labels('created').inc()
 
         app.logger.info(f'Created order {order.order_no} for {amount} USDT')
 
         # 重定向到订单页面
-        return redirect(url_for('order_detail', order_no=order.order_no))
+        return redirect(url_for('.order_detail', order_no=order.order_no))
 
     except Exception as e:
         app.logger.exception(f'Error creating order: {e}')
         return f"Error: {str(e)}", 500
 
 
-@app.route('/order/<order_no>')
+@bp.route('/api/orders/batch', methods=['POST'])
+def create_orders_batch():
+    """批量创建订单, 请求体为 {"orders": [{"amount": 10}, ...]}, 返回订单号与收款地址"""
+    from order_batch import create_orders
+    from web3_support import get_web3_support
+
+    app = current_app._get_current_object()
+    w3 = get_web3_support(app)
+    body = request.get_json(silent=True)
+    items = body.get('orders') if isinstance(body, dict) else None
+    max_batch = app.config['ORDER_BATCH_MAX']
+    if not isinstance(items, list) or not 0 < len(items) <= max_batch:
+        return jsonify({'error': f'orders must be a list of 1-{max_batch} items'}), 400
+    try:
+        amounts = [float(item['amount']) for item in items]
+    except (TypeError, KeyError, ValueError):
+        return jsonify({'error': 'Each order needs a numeric amount'}), 400
+    if not all(0 < amount < float('inf') for amount in amounts):
+        return jsonify({'error': 'Invalid amount'}), 400
+    if app.config.get('PAYMENT_MODE') == 'amount' and not w3.collect_address:
+        return jsonify({'error': 'Collection address not configured'}), 500
+
+    try:
+        orders = create_orders(app, w3, amounts)
+    except Exception as e:
+        db.session.rollback()
+        app.logger.exception(f'Error creating orders in batch: {e}')
+        return jsonify({'error': str(e)}), 500
+    if orders is None:
+        return jsonify({'error': 'Too many pending orders with these amounts, please try again later'}), 503
+
+    ORDER_TRANSITIONS.labels('created').inc(len(orders))
+    app.logger.info(f'Created {len(orders)} orders in batch')
+    for order in orders:
+        order['url'] = url_for('.order_detail', order_no=order['order_no'], _external=True)
+    return jsonify({'orders': orders}), 201
+
+
+def expire_if_due(order):
+    """未支付订单超过过期时间时标记为过期"""
+    if order.expire_time < datetime.utcnow() and order.status == OrderStatus.UNPAID:
+        order.status = OrderStatus.EXPIRED
+        db.session.commit()
+        ORDER_TRANSITIONS.labels(OrderStatus.EXPIRED.value).inc()
+        event_bus.publish(order.order_no, order.status)
+
+
+def status_payload(status):
+    """订单状态的返回格式"""
+    return {
+        'status': status.value,
+        'paid': status == OrderStatus.PAID,
+        'expired': status == OrderStatus.EXPIRED
+    }
+
+
+@bp.route('/order/<order_no>')
 def order_detail(order_no):
     """订单详情页面"""
     order = Order.query.filter_by(order_no=order_no).first_or_404()
+    expire_if_due(order)
+    mark_watched(current_app, order)
     return render_template('order.html', order=order)
 
 
-@app.route('/order/<order_no>/check')
-def check_order_status(order_no):
-    """检查订单状态API"""
-    order = Order.query.filter_by(order_no=order_no).first_or_404()
+@bp.route('/order/<order_no>/qr.png')
+def order_qr_code(order_no):
+    """订单收款二维码图片"""
+    address = db.session.query(Order.address).filter_by(order_no=order_no).scalar()
+    if address is None:
+        abort(404)
 
-    # 检查是否过期
-    if order.expire_time < datetime.utcnow() and order.status == OrderStatus.UNPAID:
-        order.status = OrderStatus.EXPIRED
-        db.session.commit()
+    # 二维码只由地址决定，客户端缓存有效时无需读取图片
+    etag = qr_etag(address)
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = Response(get_qr_png(address), mimetype='image/png')
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = 86400
+    return response
 
-    return jsonify({
-        'status': order.status.value,
-        'paid': order.status == OrderStatus.PAID,
-        'expired': order.status == OrderStatus.EXPIRED
-    })
 
+@bp.route('/order/<order_no>/check')
+def check_order_status(order_no):
+    """检查订单状态API, 传入wait参数时长轮询等待状态变化"""
+    wait = min(request.args.get('wait', 0, type=int), current_app.config['ORDER_WAIT_MAX_SECONDS'])
 
-@app.route('/order/<order_no>/collect', methods=['POST'])
+    # 先订阅再查询，避免错过两者之间发布的状态
+    events = event_bus.subscribe(order_no)
+    try:
+        order = Order.query.filter_by(order_no=order_no).first_or_404()
+
+        # 检查是否过期
+        expire_if_due(order)
+        mark_watched(current_app, order)
+        status = order.status
+        expire_time = order.expire_time
+        # 等待期间不占用数据库连接
+        db.session.remove()
+
+        if status == OrderStatus.UNPAID and wait > 0:
+            timeout = min(wait, (expire_time - datetime.utcnow()).total_seconds())
+            try:
+                status = events.get(timeout=max(timeout, 0))
+            except queue.Empty:
+                if expire_time < datetime.utcnow():
+                    status = OrderStatus.EXPIRED
+    finally:
+        event_bus.unsubscribe(order_no, events)
+
+    return jsonify(status_payload(status))
+
+
+@bp.route('/order/<order_no>/events')
+def order_events(order_no):
+    """订单状态的Server-Sent Events推送"""
+    app = current_app._get_current_object()
+    heartbeat = app.config['ORDER_EVENTS_HEARTBEAT']
+    max_wait = app.config['ORDER_WAIT_MAX_SECONDS']
+    retry = app.config['ORDER_EVENTS_RETRY_MS']
+    events = event_bus.subscribe(order_no)
+    try:
+        order = Order.query.filter_by(order_no=order_no).first_or_404()
+        expire_if_due(order)
+        mark_watched(current_app, order)
+        order_id = order.id
+        status = order.status
+        expire_time = order.expire_time
+        db.session.remove()
+    except Exception:
+        event_bus.unsubscribe(order_no, events)
+        raise
+
+    def stream():
+        try:
+            current = status
+            # 连接到达最长时间后关闭, 不长期占用工作线程, 浏览器按retry(毫秒)自动重连
+            close_time = datetime.utcnow() + timedelta(seconds=max_wait)
+            yield f'retry: {retry}\ndata: {json.dumps(status_payload(current))}\n\n'
+            while current == OrderStatus.UNPAID:
+                now = datetime.utcnow()
+                remaining = (expire_time - now).total_seconds()
+                lifetime = (close_time - now).total_seconds()
+                if remaining <= 0:
+                    current = OrderStatus.EXPIRED
+                elif lifetime <= 0:
+                    break
+                else:
+                    try:
+                        current = events.get(timeout=min(heartbeat, remaining, lifetime))
+                    except queue.Empty:
+                        # 心跳，保持连接并及时发现客户端断开
+                        yield ': keepalive\n\n'
+                        # 页面仍然打开，保持频繁检查
+                        touch_watched(app, order_id)
+                        continue
+                yield f'data: {json.dumps(status_payload(current))}\n\n'
+        finally:
+            event_bus.unsubscribe(order_no, events)
+
+    response = Response(stream(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@bp.route('/order/<order_no>/collect', methods=['POST'])
 def collect_order_funds(order_no):
     """手动归集订单资金"""
+    from collector import enqueue_collection
+    from web3_support import get_web3_support
+
+    app = current_app._get_current_object()
+    w3 = get_web3_support(app)
     order = Order.query.filter_by(order_no=order_no).first_or_404()
 
     # 只有已支付的订单才能归集
@@ -291,6 +422,13 @@ def collect_order_funds(order_no):
             'message': 'Only paid orders can be collected'
         }), 400
 
+    # 统一收款地址模式的订单直接付款到归集地址, 无需归集
+    if order.pay_amount is not None:
+        return jsonify({
+            'success': False,
+            'message': 'Orders paid to the collection address need no collection'
+        }), 400
+
     try:
         # 检查地址余额
         current_balance = w3.get_usdt_balance(order.address)
@@ -308,33 +446,31 @@ def collect_order_funds(order_no):
                 'message': 'Collection address not configured'
             })
 
-        app.logger.info(f'Manual collection triggered for order {order.order_no}, balance: {current_balance} USDT')
-
-        # 执行归集
-        collect_tx = w3.collect_usdt(
-            order.address,
-            order.private_key,
-            current_balance
-        )
-
-        if collect_tx:
-            # 更新订单信息
-            order.collect_tx_hash = collect_tx
-            order.update_time = datetime.utcnow()
-            db.session.commit()
-
+        # 已有进行中的归集任务时不重复创建
+        active_job = CollectJob.query.filter(
+            CollectJob.order_id == order.id,
+            CollectJob.status.in_([CollectStatus.PENDING, CollectStatus.GAS_FUNDING, CollectStatus.TRANSFER_SENT])
+        ).first()
+        if active_job:
             return jsonify({
                 'success': True,
-                'message': f'Successfully collected {current_balance:.2f} USDT',
-                'tx_hash': collect_tx,
-                'amount': current_balance
-            })
-        else:
-            return jsonify({
-                'success': False,
-                'message': 'Collection failed, please check logs'
+                'message': f'Collection already in progress ({active_job.status.value})',
+                'job_id': active_job.id
             })
 
+        app.logger.info(f'Manual collection triggered for order {order.order_no}, balance: {current_balance} USDT')
+
+        # 交由后台归集任务处理，交易上链后由收据跟踪器更新订单
+        job = enqueue_collection(app, order, current_balance)
+        db.session.commit()
+
+        return jsonify({
+            'success': True,
+            'message': f'Collection of {current_balance:.2f} USDT queued',
+            'job_id': job.id,
+            'amount': current_balance
+        })
+
     except Exception as e:
         app.logger.error(f'Error collecting funds for order {order.order_no}: {e}')
         return jsonify({
@@ -344,7 +480,7 @@ def collect_order_funds(order_no):
 
 
 # 健康检查端点
-@app.route('/health')
+@bp.route('/health')
 def health_check():
     """健康检查"""
     return jsonify({
@@ -353,16 +489,113 @@ def health_check():
     })
 
 
+@bp.route('/metrics')
+def metrics():
+    """Prometheus指标"""
+    data, content_type = render_metrics()
+    return Response(data, content_type=content_type)
+
+
 # 手动触发订单检查（仅用于测试）
-@app.route('/admin/check_orders')
+@bp.route('/admin/check_orders')
 def manual_check_orders():
     """手动触发订单检查"""
-    check_orders(app)
+    from scheduler import check_orders
+
+    check_orders(current_app._get_current_object())
     return 'Order check completed. <a href="/">Back to home</a>'
 
 
+# 地址池状态
+@bp.route('/admin/address_pool')
+def address_pool_status():
+    """查看地址池状态"""
+    from address_pool import pool_stats
+
+    return jsonify(pool_stats(current_app))
+
+
+@bp.route('/admin/orders')
+def admin_list_orders():
+    """
+    订单列表, 按创建时间倒序分页
+    参数: status, created_after, created_before, fields, limit, cursor(上一页返回的next_cursor)
+    """
+    try:
+        fields = parse_fields(request.args.get('fields'))
+        filters = parse_filters(request.args)
+        limit = min(max(int(request.args.get('limit', 100)), 1), current_app.config['ADMIN_ORDERS_MAX_LIMIT'])
+        orders, next_cursor = list_orders(filters, fields, request.args.get('cursor'), limit)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    return jsonify({'orders': orders, 'next_cursor': next_cursor})
+
+
+@bp.route('/admin/orders/export')
+def admin_export_orders():
+    """流式导出订单, format为csv或ndjson, 过滤参数与订单列表相同"""
+    export_format = request.args.get('format', 'csv')
+    if export_format not in ('csv', 'ndjson'):
+        return jsonify({'error': 'format must be csv or ndjson'}), 400
+    try:
+        fields = parse_fields(request.args.get('fields'))
+        filters = parse_filters(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    rows = export_orders(filters, fields, export_format, current_app.config['ADMIN_EXPORT_CHUNK_SIZE'])
+    response = Response(
+        stream_with_context(rows),
+        mimetype='text/csv' if export_format == 'csv' else 'application/x-ndjson'
+    )
+    response.headers['Content-Disposition'] = f'attachment; filename=orders.{export_format}'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@bp.cli.command('reconcile')
+@click.option('--from-block', type=int, help='起始区块，默认从上次对账的位置继续')
+@click.option('--to-block', type=int, help='结束区块，默认为最新的已确认区块')
+@click.option('--workers', type=int, help='并发获取事件的线程数')
+def reconcile_command(from_block, to_block, workers):
+    """对账历史区块，补记遗漏或迟到的支付"""
+    from reconcile import reconcile
+
+    stats = reconcile(current_app._get_current_object(), from_block, to_block, workers)
+    click.echo(json.dumps(stats))
+
+
+@bp.cli.command('init-db')
+def init_db_command():
+    """创建数据库表, 已有旧版本的数据库时升级orders表"""
+    from migrations import upgrade_schema
+
+    for step in upgrade_schema():
+        click.echo(f'Upgraded: {step}')
+    click.echo('Database tables created')
+
+
+@bp.cli.command('run-scheduler')
+def run_scheduler_command():
+    """运行订单检查、归集等后台任务, 与Web进程分开部署和扩容"""
+    app = current_app._get_current_object()
+    db.create_all()
+    scheduler = start_background_tasks(app)
+    app.logger.info('Scheduler started')
+    if start_metrics_server(app.config.get('SCHEDULER_METRICS_PORT')):
+        app.logger.info(f"Scheduler metrics at http://0.0.0.0:{app.config['SCHEDULER_METRICS_PORT']}/metrics")
+
+    stopped = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *args: stopped.set())
+    stopped.wait()
+    scheduler.shutdown()
+    app.logger.info('Scheduler stopped')
+
+
 # 错误处理
-@app.errorhandler(404)
+@bp.app_errorhandler(404)
 def not_found(error):
     return '''
     <h1>404 - Page Not Found</h1>
@@ -371,7 +604,7 @@ def not_found(error):
     ''', 404
 
 
-@app.errorhandler(500)
+@bp.app_errorhandler(500)
 def internal_error(error):
     return '''
     <h1>500 - Internal Server Error</h1>
@@ -381,4 +614,9 @@ def internal_error(error):
 
 
 if __name__ == '__main__':
+    # 开发环境: 在同一进程中运行Web服务与后台任务
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+    start_background_tasks(app)
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -0,0 +1,97 @@
+import asyncio
+import threading
+
+from web3 import AsyncWeb3, Web3
+
+from rpc_provider import AsyncFailoverHTTPProvider
+from web3_support import USDT_ADDRESS, USDT_ABI
+
+_registry_lock = threading.Lock()
+
+
+def get_async_web3_support(app):
+    """获取进程内共享的AsyncWeb3Support, 各轮检查复用同一个事件循环与节点会话"""
+    with _registry_lock:
+        support = app.extensions.get('async_web3_support')
+        if support is None:
+            support = AsyncWeb3Support(app)
+            app.extensions['async_web3_support'] = support
+        return support
+
+
+class AsyncWeb3Support(object):
+    """
+    异步Web3交互支持类, 用于并发查询链上数据
+    在独立线程中运行常驻事件循环, aiohttp会话绑定该循环, 因此不随每轮检查重建
+    """
+
+    def __init__(self, app=None):
+        self.app = app
+        self.w3 = None
+        self.usdt_address = USDT_ADDRESS
+        self.usdt_abi = USDT_ABI
+        self.usdt_contract = None
+        self._loop = None
+        self._loop_lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """初始化应用, 不在此处检查连接, 避免阻塞"""
+        self.app = app
+        bsc_endpoints = app.config.get('BSC_ENDPOINTS') or [app.config.get('BSC_ENDPOINT')]
+        bsc_endpoints = [endpoint for endpoint in bsc_endpoints if endpoint]
+        if bsc_endpoints:
+            try:
+                # 连接到BSC节点, 与同步Provider一样在请求失败时自动切换节点
+                self.w3 = AsyncWeb3(AsyncFailoverHTTPProvider(
+                    bsc_endpoints,
+                    pool_size=app.config.get('RPC_POOL_SIZE', 20),
+                    timeout=app.config.get('RPC_TIMEOUT', 10)
+                ))
+                # 只做eth_call查询, 去掉校验中间件, 避免每次调用前多发一次eth_chainId
+                self.w3.middleware_onion.remove('validation')
+
+                # 允许覆盖合约地址, 便于连接本地测试链
+                if app.config.get('BSC_USDT_ADDRESS'):
+                    self.usdt_address = Web3.to_checksum_address(app.config['BSC_USDT_ADDRESS'])
+
+                # 初始化USDT合约
+                self.usdt_contract = self.w3.eth.contract(
+                    address=self.usdt_address,
+                    abi=self.usdt_abi
+                )
+
+            except Exception as e:
+                app.logger.error(f'Failed to initialize AsyncWeb3: {e}')
+
+    def run(self, coroutine):
+        """在常驻事件循环中执行协程并等待结果, 可在任意线程调用"""
+        with self._loop_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name='async-web3', daemon=True).start()
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    async def is_connected(self):
+        """检查节点连接"""
+        if not self.w3:
+            return False
+        return await self.w3.is_connected()
+
+    async def get_usdt_balance(self, address):
+        """获取指定地址的USDT余额, 失败时返回None以便调用方区分"""
+        if not self.w3 or not self.usdt_contract:
+            self.app.logger.error('AsyncWeb3 not initialized')
+            return None
+
+        try:
+            address = Web3.to_checksum_address(address)
+            balance_wei = await self.usdt_contract.functions.balanceOf(address).call()
+            balance = balance_wei / 10 ** 18  # USDT在BSC上是18位小数
+            self.app.logger.debug(f'USDT balance for {address}: {balance}')
+            return float(balance)
+        except Exception as e:
+            self.app.logger.error(f'Error getting USDT balance for {address}: {e}')
+            return None
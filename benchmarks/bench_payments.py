@@ -0,0 +1,298 @@
+"""
+收款流程基准: 在本地模拟链上测量订单检查、下单与归集的性能
+用法: python benchmarks/bench_payments.py [-n 1000] [--latency 0.02] [--modes balance,async,logs]
+输出JSON, 便于在不同提交之间比较
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from eth_account import Account
+
+from mock_chain import MockChain, TOKEN_ADDRESS, MULTICALL_ADDRESS
+
+
+def setup_app(chain, database_path):
+    """通过环境变量把应用指向模拟链与临时数据库, 再创建应用"""
+    gas_account = Account.create()
+    collect_account = Account.create()
+    chain.fund(gas_account.address, 1000000)
+
+    os.environ.update({
+        'DATABASE_URL': f'sqlite:///{database_path}',
+        'BSC_ENDPOINT': chain.url,
+        'BSC_ENDPOINTS': chain.url,
+        'BSC_USDT_ADDRESS': TOKEN_ADDRESS,
+        'BSC_MULTICALL_ADDRESS': MULTICALL_ADDRESS,
+        'BSC_COLLECT_ADDRESS': collect_account.address,
+        'BSC_GAS_ADDRESS': gas_account.address,
+        'BSC_GAS_ADDRESS_PRIVATE_KEY': gas_account.key.hex(),
+    })
+
+    from app import create_app
+    from models import db
+    # 基准测试直接调用各个任务, 不启动后台调度
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+def reset_database(app):
+    from models import db
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+
+def seed_orders(app, n, amount=10.0):
+    """批量创建已到检查时间的未支付订单, 返回收款地址列表"""
+    from sqlalchemy import insert
+    from models import db, Order, OrderStatus
+
+    now = datetime.utcnow()
+    accounts = [Account.create() for _ in range(n)]
+    with app.app_context():
+        db.session.execute(insert(Order), [
+            {
+                'order_no': f'bench-{index}-{account.address}',
+                'amount': amount,
+                'status': OrderStatus.UNPAID,
+                'address': account.address,
+                'private_key': account.key.hex(),
+                'create_time': now,
+                'update_time': now,
+                'expire_time': now + timedelta(hours=2),
+                'next_check_at': now - timedelta(seconds=1)
+            }
+            for index, account in enumerate(accounts)
+        ])
+        db.session.commit()
+    return [account.address for account in accounts]
+
+
+def seed_payments(app, chain, addresses, amount=10.0, per_block=100):
+    """在模拟链上为订单付款, 并使事件扫描从付款前的区块开始"""
+    from models import db, ScanCursor
+    from scheduler import TRANSFER_CURSOR
+
+    with app.app_context():
+        db.session.add(ScanCursor(name=TRANSFER_CURSOR, block_number=chain.block_number))
+        db.session.commit()
+
+    for start in range(0, len(addresses), per_block):
+        chain.pay([(address, amount) for address in addresses[start:start + per_block]])
+    # 付款所在区块全部达到确认数
+    chain.mine(app.config['CONFIRMATION_BLOCKS'])
+
+
+def count_orders(app, status):
+    from models import Order
+    with app.app_context():
+        return Order.query.filter_by(status=status).count()
+
+
+def bench_sweep(app, chain, mode, n, payments):
+    """一轮check_orders的耗时与RPC调用次数"""
+    from models import OrderStatus
+    from scheduler import check_orders
+
+    reset_database(app)
+    addresses = seed_orders(app, n)
+    seed_payments(app, chain, addresses[:payments])
+
+    app.config['DETECTION_MODE'] = mode
+    chain.reset_stats()
+    start = time.perf_counter()
+    check_orders(app)
+    elapsed = time.perf_counter() - start
+
+    return dict(
+        orders=n,
+        payments=payments,
+        detected=count_orders(app, OrderStatus.PAID),
+        sweep_seconds=round(elapsed, 4),
+        **chain.stats()
+    )
+
+
+def bench_create_order(app, count, use_pool):
+    """下单接口的响应时间分布"""
+    from address_pool import refill_address_pool
+
+    reset_database(app)
+    if use_pool:
+        app.config['ADDRESS_POOL_LOW'] = count
+        app.config['ADDRESS_POOL_HIGH'] = count
+        refill_address_pool(app)
+
+    client = app.test_client()
+    timings = []
+    for _ in range(count):
+        start = time.perf_counter()
+        response = client.post('/create_order', data={'amount': '10'})
+        timings.append((time.perf_counter() - start) * 1000)
+        if response.status_code != 302:
+            raise RuntimeError(f'create_order returned {response.status_code}')
+
+    timings.sort()
+    return {
+        'requests': count,
+        'p50_ms': round(statistics.median(timings), 3),
+        'p99_ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.99))], 3),
+        'mean_ms': round(statistics.fmean(timings), 3)
+    }
+
+
+def bench_collection(app, chain, count, timeout):
+    """归集任务从创建到链上确认的吞吐量, 交易收据由收据跟踪器批量查询"""
+    from sqlalchemy import update
+    from collector import enqueue_collections, process_collect_jobs
+    from receipt_tracker import poll_receipts
+    from models import db, Order, OrderStatus, CollectJob, CollectStatus
+
+    reset_database(app)
+    addresses = seed_orders(app, count)
+    chain.pay([(address, 10.0) for address in addresses])
+    with app.app_context():
+        db.session.execute(update(Order).values(status=OrderStatus.PAID, paid_amount=10.0))
+        enqueue_collections(app, [(order.id, 10.0) for order in Order.query.all()])
+        db.session.commit()
+
+    def remaining():
+        with app.app_context():
+            return CollectJob.query.filter(
+                CollectJob.status.notin_([CollectStatus.CONFIRMED, CollectStatus.FAILED])
+            ).count()
+
+    chain.reset_stats()
+    start = time.perf_counter()
+    while remaining() and time.perf_counter() - start < timeout:
+        process_collect_jobs(app)
+        if not chain.block_time:
+            # 交易立即出块时, 最后一笔交易之后不再有新区块, 收据跟踪器只在新区块时查询
+            chain.mine()
+        poll_receipts(app)
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - start
+
+    with app.app_context():
+        confirmed = CollectJob.query.filter_by(status=CollectStatus.CONFIRMED).count()
+        failed = CollectJob.query.filter_by(status=CollectStatus.FAILED).count()
+
+    return dict(
+        jobs=count,
+        confirmed=confirmed,
+        failed=failed,
+        seconds=round(elapsed, 4),
+        jobs_per_second=round(confirmed / elapsed, 2) if elapsed else None,
+        **chain.stats()
+    )
+
+
+def bench_reconcile(app, chain, count, blocks, max_log_blocks):
+    """历史对账的吞吐量: 已过期订单的付款分散在blocks个区块中, 节点限制eth_getLogs的区块跨度"""
+    from sqlalchemy import update
+    from models import db, Order, OrderStatus
+    from reconcile import reconcile
+
+    reset_database(app)
+    addresses = seed_orders(app, count)
+    with app.app_context():
+        db.session.execute(update(Order).values(status=OrderStatus.EXPIRED))
+        db.session.commit()
+
+    from_block = chain.block_number + 1
+    step = max(blocks // count, 1)
+    for address in addresses:
+        chain.pay([(address, 10.0)])
+        chain.mine(step - 1)
+    chain.mine(max(from_block + blocks - 1 - chain.block_number, 0))
+
+    chain.reset_stats()
+    chain.max_log_blocks = max_log_blocks
+    try:
+        with app.app_context():
+            stats = reconcile(app, from_block, chain.block_number)
+    finally:
+        chain.max_log_blocks = None
+
+    return dict(
+        stats,
+        detected=count_orders(app, OrderStatus.PAID),
+        **chain.stats()
+    )
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=1000, help='每轮检查的订单数量')
+    parser.add_argument('--payments', type=int, help='已付款订单数量, 默认与订单数量相同')
+    parser.add_argument('--modes', default='balance,async,logs', help='要测量的检测方式, 逗号分隔')
+    parser.add_argument('--latency', type=float, default=0.02, help='模拟链每个HTTP请求的延迟(秒)')
+    parser.add_argument('--block-time', type=float, default=0.0, help='出块间隔(秒), 0表示交易立即出块')
+    parser.add_argument('--create', type=int, default=200, help='下单请求数量')
+    parser.add_argument('--collect', type=int, default=100, help='归集任务数量')
+    parser.add_argument('--collect-timeout', type=float, default=120, help='归集测量的最长时间(秒)')
+    parser.add_argument('--reconcile-blocks', type=int, default=100000, help='历史对账的区块数')
+    parser.add_argument('--max-log-blocks', type=int, default=2000, help='模拟节点允许的eth_getLogs最大区块跨度')
+    parser.add_argument('--log-level', default='WARNING', help='应用日志级别')
+    args = parser.parse_args()
+
+    payments = args.n if args.payments is None else min(args.payments, args.n)
+    chain = MockChain(latency=args.latency, block_time=args.block_time).start()
+    workdir = tempfile.mkdtemp(prefix='bench-payments-')
+    # 避免在仓库目录下生成数据库文件
+    os.chdir(workdir)
+
+    try:
+        app = setup_app(chain, os.path.join(workdir, 'bench.db'))
+        logging.getLogger().setLevel(args.log_level)
+        app.logger.setLevel(args.log_level)
+
+        results = {
+            'revision': git_revision(),
+            'params': {
+                'orders': args.n,
+                'payments': payments,
+                'latency': args.latency,
+                'block_time': args.block_time
+            },
+            'sweep': {
+                mode: bench_sweep(app, chain, mode, args.n, payments)
+                for mode in args.modes.split(',') if mode
+            },
+            'create_order': {
+                'pool_empty': bench_create_order(app, args.create, use_pool=False),
+                'pool': bench_create_order(app, args.create, use_pool=True)
+            },
+            'collection': bench_collection(app, chain, args.collect, args.collect_timeout),
+            'reconcile': bench_reconcile(app, chain, args.collect, args.reconcile_blocks, args.max_log_blocks)
+        }
+    finally:
+        chain.stop()
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""
+二维码渲染微基准: 统计单张图片耗时与内存峰值
+每种实现在独立的子进程中运行, 以常驻内存(RSS)峰值的增长衡量包括Pillow图像缓冲区在内的内存占用
+用法: python benchmarks/bench_qr.py [-n 200]
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import qrcode
+from eth_account import Account
+from PIL import Image, ImageDraw
+import qr_support
+
+LOGO_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'static', 'img', 'usdt-bsc.png')
+
+
+def baseline_qr_with_logo(data, logo_path, logo_bg_shape='circle'):
+    """优化前的实现(RGBA图像, 每张重新读取并用LANCZOS缩放Logo), 作为对比基线"""
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_H,
+        box_size=10,
+        border=4,
+    )
+    qr.add_data(data)
+    qr.make(fit=True)
+    qr_img = qr.make_image(fill_color="black", back_color="white").convert('RGBA')
+
+    logo = Image.open(logo_path).convert('RGBA')
+    qr_width, qr_height = qr_img.size
+    logo_size = min(qr_width, qr_height) // 5
+    logo.thumbnail((logo_size, logo_size), Image.Resampling.LANCZOS)
+    logo_width, logo_height = logo.size
+
+    bg_size = int(logo_size * 1.2)
+    bg_img = Image.new('RGBA', (bg_size, bg_size), (255, 255, 255, 255))
+    if logo_bg_shape == 'circle':
+        mask = Image.new('L', (bg_size, bg_size), 0)
+        draw = ImageDraw.Draw(mask)
+        draw.ellipse((0, 0, bg_size, bg_size), fill=255)
+        bg_img.putalpha(mask)
+
+    logo_pos = ((bg_size - logo_width) // 2, (bg_size - logo_height) // 2)
+    bg_img.paste(logo, logo_pos, logo)
+    qr_pos = ((qr_width - bg_size) // 2, (qr_height - bg_size) // 2)
+    qr_img.paste(bg_img, qr_pos, bg_img)
+
+    buffered = BytesIO()
+    qr_img.save(buffered, format="PNG")
+    return buffered.getvalue()
+
+
+def peak_rss():
+    """进程的常驻内存峰值(字节), Linux上ru_maxrss的单位为KB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def current_rss():
+    """进程当前的常驻内存(字节), 无法读取/proc时退回到峰值"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return peak_rss()
+
+
+VARIANTS = ('baseline', 'QRRenderer.render', 'QRRenderer.render_many')
+
+
+def make_render(variant):
+    """返回渲染一组地址的函数, 渲染器在测量开始前创建, 不计入内存增长"""
+    renderer = qr_support.QRRenderer(LOGO_PATH)
+    return {
+        'baseline': lambda items: [baseline_qr_with_logo(a, LOGO_PATH) for a in items],
+        'QRRenderer.render': lambda items: [renderer.render(a) for a in items],
+        'QRRenderer.render_many': renderer.render_many
+    }[variant]
+
+
+def measure(render, addresses):
+    """
+    返回单张耗时(毫秒)与内存占用:
+    rss_peak_growth_bytes: 渲染全部图片期间常驻内存峰值的增长, 包括Pillow在C层分配的图像缓冲区
+    pillow_images_per_image: 每张二维码创建的Pillow图像数(中间图像越多, 分配与复制越多)
+    python_heap_peak_bytes_per_image: tracemalloc统计的单张Python堆峰值, 不含Pillow的C内存
+    """
+    rss_before = current_rss()
+    images_before = Image.core.get_stats()['new_count']
+
+    render(addresses[:1])  # 预热
+    start = time.perf_counter()
+    render(addresses)
+    elapsed = time.perf_counter() - start
+
+    rss_growth = peak_rss() - rss_before
+    images = Image.core.get_stats()['new_count'] - images_before
+
+    peaks = []
+    tracemalloc.start()
+    for address in addresses[:20]:
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        render([address])
+        _, peak = tracemalloc.get_traced_memory()
+        peaks.append(peak - current)
+    tracemalloc.stop()
+
+    return {
+        'per_image_ms': round(elapsed / len(addresses) * 1000, 3),
+        'rss_peak_growth_bytes': max(rss_growth, 0),
+        'pillow_images_per_image': round(images / (len(addresses) + 1), 2),
+        'python_heap_peak_bytes_per_image': round(sum(peaks) / len(peaks))
+    }
+
+
+def run_variant(variant, n):
+    """在全新的子进程中测量一种实现, 避免前一种实现留下的内存峰值与缓存影响结果"""
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '-n', str(n), '--variant', variant],
+        check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=200, help='渲染的地址数量')
+    parser.add_argument('--variant', choices=VARIANTS, help='只在当前进程中测量一种实现(供子进程使用)')
+    args = parser.parse_args()
+
+    if args.variant:
+        addresses = [Account.create().address for _ in range(args.n)]
+        print(json.dumps(measure(make_render(args.variant), addresses)))
+        return
+
+    results = {variant: run_variant(variant, args.n) for variant in VARIANTS}
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,342 @@
+"""
+本地模拟链: 以JSON-RPC服务的形式模拟BSC节点, 供基准测试使用
+包含一个类USDT的ERC-20合约(18位小数)、Multicall3合约与原生币转账, 每个HTTP请求可附加固定延迟
+"""
+import json
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import rlp
+from eth_abi import decode, encode
+from eth_account import Account
+from web3 import Web3
+
+CHAIN_ID = 56
+TOKEN_ADDRESS = Web3.to_checksum_address('0x' + 'aa' * 20)
+MULTICALL_ADDRESS = Web3.to_checksum_address('0x' + 'cc' * 20)
+TRANSFER_EVENT_TOPIC = Web3.to_hex(Web3.keccak(text='Transfer(address,address,uint256)'))
+GAS_PRICE = Web3.to_wei(3, 'gwei')
+NATIVE_TRANSFER_GAS = 21000
+TOKEN_TRANSFER_GAS = 51000
+
+BALANCE_OF = Web3.keccak(text='balanceOf(address)')[:4]
+TRANSFER = Web3.keccak(text='transfer(address,uint256)')[:4]
+AGGREGATE3 = Web3.keccak(text='aggregate3((address,bool,bytes)[])')[:4]
+
+
+class RPCError(Exception):
+    """返回给客户端的JSON-RPC错误"""
+
+
+class MockChain(object):
+    """
+    模拟链状态与JSON-RPC服务, block_time为0时每笔交易立即单独出块
+    max_log_blocks限制eth_getLogs的区块跨度, 模拟拒绝过宽范围的公共节点
+    """
+
+    def __init__(self, latency: float = 0.0, block_time: float = 0.0, max_log_blocks: int = None):
+        self.latency = latency
+        self.block_time = block_time
+        self.max_log_blocks = max_log_blocks
+        self.block_number = 1
+        self.token_balances = Counter()
+        self.native_balances = Counter()
+        self.nonces = Counter()
+        self.logs = []
+        self.receipts = {}
+        self.pending = []
+        # nonce不连续而排队的交易: {(发送地址, nonce): 交易}
+        self.queued = {}
+        # 按方法统计的RPC调用次数, 批量请求中的每个调用分别计数
+        self.calls = Counter()
+        # HTTP请求次数, 即网络往返次数
+        self.requests = 0
+        self._lock = threading.RLock()
+        self._server = None
+        self._stopped = threading.Event()
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f'http://{host}:{port}'
+
+    def start(self, port: int = 0):
+        """在后台线程中启动JSON-RPC服务, 端口为0时自动分配"""
+        chain = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                if chain.latency:
+                    time.sleep(chain.latency)
+                with chain._lock:
+                    chain.requests += 1
+                if isinstance(body, list):
+                    result = [chain.handle(request) for request in body]
+                else:
+                    result = chain.handle(body)
+                data = json.dumps(result).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        if self.block_time:
+            threading.Thread(target=self._produce_blocks, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def reset_stats(self):
+        with self._lock:
+            self.calls.clear()
+            self.requests = 0
+
+    def stats(self):
+        """返回RPC调用统计"""
+        with self._lock:
+            return {
+                'rpc_requests': self.requests,
+                'rpc_calls': sum(self.calls.values()),
+                'rpc_calls_by_method': dict(self.calls.most_common())
+            }
+
+    # 链状态操作
+
+    def fund(self, address, amount_bnb):
+        """为地址充值原生币"""
+        with self._lock:
+            self.native_balances[address.lower()] += Web3.to_wei(amount_bnb, 'ether')
+
+    def pay(self, payments, sender=None):
+        """在同一个新区块中向多个地址转入USDT, payments为[(地址, 金额)]"""
+        sender = (sender or '0x' + '11' * 20).lower()
+        with self._lock:
+            self.block_number += 1
+            for index, (address, amount) in enumerate(payments):
+                value = Web3.to_wei(amount, 'ether')
+                self.token_balances[address.lower()] += value
+                tx_hash = Web3.to_hex(Web3.keccak(text=f'payment:{self.block_number}:{index}'))
+                self._emit_transfer(sender, address.lower(), value, tx_hash, index)
+
+    def mine(self, blocks: int = 1):
+        """产生新区块, 打包待处理的交易"""
+        with self._lock:
+            for _ in range(blocks):
+                self.block_number += 1
+                pending, self.pending = self.pending, []
+                for index, tx_hash in enumerate(pending):
+                    self.receipts[tx_hash]['blockNumber'] = hex(self.block_number)
+                    self.receipts[tx_hash]['transactionIndex'] = hex(index)
+
+    def _produce_blocks(self):
+        while not self._stopped.wait(self.block_time):
+            self.mine()
+
+    def _emit_transfer(self, sender, to, value, tx_hash, log_index):
+        log = {
+            'address': TOKEN_ADDRESS,
+            'blockNumber': hex(self.block_number),
+            'blockHash': Web3.to_hex(Web3.keccak(text=f'block:{self.block_number}')),
+            'transactionHash': tx_hash,
+            'transactionIndex': hex(log_index),
+            'logIndex': hex(log_index),
+            'removed': False,
+            'topics': [
+                TRANSFER_EVENT_TOPIC,
+                '0x' + '0' * 24 + sender[2:],
+                '0x' + '0' * 24 + to[2:]
+            ],
+            'data': '0x' + '%064x' % value
+        }
+        self.logs.append(log)
+        return log
+
+    # JSON-RPC处理
+
+    def handle(self, request):
+        method = request['method']
+        params = request.get('params') or []
+        with self._lock:
+            self.calls[method] += 1
+            try:
+                handler = getattr(self, 'rpc_' + method, None)
+                if handler is None:
+                    raise RPCError(f'method {method} not supported')
+                return {'jsonrpc': '2.0', 'id': request.get('id'), 'result': handler(*params)}
+            except RPCError as e:
+                return {'jsonrpc': '2.0', 'id': request.get('id'), 'error': {'code': -32000, 'message': str(e)}}
+
+    def rpc_eth_chainId(self):
+        return hex(CHAIN_ID)
+
+    def rpc_net_version(self):
+        return str(CHAIN_ID)
+
+    def rpc_web3_clientVersion(self):
+        return 'MockChain/v1'
+
+    def rpc_eth_blockNumber(self):
+        return hex(self.block_number)
+
+    def rpc_eth_gasPrice(self):
+        return hex(GAS_PRICE)
+
+    def rpc_eth_getBalance(self, address, block='latest'):
+        return hex(self.native_balances[address.lower()])
+
+    def rpc_eth_getTransactionCount(self, address, block='latest'):
+        return hex(self.nonces[address.lower()])
+
+    def rpc_eth_estimateGas(self, tx, block='latest'):
+        data = Web3.to_bytes(hexstr=tx.get('data') or tx.get('input') or '0x')
+        return hex(TOKEN_TRANSFER_GAS if data else NATIVE_TRANSFER_GAS)
+
+    def rpc_eth_call(self, tx, block='latest'):
+        data = Web3.to_bytes(hexstr=tx.get('data') or tx.get('input') or '0x')
+        return Web3.to_hex(self._call(tx['to'], data))
+
+    def rpc_eth_getLogs(self, log_filter):
+        def topic_matches(value, topic):
+            # None匹配任意值, 列表匹配其中任意一个
+            if topic is None:
+                return True
+            candidates = topic if isinstance(topic, list) else [topic]
+            return value.lower() in [candidate.lower() for candidate in candidates]
+
+        from_block = int(log_filter.get('fromBlock', '0x0'), 16)
+        to_block = int(log_filter.get('toBlock', hex(self.block_number)), 16)
+        topics = log_filter.get('topics') or []
+        if self.max_log_blocks and to_block - from_block + 1 > self.max_log_blocks:
+            raise RPCError(f'block range is too wide, maximum is {self.max_log_blocks}')
+        return [
+            log for log in self.logs
+            if from_block <= int(log['blockNumber'], 16) <= to_block
+            and all(topic_matches(log['topics'][index], topic) for index, topic in enumerate(topics))
+        ]
+
+    def rpc_eth_getBlockByNumber(self, block, full_transactions=False):
+        number = self.block_number if block in ('latest', 'pending', 'safe', 'finalized') else int(block, 16)
+        if number > self.block_number:
+            return None
+        # 区块时间按3秒出块从当前时间倒推
+        return {
+            'number': hex(number),
+            'hash': Web3.to_hex(Web3.keccak(text=f'block:{number}')),
+            'parentHash': Web3.to_hex(Web3.keccak(text=f'block:{number - 1}')),
+            'timestamp': hex(int(time.time()) - (self.block_number - number) * 3),
+            'transactions': []
+        }
+
+    def rpc_eth_getTransactionReceipt(self, tx_hash):
+        receipt = self.receipts.get(tx_hash)
+        if receipt is None or receipt['blockNumber'] is None:
+            return None
+        return receipt
+
+    def rpc_eth_sendRawTransaction(self, raw):
+        raw = Web3.to_bytes(hexstr=raw)
+        nonce, gas_price, gas, to, value, data, _, _, _ = rlp.decode(raw)
+        tx = {
+            'hash': Web3.to_hex(Web3.keccak(raw)),
+            'from': Account.recover_transaction(raw).lower(),
+            'nonce': int.from_bytes(nonce, 'big'),
+            'gas_price': int.from_bytes(gas_price, 'big'),
+            'to': Web3.to_hex(to).lower(),
+            'value': int.from_bytes(value, 'big'),
+            'data': data
+        }
+        if tx['nonce'] < self.nonces[tx['from']]:
+            raise RPCError('nonce too low')
+        if tx['nonce'] == self.nonces[tx['from']] and self.native_balances[tx['from']] < self._cost(tx):
+            raise RPCError('insufficient funds for gas * price + value')
+
+        # 与节点交易池一样, nonce不连续的交易先排队, 等前面的交易执行后再执行
+        self.queued[(tx['from'], tx['nonce'])] = tx
+        while (tx['from'], self.nonces[tx['from']]) in self.queued:
+            self._execute(self.queued.pop((tx['from'], self.nonces[tx['from']])))
+
+        if not self.block_time:
+            self.mine()
+        return tx['hash']
+
+    def _execute(self, tx):
+        """执行交易并生成收据, 收据在出块后可查询"""
+        sender, to, value = tx['from'], tx['to'], tx['value']
+        gas_used = TOKEN_TRANSFER_GAS if tx['data'] else NATIVE_TRANSFER_GAS
+        self.nonces[sender] += 1
+        if self.native_balances[sender] < self._cost(tx):
+            # 排队期间余额已不足的交易不会上链, 只消耗nonce以免阻塞后续交易
+            return
+
+        self.native_balances[sender] -= self._cost(tx)
+        self.native_balances[to] += value
+
+        status = 1
+        logs = []
+        if tx['data']:
+            status = 0
+            data = tx['data']
+            if to == TOKEN_ADDRESS.lower() and data[:4] == TRANSFER:
+                recipient, amount = decode(['address', 'uint256'], data[4:])
+                if self.token_balances[sender] >= amount:
+                    self.token_balances[sender] -= amount
+                    self.token_balances[recipient.lower()] += amount
+                    logs.append(self._emit_transfer(sender, recipient.lower(), amount, tx['hash'], 0))
+                    status = 1
+
+        self.receipts[tx['hash']] = {
+            'transactionHash': tx['hash'],
+            'transactionIndex': '0x0',
+            'blockHash': Web3.to_hex(Web3.keccak(text=f'block:{self.block_number + 1}')),
+            'blockNumber': None,
+            'from': sender,
+            'to': to,
+            'cumulativeGasUsed': hex(gas_used),
+            'gasUsed': hex(gas_used),
+            'effectiveGasPrice': hex(tx['gas_price']),
+            'contractAddress': None,
+            'logs': logs,
+            'logsBloom': '0x' + '00' * 256,
+            'status': hex(status),
+            'type': '0x0'
+        }
+        self.pending.append(tx['hash'])
+
+    @staticmethod
+    def _cost(tx):
+        """交易消耗的原生币: 实际gas费用加转账金额"""
+        gas_used = TOKEN_TRANSFER_GAS if tx['data'] else NATIVE_TRANSFER_GAS
+        return gas_used * tx['gas_price'] + tx['value']
+
+    def _call(self, to, data):
+        """执行只读合约调用"""
+        selector, args = data[:4], data[4:]
+        if to.lower() == TOKEN_ADDRESS.lower() and selector == BALANCE_OF:
+            (owner,) = decode(['address'], args)
+            return encode(['uint256'], [self.token_balances[owner.lower()]])
+        if to.lower() == MULTICALL_ADDRESS.lower() and selector == AGGREGATE3:
+            (calls,) = decode(['(address,bool,bytes)[]'], args)
+            results = []
+            for target, allow_failure, call_data in calls:
+                try:
+                    results.append((True, self._call(target, call_data)))
+                except RPCError:
+                    if not allow_failure:
+                        raise
+                    results.append((False, b''))
+            return encode(['(bool,bytes)[]'], [results])
+        raise RPCError('execution reverted')
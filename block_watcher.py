@@ -0,0 +1,102 @@
+import asyncio
+import json
+import threading
+import websockets
+from metrics import BLOCK_WATCHER_CONNECTED, BLOCK_HEADS
+from receipt_tracker import poll_receipts
+from scheduler import check_orders
+
+
+class BlockWatcher(object):
+    """
+    区块驱动的订单检查
+    通过WebSocket订阅newHeads, 每个新区块触发一轮增量检查与收据查询
+    订阅正常时暂停调度器中的定时任务, 连接断开或长时间没有新区块时恢复定时轮询
+    """
+
+    # 由新区块触发的调度任务: (任务ID, 任务函数)
+    JOBS = (
+        ('check_orders', check_orders),
+        ('poll_receipts', poll_receipts),
+    )
+
+    def __init__(self, app, scheduler):
+        self.app = app
+        self.scheduler = scheduler
+        self.endpoint = app.config['BSC_WS_ENDPOINT']
+        self.stall_seconds = app.config.get('BLOCK_WATCHER_STALL_SECONDS', 30)
+        self.max_backoff = app.config.get('BLOCK_WATCHER_MAX_BACKOFF', 60)
+        self.last_block = None
+        self.subscribed = False
+        # 检查期间到达的多个新区块合并为下一轮检查
+        self._wakeup = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._run_checks, name='block-checks', daemon=True).start()
+        threading.Thread(target=lambda: asyncio.run(self._watch()), name='block-watcher', daemon=True).start()
+        return self
+
+    async def _watch(self):
+        """保持newHeads订阅, 断开后按指数退避重连"""
+        delay = 1
+        while True:
+            try:
+                async with websockets.connect(self.endpoint, max_size=2 ** 22) as connection:
+                    await self._subscribe(connection)
+                    delay = 1
+                    while True:
+                        message = await asyncio.wait_for(connection.recv(), self.stall_seconds)
+                        head = json.loads(message).get('params', {}).get('result')
+                        if head:
+                            self._on_head(int(head['number'], 16))
+            except asyncio.TimeoutError:
+                self.app.logger.warning(f'No new block head for {self.stall_seconds}s, reconnecting')
+            except Exception as e:
+                self.app.logger.warning(f'Block head subscription lost: {e}')
+            finally:
+                self._set_subscribed(False)
+
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_backoff)
+
+    async def _subscribe(self, connection):
+        await connection.send(json.dumps({
+            'jsonrpc': '2.0', 'id': 1, 'method': 'eth_subscribe', 'params': ['newHeads']
+        }))
+        response = json.loads(await asyncio.wait_for(connection.recv(), self.stall_seconds))
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+        self.app.logger.info(f'Subscribed to new block heads: {response.get("result")}')
+        self._set_subscribed(True)
+
+    def _on_head(self, block_number):
+        # 重连后节点可能重复推送同一区块
+        if block_number == self.last_block:
+            return
+        self.last_block = block_number
+        BLOCK_HEADS.inc()
+        self._wakeup.set()
+
+    def _set_subscribed(self, subscribed):
+        """订阅正常时暂停定时任务, 断开时恢复, 保证始终有一种方式在检查订单"""
+        if subscribed == self.subscribed:
+            return
+        self.subscribed = subscribed
+        BLOCK_WATCHER_CONNECTED.set(1 if subscribed else 0)
+        for job_id, _ in self.JOBS:
+            try:
+                if subscribed:
+                    self.scheduler.pause_job(job_id)
+                else:
+                    self.scheduler.resume_job(job_id)
+            except Exception as e:
+                self.app.logger.warning(f'Failed to toggle job {job_id}: {e}')
+        if not subscribed:
+            self.app.logger.warning('Falling back to interval polling')
+
+    def _run_checks(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            for _, func in self.JOBS:
+                func(self.app)
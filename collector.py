@@ -0,0 +1,218 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from sqlalchemy import insert, func
+from hd_wallet import get_order_private_key
+from leases import claim_collect_jobs
+from metrics import COLLECT_JOBS, COLLECT_INFLIGHT, COLLECT_STAGE
+from models import db, CollectJob, CollectStatus
+from nonce_manager import get_nonce_manager
+from receipt_tracker import receipt_tracker
+from web3_support import get_web3_support
+
+# 收据跟踪器中的交易类型
+GAS_FUNDING_TX = 'gas_funding'
+COLLECT_TX = 'collect'
+
+_executor = None
+_executor_lock = threading.Lock()
+# 正在线程池中处理的任务, 避免同一任务被重复提交
+_inflight = set()
+_inflight_lock = threading.Lock()
+
+
+def enqueue_collection(app, order, amount):
+    """创建归集任务, 随调用方的事务一起提交"""
+    if not app.config.get('BSC_COLLECT_ADDRESS'):
+        return None
+
+    job = CollectJob(order_id=order.id, amount=amount, status=CollectStatus.PENDING)
+    db.session.add(job)
+    return job
+
+
+def enqueue_collections(app, items):
+    """批量创建归集任务, items为[(订单ID, 金额)], 随调用方的事务一起提交"""
+    if not app.config.get('BSC_COLLECT_ADDRESS') or not items:
+        return
+
+    now = datetime.utcnow()
+    db.session.execute(insert(CollectJob), [
+        {
+            'order_id': order_id,
+            'amount': amount,
+            'status': CollectStatus.PENDING,
+            'attempts': 0,
+            'create_time': now,
+            'update_time': now
+        }
+        for order_id, amount in items
+    ])
+
+
+def process_collect_jobs(app):
+    """将待处理的归集任务分发到线程池"""
+    with app.app_context():
+        try:
+            observe_queue_depth()
+
+            # 已发送交易的任务由收据跟踪器推进; 待处理的任务先领取租约, 其他调度进程不会重复处理
+            token, job_ids = claim_collect_jobs(app, app.config.get('COLLECT_BATCH_SIZE', 100))
+            if not job_ids:
+                return
+
+            app.logger.info(f'Processing {len(job_ids)} collect jobs')
+
+            w3 = get_web3_support(app)
+            executor = _get_executor(app)
+            for job_id in job_ids:
+                with _inflight_lock:
+                    if job_id in _inflight:
+                        continue
+                    _inflight.add(job_id)
+                    COLLECT_INFLIGHT.set(len(_inflight))
+                executor.submit(_run_job, app, w3, job_id, token)
+
+        except Exception as e:
+            app.logger.exception(f'Error in process_collect_jobs: {e}')
+
+
+def advance_collect_job(app, w3, job):
+    """处理待归集的任务, 发送交易后不等待确认, 由收据跟踪器在交易上链后回调"""
+    order = job.order
+
+    # 检查BNB余额是否足够支付gas
+    current_bnb_balance = w3.get_bnb_balance(order.address)
+    gas_info = w3.estimate_gas(order.address, job.amount)
+    required_bnb = gas_info['safe_gas_cost_bnb']
+
+    if current_bnb_balance < required_bnb:
+        gas_tx = w3.send_bnb_for_gas(order.address, required_bnb - current_bnb_balance)
+        if not gas_tx:
+            _fail_job(app, job, 'Failed to send gas')
+            db.session.commit()
+            return
+        job.gas_tx_hash = gas_tx
+        _set_status(job, CollectStatus.GAS_FUNDING)
+        receipt_tracker.track(gas_tx, GAS_FUNDING_TX, job.id)
+        db.session.commit()
+        return
+
+    tx_hash = w3.send_usdt_transfer(order.address, get_order_private_key(app, order), job.amount, gas_info)
+    if not tx_hash:
+        _fail_job(app, job, 'Failed to send collect transaction')
+        db.session.commit()
+        return
+    job.tx_hash = tx_hash
+    _set_status(job, CollectStatus.TRANSFER_SENT)
+    receipt_tracker.track(tx_hash, COLLECT_TX, job.id)
+    db.session.commit()
+
+
+def on_gas_funded(app, job_id, tx_hash, succeeded):
+    """gas费交易完成: 成功后回到待处理状态, 重新检查余额后发送归集交易"""
+    job = db.session.get(CollectJob, job_id)
+    if job is None or job.status != CollectStatus.GAS_FUNDING or job.gas_tx_hash != tx_hash:
+        return
+
+    if succeeded:
+        _set_status(job, CollectStatus.PENDING)
+        return
+
+    # 被丢弃的交易留下nonce空缺, 之后的gas费交易都会卡在其后, 重新从节点同步
+    w3 = get_web3_support(app)
+    get_nonce_manager(w3.gas_address).resync(w3.w3)
+    if succeeded is None:
+        _fail_job(app, job, f'Gas transaction not mined: {tx_hash}')
+    else:
+        _fail_job(app, job, f'Gas transaction failed: {tx_hash}')
+
+
+def on_collect_confirmed(app, job_id, tx_hash, succeeded):
+    """归集交易完成: 更新任务与订单"""
+    job = db.session.get(CollectJob, job_id)
+    if job is None or job.status != CollectStatus.TRANSFER_SENT or job.tx_hash != tx_hash:
+        return
+
+    if succeeded is None:
+        _fail_job(app, job, f'Collect transaction not mined: {tx_hash}')
+        return
+    if not succeeded:
+        # 可能是缓存的gas用量不足, 下次重新估算
+        w3 = get_web3_support(app)
+        if w3.gas_oracle:
+            w3.gas_oracle.invalidate()
+        _fail_job(app, job, f'Collect transaction failed: {tx_hash}')
+        return
+
+    _set_status(job, CollectStatus.CONFIRMED)
+    job.order.collect_tx_hash = tx_hash
+    job.order.update_time = datetime.utcnow()
+    app.logger.info(f'Collected {job.amount} USDT from order {job.order.order_no}')
+
+
+def _set_status(job, status):
+    """进入下一个状态, 记录在上一个状态停留的时间"""
+    if job.update_time:
+        COLLECT_STAGE.labels(job.status.value).observe((datetime.utcnow() - job.update_time).total_seconds())
+    job.status = status
+    _release_lease(job)
+
+
+def _release_lease(job):
+    """状态变化后释放租约, 回到待处理状态的任务可以立即被再次领取"""
+    job.lease_owner = None
+    job.lease_expire_time = None
+
+
+def observe_queue_depth():
+    """按状态统计归集任务数量"""
+    counts = dict(db.session.query(CollectJob.status, func.count(CollectJob.id)).group_by(CollectJob.status).all())
+    for status in CollectStatus:
+        COLLECT_JOBS.labels(status.value).set(counts.get(status, 0))
+
+
+def _fail_job(app, job, error):
+    """记录失败, 未超过重试次数时重新排队, 由调用方提交"""
+    job.attempts += 1
+    job.error = error[:255]
+    if job.attempts < app.config.get('COLLECT_MAX_ATTEMPTS', 3):
+        job.status = CollectStatus.PENDING
+    else:
+        job.status = CollectStatus.FAILED
+    _release_lease(job)
+    app.logger.error(f'Collect job {job.id} for order {job.order_id} failed ({job.attempts}): {error}')
+
+
+def _run_job(app, w3, job_id, token):
+    """在工作线程中处理单个归集任务, 只处理本进程仍持有租约的任务"""
+    with app.app_context():
+        try:
+            job = db.session.get(CollectJob, job_id)
+            if job is not None and job.status == CollectStatus.PENDING and job.lease_owner == token:
+                advance_collect_job(app, w3, job)
+        except Exception as e:
+            # 交易可能已经发送, 不释放租约, 到期后再重试
+            db.session.rollback()
+            app.logger.error(f'Error processing collect job {job_id}: {e}')
+        finally:
+            db.session.remove()
+            with _inflight_lock:
+                _inflight.discard(job_id)
+                COLLECT_INFLIGHT.set(len(_inflight))
+
+
+def _get_executor(app):
+    """获取归集线程池"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=app.config.get('COLLECT_WORKERS', 4),
+                thread_name_prefix='collector'
+            )
+        return _executor
+
+
+receipt_tracker.register(GAS_FUNDING_TX, on_gas_funded)
+receipt_tracker.register(COLLECT_TX, on_collect_confirmed)
@@ -12,10 +12,111 @@ class Config:
     
     # BSC配置
     BSC_ENDPOINT = os.environ.get('BSC_ENDPOINT') or 'https://bsc-dataseed.bnbchain.org'
+    # 多个节点用逗号分隔，按延迟选择并在失败时自动切换，默认只使用BSC_ENDPOINT
+    BSC_ENDPOINTS = [e.strip() for e in (os.environ.get('BSC_ENDPOINTS') or BSC_ENDPOINT).split(',') if e.strip()]
+    RPC_POOL_SIZE = int(os.environ.get('RPC_POOL_SIZE') or 20)  # 每个节点的连接池大小
+    RPC_TIMEOUT = int(os.environ.get('RPC_TIMEOUT') or 10)  # 单次RPC请求超时（秒）
+    # WebSocket节点（可选），配置后订阅newHeads，每个新区块触发一轮订单检查，连接断开时回退到定时轮询
+    BSC_WS_ENDPOINT = os.environ.get('BSC_WS_ENDPOINT')
+    BLOCK_WATCHER_STALL_SECONDS = 30  # 超过该时间没有新区块则认为订阅失效并重连
+    BLOCK_WATCHER_MAX_BACKOFF = 60  # 重连的最大退避时间（秒）
     BSC_COLLECT_ADDRESS = os.environ.get('BSC_COLLECT_ADDRESS')
     BSC_GAS_ADDRESS = os.environ.get('BSC_GAS_ADDRESS')
     BSC_GAS_ADDRESS_PRIVATE_KEY = os.environ.get('BSC_GAS_ADDRESS_PRIVATE_KEY')
+    # HD钱包（可选）：收款地址按索引从同一个扩展私钥派生，订单只保存派生索引
+    # BSC_HD_XPRV为收款地址父节点的扩展私钥；或使用助记词，按BSC_HD_PATH（默认m/44'/60'/0'/0）派生父节点
+    BSC_HD_XPRV = os.environ.get('BSC_HD_XPRV')
+    BSC_HD_MNEMONIC = os.environ.get('BSC_HD_MNEMONIC')
+    BSC_HD_PASSPHRASE = os.environ.get('BSC_HD_PASSPHRASE')
+    BSC_HD_PATH = os.environ.get('BSC_HD_PATH')
+    HD_KEY_CACHE_SIZE = 1024  # 归集时派生私钥的缓存数量
+    # 合约地址（可选，默认使用BSC主网地址，可指向本地测试链上的合约）
+    BSC_USDT_ADDRESS = os.environ.get('BSC_USDT_ADDRESS')
+    BSC_MULTICALL_ADDRESS = os.environ.get('BSC_MULTICALL_ADDRESS')
+
+    # 收款方式: address（每个订单独立收款地址）或 amount（统一收款到BSC_COLLECT_ADDRESS，按唯一金额识别订单，无需归集）
+    PAYMENT_MODE = os.environ.get('PAYMENT_MODE') or 'address'
+    AMOUNT_DECIMALS = 6  # 支付金额的小数位数
+    AMOUNT_SUFFIX_MAX = int(os.environ.get('AMOUNT_SUFFIX_MAX') or 9999)  # 金额尾数最大值，即同一金额可同时存在的订单数
+    AMOUNT_HOLD_SECONDS = 3600  # 订单过期后金额继续保留的时间（秒），避免迟到的付款匹配到新订单
+
+    # 支付检测方式: balance（批量轮询余额）、async（并发轮询余额）或 logs（扫描Transfer事件）
+    DETECTION_MODE = os.environ.get('DETECTION_MODE') or 'balance'
+    # async模式下同时进行的余额查询数量
+    CHECK_CONCURRENCY = int(os.environ.get('CHECK_CONCURRENCY') or 20)
+    # 扫描事件时的确认区块数，只处理已确认的区块，并在链回滚时回退游标
+    CONFIRMATION_BLOCKS = int(os.environ.get('CONFIRMATION_BLOCKS') or 15)
+    # 单次eth_getLogs请求的最大区块跨度，节点拒绝时自动缩小
+    LOG_SCAN_MAX_BLOCKS = int(os.environ.get('LOG_SCAN_MAX_BLOCKS') or 1000)
+    # 按收款地址过滤事件的最大地址数量，未支付订单的地址更多时获取全部USDT转账
+    LOG_SCAN_MAX_ADDRESSES = int(os.environ.get('LOG_SCAN_MAX_ADDRESSES') or 1000)
+    # 支付通知（可选）：订单支付后向这些地址POST事件（逗号分隔），失败后按指数退避重试
+    WEBHOOK_URLS = [u.strip() for u in (os.environ.get('WEBHOOK_URLS') or '').split(',') if u.strip()]
+    WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')  # 配置后请求带X-Signature头（请求体的HMAC-SHA256）
+    WEBHOOK_TIMEOUT = 10  # 单次投递超时（秒）
+    WEBHOOK_POOL_SIZE = 100  # 连接池大小，即同时进行的投递请求上限
+    WEBHOOK_CONCURRENCY_PER_DESTINATION = 4  # 每个地址同时进行的投递请求数
+    WEBHOOK_BATCH_SIZE = 50  # 同一地址的通知合并为一个请求的最大数量
+    WEBHOOK_MAX_ATTEMPTS = 10  # 超过后不再重试
+    WEBHOOK_BACKOFF_BASE = 5  # 首次重试间隔（秒），之后每次翻倍
+    WEBHOOK_BACKOFF_MAX = 3600  # 最大重试间隔（秒）
+    WEBHOOK_POLL_SECONDS = 5  # 检查到期通知的间隔，新通知提交后会立即投递
+    WEBHOOK_LEASE_SECONDS = 120  # 领取通知的租约时长，进程退出后由其他进程重新投递
+    # 批量创建订单：每次请求的最大订单数，生成地址与二维码的进程数（默认CPU核数）与每个任务的数量
+    ORDER_BATCH_MAX = 1000
+    ORDER_BATCH_WORKERS = int(os.environ.get('ORDER_BATCH_WORKERS') or 0) or None
+    ORDER_BATCH_CHUNK_SIZE = 50
+    # 订单管理接口：列表每页最大数量与导出时每次从数据库读取的行数
+    ADMIN_ORDERS_MAX_LIMIT = 500
+    ADMIN_EXPORT_CHUNK_SIZE = 1000
+    # 历史对账（flask reconcile）：并发线程数与每个线程一次处理的区块数
+    RECONCILE_WORKERS = int(os.environ.get('RECONCILE_WORKERS') or 8)
+    RECONCILE_CHUNK_BLOCKS = int(os.environ.get('RECONCILE_CHUNK_BLOCKS') or 5000)
+    # run-scheduler进程的Prometheus指标端口，设为0不开放；配置PROMETHEUS_MULTIPROC_DIR时由Web进程的/metrics合并，不单独开放
+    SCHEDULER_METRICS_PORT = int(os.environ.get('SCHEDULER_METRICS_PORT') or 9108)
+
+    # 每次Multicall3聚合的balanceOf调用数量
+    MULTICALL_CHUNK_SIZE = int(os.environ.get('MULTICALL_CHUNK_SIZE') or 500)
     
+    # 自适应检查调度：按订单年龄（秒）决定检查间隔（秒），页面打开中的订单频繁检查
+    POLL_SCHEDULE = [
+        (120, 5),  # 2分钟内的新订单每5秒检查一次
+        (600, 15),
+        (1800, 30),
+    ]
+    POLL_MAX_INTERVAL = 120  # 更旧订单的检查间隔
+    POLL_WATCHED_INTERVAL = 5  # 页面打开中的订单的检查间隔
+    POLL_WATCH_WINDOW = 60  # 页面最近一次访问后视为仍在打开的时间
+
+    # 多进程检查订单的租约配置
+    ORDER_LEASE_SECONDS = 25  # 租约时长（秒），处理期间自动续约，进程退出后自然过期
+    ORDER_LEASE_BATCH_SIZE = int(os.environ.get('ORDER_LEASE_BATCH_SIZE') or 1000)  # 每次领取的订单数量
+
+    # 归集任务配置
+    COLLECT_WORKERS = int(os.environ.get('COLLECT_WORKERS') or 4)  # 归集线程数
+    COLLECT_BATCH_SIZE = 100  # 每轮分发的最大任务数
+    COLLECT_MAX_ATTEMPTS = 3  # 最大重试次数
+    COLLECT_LEASE_SECONDS = 300  # 领取归集任务的租约时长（秒），多个进程不会重复处理同一任务
+
+    # 交易收据跟踪配置
+    RECEIPT_BATCH_SIZE = 500  # 每个JSON-RPC批量请求查询的收据数量
+    RECEIPT_TIMEOUT = 600  # 交易未上链的超时时间（秒）
+
+    # Gas缓存配置
+    GAS_PRICE_TTL = int(os.environ.get('GAS_PRICE_TTL') or 15)  # gas价格缓存时间（秒）
+    GAS_LIMIT_TTL = int(os.environ.get('GAS_LIMIT_TTL') or 600)  # transfer gas用量缓存时间（秒）
+
+    # 地址池配置
+    ADDRESS_POOL_LOW = int(os.environ.get('ADDRESS_POOL_LOW') or 100)  # 低于此数量时开始补充
+    ADDRESS_POOL_HIGH = int(os.environ.get('ADDRESS_POOL_HIGH') or 500)  # 补充到此数量
+    ADDRESS_POOL_BATCH_SIZE = 50  # 每次提交的地址数量
+
+    # 订单状态推送配置
+    ORDER_WAIT_MAX_SECONDS = 30  # 长轮询与单个SSE连接的最长等待时间（秒）
+    ORDER_EVENTS_HEARTBEAT = 15  # SSE心跳间隔（秒）
+    ORDER_EVENTS_RETRY_MS = 1000  # SSE连接关闭后浏览器重连的等待时间（毫秒）
+    ORDER_EVENTS_POLL_SECONDS = 1  # 有等待中的页面时查询订单状态的间隔（秒），状态可能由独立的调度器进程更新
+
     # 调度器配置
     SCHEDULER_API_ENABLED = True
     JOBS = [
@@ -23,7 +124,28 @@ class Config:
             'id': 'check_orders',
             'func': 'scheduler:check_orders',
             'trigger': 'interval',
-            'seconds': 30,  # 每30秒检查一次
-            'args': (None,)  # 将在运行时替换为app实例
+            'seconds': 5,  # 每5秒检查一次已到检查时间的订单
+            'args': (None,)  # 启动调度器时替换为app实例
+        },
+        {
+            'id': 'process_collect_jobs',
+            'func': 'collector:process_collect_jobs',
+            'trigger': 'interval',
+            'seconds': 10,  # 每10秒推进一次归集任务
+            'args': (None,)
+        },
+        {
+            'id': 'poll_receipts',
+            'func': 'receipt_tracker:poll_receipts',
+            'trigger': 'interval',
+            'seconds': 3,  # BSC约3秒一个区块, 每个新区块批量查询一次收据
+            'args': (None,)
+        },
+        {
+            'id': 'refill_address_pool',
+            'func': 'address_pool:refill_address_pool',
+            'trigger': 'interval',
+            'seconds': 15,  # 每15秒检查一次地址池水位
+            'args': (None,)
         }
     ]
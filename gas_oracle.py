@@ -0,0 +1,70 @@
+import threading
+import time
+
+
+class GasOracle(object):
+    """缓存gas价格与各类调用的gas用量, 减少每次归集的RPC请求"""
+
+    def __init__(self, price_ttl=15, limit_ttl=600):
+        self.price_ttl = price_ttl  # gas价格缓存时间（秒）
+        self.limit_ttl = limit_ttl  # gas用量缓存时间（秒）
+        self._lock = threading.Lock()
+        self._gas_price = None
+        self._gas_price_time = 0
+        self._gas_limits = {}
+        self.stats = {
+            'price_hits': 0,
+            'price_misses': 0,
+            'limit_hits': 0,
+            'limit_misses': 0
+        }
+
+    def get_gas_price(self, w3):
+        """获取gas价格, 缓存过期时从节点刷新"""
+        with self._lock:
+            if self._gas_price is not None and time.monotonic() - self._gas_price_time < self.price_ttl:
+                self.stats['price_hits'] += 1
+                return self._gas_price
+            self.stats['price_misses'] += 1
+
+        gas_price = w3.eth.gas_price
+        with self._lock:
+            self._gas_price = gas_price
+            self._gas_price_time = time.monotonic()
+        return gas_price
+
+    def get_gas_limit(self, key, estimate):
+        """按调用形态缓存gas用量, key如('transfer', 归集地址), estimate为实际估算函数"""
+        with self._lock:
+            cached = self._gas_limits.get(key)
+            if cached is not None and time.monotonic() - cached[1] < self.limit_ttl:
+                self.stats['limit_hits'] += 1
+                return cached[0]
+            self.stats['limit_misses'] += 1
+
+        gas_limit = estimate()
+        with self._lock:
+            self._gas_limits[key] = (gas_limit, time.monotonic())
+        return gas_limit
+
+    def invalidate(self):
+        """清空缓存, 例如交易因gas不足失败后"""
+        with self._lock:
+            self._gas_price = None
+            self._gas_limits.clear()
+
+
+_oracle = None
+_oracle_lock = threading.Lock()
+
+
+def get_gas_oracle(app):
+    """获取进程内共享的GasOracle"""
+    global _oracle
+    with _oracle_lock:
+        if _oracle is None:
+            _oracle = GasOracle(
+                price_ttl=app.config.get('GAS_PRICE_TTL', 15),
+                limit_ttl=app.config.get('GAS_LIMIT_TTL', 600)
+            )
+        return _oracle
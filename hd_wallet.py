@@ -0,0 +1,145 @@
+import hashlib
+import threading
+from functools import lru_cache
+from eth_account import Account
+from eth_account.hdaccount import seed_from_mnemonic
+from eth_account.hdaccount.deterministic import (
+    Node, SoftNode, SECP256K1_N, derive_child_key, ec_point, hmac_sha512, to_int
+)
+from sqlalchemy import insert, select, update
+from sqlalchemy.exc import IntegrityError
+from models import db, DerivationCounter
+
+# BIP-44以太坊收款地址的父路径, 收款地址为其下的第index个子节点
+DEFAULT_BASE_PATH = "m/44'/60'/0'/0"
+BASE58_ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+
+
+class HDWallet(object):
+    """
+    BIP-32/44分层确定性钱包
+    所有收款地址由同一个扩展私钥按索引派生, 订单只保存派生索引, 私钥在归集时再派生并缓存
+    """
+
+    def __init__(self, chain_code: bytes, key: bytes, cache_size: int = 1024):
+        # 收款地址父节点的扩展私钥, 父节点公钥只计算一次
+        self._chain_code = chain_code
+        self._key = key
+        self._key_int = to_int(key)
+        self._point = ec_point(key)
+        self._account = lru_cache(maxsize=cache_size)(self._derive_account)
+
+    def __reduce__(self):
+        # 可传递给工作进程批量派生, 缓存不随之传递
+        return HDWallet, (self._chain_code, self._key, self._account.cache_info().maxsize)
+
+    @classmethod
+    def from_mnemonic(cls, mnemonic, passphrase='', base_path=DEFAULT_BASE_PATH, cache_size=1024):
+        """从助记词派生到收款地址的父节点"""
+        master = hmac_sha512(b'Bitcoin seed', seed_from_mnemonic(mnemonic, passphrase))
+        key, chain_code = master[:32], master[32:]
+        for node in base_path.split('/')[1:]:
+            key, chain_code = derive_child_key(key, chain_code, Node.decode(node))
+        return cls(chain_code, key, cache_size)
+
+    @classmethod
+    def from_xprv(cls, xprv, cache_size=1024):
+        """从收款地址父节点的扩展私钥(xprv)创建"""
+        number = 0
+        for char in xprv:
+            number = number * 58 + BASE58_ALPHABET.index(char)
+        raw = number.to_bytes(82, 'big')
+        payload, checksum = raw[:-4], raw[-4:]
+        if hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4] != checksum or payload[45] != 0:
+            raise ValueError('Invalid extended private key')
+        return cls(payload[13:45], payload[46:78], cache_size)
+
+    def _derive_key(self, index):
+        """派生第index个子节点的私钥"""
+        node = SoftNode(index)
+        digest = hmac_sha512(self._chain_code, self._point + node.serialize())
+        tweak = to_int(digest[:32])
+        key = (tweak + self._key_int) % SECP256K1_N
+        if tweak >= SECP256K1_N or key == 0:
+            # 无效子节点的概率低于2^-127, 按BIP-32跳到下一个节点
+            return '0x' + derive_child_key(self._key, self._chain_code, node)[0].hex()
+        return '0x' + key.to_bytes(32, 'big').hex()
+
+    def _derive_account(self, index):
+        private_key = self._derive_key(index)
+        return Account.from_key(private_key).address, private_key
+
+    def derive(self, index):
+        """派生第index个收款地址"""
+        return self._account(index)[0]
+
+    def private_key(self, index):
+        """派生第index个收款地址的私钥, 归集时使用, 结果由LRU缓存"""
+        return self._account(index)[1]
+
+    def derive_range(self, start, count):
+        """批量派生连续索引的收款地址, 返回 [(索引, 地址)]"""
+        # 批量预生成的私钥之后很少再用到, 不写入缓存
+        return [
+            (index, Account.from_key(self._derive_key(index)).address)
+            for index in range(start, start + count)
+        ]
+
+
+_wallet = None
+_wallet_lock = threading.Lock()
+
+
+def get_hd_wallet(app):
+    """获取进程内共享的HD钱包, 未配置时返回None"""
+    global _wallet
+    with _wallet_lock:
+        if _wallet is None:
+            cache_size = app.config.get('HD_KEY_CACHE_SIZE', 1024)
+            if app.config.get('BSC_HD_XPRV'):
+                _wallet = HDWallet.from_xprv(app.config['BSC_HD_XPRV'], cache_size)
+            elif app.config.get('BSC_HD_MNEMONIC'):
+                _wallet = HDWallet.from_mnemonic(
+                    app.config['BSC_HD_MNEMONIC'],
+                    app.config.get('BSC_HD_PASSPHRASE') or '',
+                    app.config.get('BSC_HD_PATH') or DEFAULT_BASE_PATH,
+                    cache_size
+                )
+        return _wallet
+
+
+def reserve_indexes(count, name='deposit'):
+    """以独立的短事务预留一段连续的派生索引, 返回起始索引, 多进程之间不会重复"""
+    for _ in range(3):
+        try:
+            with db.engine.begin() as connection:
+                # UPDATE锁住计数器行直到提交, 读到的是本事务更新后的值
+                result = connection.execute(
+                    update(DerivationCounter).where(DerivationCounter.name == name).values(
+                        next_index=DerivationCounter.next_index + count
+                    )
+                )
+                if result.rowcount == 0:
+                    connection.execute(insert(DerivationCounter).values(name=name, next_index=count))
+                    return 0
+                return connection.execute(
+                    select(DerivationCounter.next_index).where(DerivationCounter.name == name)
+                ).scalar_one() - count
+        except IntegrityError:
+            # 首次使用时其他进程同时创建了计数器, 重试即可
+            continue
+    raise RuntimeError(f'Failed to reserve derivation indexes for {name}')
+
+
+def get_order_private_key(app, order):
+    """获取订单收款地址的私钥, HD钱包派生的地址按索引派生"""
+    if order.derivation_index is None:
+        return order.private_key
+
+    wallet = get_hd_wallet(app)
+    if wallet is None:
+        raise RuntimeError(f'HD wallet not configured for order {order.order_no}')
+    # 配置的扩展私钥变化时派生出的地址不同, 不能用于签名
+    if wallet.derive(order.derivation_index) != order.address:
+        raise RuntimeError(f'Derived address mismatch for order {order.order_no}')
+    return wallet.private_key(order.derivation_index)
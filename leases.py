@@ -0,0 +1,150 @@
+import os
+import socket
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from sqlalchemy import select, update, or_
+from models import db, Order, OrderStatus, ScanCursor, CollectJob, CollectStatus
+
+# 当前进程的标识
+WORKER_ID = f'{socket.gethostname()}:{os.getpid()}'
+
+
+def claim_orders(app, since, batch_size):
+    """
+    领取一批已到检查时间且未被其他进程租用的未支付订单
+    PostgreSQL等数据库使用 SELECT ... FOR UPDATE SKIP LOCKED, SQLite依赖写锁串行执行UPDATE
+    :return: (租约标识, 订单列表)
+    """
+    now = datetime.utcnow()
+    lease_expire_time = now + timedelta(seconds=app.config.get('ORDER_LEASE_SECONDS', 25))
+    # 每批使用独立的标识, 续约与查询只作用于这一批
+    token = f'{WORKER_ID}:{uuid.uuid4().hex[:8]}'
+
+    claimable = select(Order.id).where(
+        Order.status == OrderStatus.UNPAID,
+        Order.create_time >= since,
+        or_(Order.next_check_at.is_(None), Order.next_check_at <= now),
+        or_(Order.lease_expire_time.is_(None), Order.lease_expire_time < now)
+    ).order_by(Order.next_check_at, Order.id).limit(batch_size)
+
+    if db.engine.dialect.name == 'sqlite':
+        ids = claimable.scalar_subquery()
+    else:
+        ids = db.session.execute(claimable.with_for_update(skip_locked=True)).scalars().all()
+        if not ids:
+            db.session.commit()
+            return token, []
+
+    db.session.execute(
+        update(Order).where(Order.id.in_(ids)).values(
+            lease_owner=token,
+            lease_expire_time=lease_expire_time,
+            update_time=Order.update_time  # 租约不算订单更新
+        ),
+        execution_options={'synchronize_session': False}
+    )
+    db.session.commit()
+
+    orders = Order.query.filter(Order.lease_owner == token).order_by(Order.id).all()
+    return token, orders
+
+
+def claim_collect_jobs(app, batch_size):
+    """
+    领取一批待处理且未被其他进程租用的归集任务, 多个调度进程不会为同一任务重复发送交易
+    :return: (租约标识, 任务ID列表)
+    """
+    now = datetime.utcnow()
+    token = f'{WORKER_ID}:{uuid.uuid4().hex[:8]}'
+
+    claimable = select(CollectJob.id).where(
+        CollectJob.status == CollectStatus.PENDING,
+        or_(CollectJob.lease_expire_time.is_(None), CollectJob.lease_expire_time < now)
+    ).order_by(CollectJob.id).limit(batch_size)
+
+    if db.engine.dialect.name == 'sqlite':
+        ids = claimable.scalar_subquery()
+    else:
+        ids = db.session.execute(claimable.with_for_update(skip_locked=True)).scalars().all()
+        if not ids:
+            db.session.commit()
+            return token, []
+
+    db.session.execute(
+        update(CollectJob).where(CollectJob.id.in_(ids)).values(
+            lease_owner=token,
+            lease_expire_time=now + timedelta(seconds=app.config.get('COLLECT_LEASE_SECONDS', 300)),
+            update_time=CollectJob.update_time  # 租约不算任务状态变化
+        ),
+        execution_options={'synchronize_session': False}
+    )
+    db.session.commit()
+
+    job_ids = db.session.execute(
+        select(CollectJob.id).where(CollectJob.lease_owner == token).order_by(CollectJob.id)
+    ).scalars().all()
+    return token, job_ids
+
+
+@contextmanager
+def renew_lease(app, token):
+    """处理期间在后台线程中定期续约, 进程退出后租约自然过期"""
+    lease_seconds = app.config.get('ORDER_LEASE_SECONDS', 25)
+    stopped = threading.Event()
+
+    def renew():
+        while not stopped.wait(lease_seconds / 3):
+            try:
+                with app.app_context(), db.engine.begin() as connection:
+                    connection.execute(
+                        update(Order).where(Order.lease_owner == token).values(
+                            lease_expire_time=datetime.utcnow() + timedelta(seconds=lease_seconds),
+                            update_time=Order.update_time
+                        )
+                    )
+            except Exception as e:
+                app.logger.error(f'Failed to renew lease {token}: {e}')
+
+    thread = threading.Thread(target=renew, name='lease-renewer', daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def claim_cursor(app, cursor):
+    """领取扫描游标的租约, 保证同一时间只有一个进程扫描; 已持有时续约"""
+    now = datetime.utcnow()
+    result = db.session.execute(
+        update(ScanCursor).where(
+            ScanCursor.id == cursor.id,
+            or_(
+                ScanCursor.lease_expire_time.is_(None),
+                ScanCursor.lease_expire_time < now,
+                ScanCursor.lease_owner == WORKER_ID
+            )
+        ).values(
+            lease_owner=WORKER_ID,
+            lease_expire_time=now + timedelta(seconds=app.config.get('ORDER_LEASE_SECONDS', 25))
+        ),
+        execution_options={'synchronize_session': False}
+    )
+    db.session.commit()
+    db.session.refresh(cursor)
+    return result.rowcount == 1
+
+
+def release_cursor(cursor):
+    """释放扫描游标的租约"""
+    db.session.execute(
+        update(ScanCursor).where(
+            ScanCursor.id == cursor.id,
+            ScanCursor.lease_owner == WORKER_ID
+        ).values(lease_owner=None, lease_expire_time=None),
+        execution_options={'synchronize_session': False}
+    )
+    db.session.commit()
@@ -0,0 +1,32 @@
+import threading
+
+
+class AdaptiveSpan(object):
+    """
+    eth_getLogs的区块跨度
+    节点拒绝过宽的范围(或结果过多)时缩小, 成功时扩大, 在成功过的最大跨度与被拒绝过的最小跨度之间二分, 收敛到节点的限制
+    """
+
+    def __init__(self, span, max_span):
+        self.size = max(1, min(span, max_span))
+        self.max_span = max_span
+        self._good_span = 0
+        self._bad_span = None
+        self._lock = threading.Lock()
+
+    def resize(self, size, succeeded):
+        """根据一次请求的结果调整跨度"""
+        with self._lock:
+            if succeeded:
+                if size < self.size:
+                    # 末尾的较短请求不说明更大的跨度是否可行
+                    return
+                self._good_span = max(self._good_span, size)
+                span = size * 2 if self._bad_span is None else (size + self._bad_span) // 2
+            else:
+                if self._good_span >= size:
+                    # 节点的限制变小了(如负载升高), 重新探测
+                    self._good_span = 0
+                self._bad_span = size if self._bad_span is None else min(self._bad_span, size)
+                span = max(self._good_span, size // 2)
+            self.size = max(1, min(span, self.max_span))
@@ -0,0 +1,104 @@
+import os
+from urllib.parse import urlsplit
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess,
+    start_http_server
+)
+
+# RPC请求耗时, 按JSON-RPC方法与节点区分
+RPC_LATENCY = Histogram(
+    'usdt_rpc_request_seconds', 'JSON-RPC request latency', ['method', 'endpoint'],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+RPC_ERRORS = Counter('usdt_rpc_errors_total', 'Failed JSON-RPC requests', ['method', 'endpoint'])
+
+# 订单检查
+SWEEP_DURATION = Histogram(
+    'usdt_sweep_duration_seconds', 'Duration of one check_orders sweep', ['mode'],
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+)
+SWEEP_ORDERS = Histogram(
+    'usdt_sweep_orders', 'Orders checked per sweep', ['mode'],
+    buckets=(0, 10, 50, 100, 500, 1000, 5000, 10000, 50000)
+)
+ORDERS_CHECKED = Counter('usdt_orders_checked_total', 'Orders checked', ['mode'])
+
+# 订单生命周期
+ORDER_TRANSITIONS = Counter('usdt_orders_total', 'Orders created, paid or expired', ['status'])
+DETECTION_LATENCY = Histogram(
+    'usdt_payment_detection_seconds', 'Time from the payment block to the order being marked paid', ['mode'],
+    buckets=(5, 10, 20, 30, 60, 120, 300, 600, 1800)
+)
+
+# 归集任务
+COLLECT_STAGE = Histogram(
+    'usdt_collect_stage_seconds', 'Time a collect job spent in a stage', ['stage'],
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800)
+)
+COLLECT_JOBS = Gauge('usdt_collect_jobs', 'Collect jobs by status', ['status'], multiprocess_mode='max')
+COLLECT_INFLIGHT = Gauge('usdt_collect_jobs_inflight', 'Collect jobs being processed', multiprocess_mode='livesum')
+PENDING_TRANSACTIONS = Gauge('usdt_pending_transactions', 'Sent transactions waiting for a receipt', multiprocess_mode='max')
+
+# 订单事件通知
+WEBHOOK_LATENCY = Histogram(
+    'usdt_webhook_request_seconds', 'Webhook delivery request latency', ['endpoint'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+NOTIFICATIONS = Counter('usdt_notifications_total', 'Notification delivery results', ['result'])
+
+# 地址池, 领取与补充分别发生在Web进程与调度器进程中
+ADDRESS_POOL_CLAIMS = Counter(
+    'usdt_address_pool_claims_total', 'Deposit address requests served from the pool (hit) or not (miss)', ['result']
+)
+ADDRESS_POOL_REFILLED = Counter('usdt_address_pool_refilled_total', 'Deposit addresses added to the pool')
+ADDRESS_POOL_LAST_REFILL = Gauge(
+    'usdt_address_pool_last_refill_timestamp_seconds', 'Time of the last pool refill', multiprocess_mode='max'
+)
+
+# 新区块订阅
+BLOCK_WATCHER_CONNECTED = Gauge('usdt_block_watcher_connected', 'Whether the newHeads subscription is active', multiprocess_mode='max')
+BLOCK_HEADS = Counter('usdt_block_heads_total', 'New block heads received over WebSocket')
+
+
+def endpoint_label(uri):
+    """节点标签只保留主机与端口, 避免把URL中的API Key暴露在指标中"""
+    parts = urlsplit(uri)
+    return parts.hostname + (f':{parts.port}' if parts.port else '') if parts.hostname else uri
+
+
+def observe_rpc(method, endpoint, seconds, error=False):
+    """记录一次RPC请求"""
+    endpoint = endpoint_label(endpoint)
+    RPC_LATENCY.labels(method, endpoint).observe(seconds)
+    if error:
+        RPC_ERRORS.labels(method, endpoint).inc()
+
+
+def observe_sweep(mode, seconds, orders):
+    """记录一轮订单检查"""
+    SWEEP_DURATION.labels(mode).observe(seconds)
+    SWEEP_ORDERS.labels(mode).observe(orders)
+    ORDERS_CHECKED.labels(mode).inc(orders)
+
+
+def render_metrics():
+    """生成Prometheus文本格式, 多进程部署时合并各进程的指标"""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def start_metrics_server(port):
+    """
+    在没有Web服务的进程(如run-scheduler)中开放指标端口
+    配置了PROMETHEUS_MULTIPROC_DIR时各进程的指标已由Web进程的/metrics合并, 不再单独开放
+    :return: 是否开放了端口
+    """
+    if not port or os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        return False
+    start_http_server(port)
+    return True
@@ -0,0 +1,84 @@
+from sqlalchemy import inspect
+from sqlalchemy.schema import CreateColumn
+
+from models import db, Order
+
+
+def upgrade_schema():
+    """
+    创建缺少的表并把旧版本的orders表升级到当前结构
+    db.create_all不修改已有的表, 旧版本的orders表需要:
+    删除qr_code列(二维码改存qr_codes表), private_key允许为空, address不再唯一(由部分唯一索引约束),
+    增加调度、租约、统一收款金额与HD钱包派生索引的列及索引
+    :return: 执行的升级步骤说明
+    """
+    db.create_all()
+
+    inspector = inspect(db.engine)
+    columns = {column['name']: column for column in inspector.get_columns('orders')}
+    address_uniques = [
+        constraint['name'] for constraint in inspector.get_unique_constraints('orders')
+        if constraint['column_names'] == ['address']
+    ]
+    legacy = 'qr_code' in columns or not columns['private_key']['nullable'] or address_uniques
+    missing_columns = [column for column in Order.__table__.columns if column.name not in columns]
+    index_names = {index['name'] for index in inspector.get_indexes('orders')}
+    missing_indexes = [index for index in Order.__table__.indexes if index.name not in index_names]
+    if not (legacy or missing_columns or missing_indexes):
+        return []
+
+    if db.engine.dialect.name == 'sqlite':
+        return _rebuild_sqlite_orders(columns)
+    return _alter_orders(columns, address_uniques, missing_columns, missing_indexes)
+
+
+def _rebuild_sqlite_orders(columns):
+    """SQLite不能修改列的约束, 按官方步骤建新表、复制数据后删除旧表, 全部在一个事务中完成"""
+    copied = ', '.join(column.name for column in Order.__table__.columns if column.name in columns)
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        # 改名时不修改其他表中指向orders的外键, 新表建好后这些外键指向新表
+        conn.exec_driver_sql('PRAGMA legacy_alter_table=ON')
+        conn.exec_driver_sql('BEGIN')
+        try:
+            # 新表的索引与旧表同名, 先删除旧表的索引
+            for index in inspect(conn).get_indexes('orders'):
+                conn.exec_driver_sql(f'DROP INDEX "{index["name"]}"')
+            conn.exec_driver_sql('ALTER TABLE orders RENAME TO orders_old')
+            Order.__table__.create(conn)
+            conn.exec_driver_sql(f'INSERT INTO orders ({copied}) SELECT {copied} FROM orders_old')
+            conn.exec_driver_sql('DROP TABLE orders_old')
+            conn.exec_driver_sql('COMMIT')
+        except Exception:
+            conn.exec_driver_sql('ROLLBACK')
+            raise
+        finally:
+            conn.exec_driver_sql('PRAGMA legacy_alter_table=OFF')
+    return ['Rebuilt table orders with the current columns, constraints and indexes']
+
+
+def _alter_orders(columns, address_uniques, missing_columns, missing_indexes):
+    """其他数据库逐项修改orders表"""
+    mysql = db.engine.dialect.name in ('mysql', 'mariadb')
+    steps = []
+    with db.engine.begin() as conn:
+        if 'qr_code' in columns:
+            steps.append('ALTER TABLE orders DROP COLUMN qr_code')
+        if not columns['private_key']['nullable']:
+            steps.append(
+                'ALTER TABLE orders MODIFY private_key VARCHAR(66) NULL' if mysql
+                else 'ALTER TABLE orders ALTER COLUMN private_key DROP NOT NULL'
+            )
+        for name in address_uniques:
+            steps.append(f'ALTER TABLE orders DROP INDEX {name}' if mysql else f'ALTER TABLE orders DROP CONSTRAINT {name}')
+        for column in missing_columns:
+            ddl = str(CreateColumn(column).compile(dialect=db.engine.dialect))
+            steps.append(f'ALTER TABLE orders ADD COLUMN {ddl}{" UNIQUE" if column.unique else ""}')
+        for statement in steps:
+            conn.exec_driver_sql(statement)
+
+        for index in missing_indexes:
+            # 部分唯一索引只在支持的数据库上创建
+            index.create(conn)
+        created = {index['name'] for index in inspect(conn).get_indexes('orders')}
+        steps += [f'CREATE INDEX {index.name}' for index in missing_indexes if index.name in created]
+    return steps
@@ -11,9 +11,35 @@ class OrderStatus(Enum):
     EXPIRED = 'expired'
 
 
+class CollectStatus(Enum):
+    PENDING = 'pending'  # 等待处理
+    GAS_FUNDING = 'gas_funding'  # 已发送gas费, 等待到账
+    TRANSFER_SENT = 'transfer_sent'  # 已发送USDT归集交易, 等待确认
+    CONFIRMED = 'confirmed'  # 归集完成
+    FAILED = 'failed'  # 超过重试次数
+
+
+class NotificationStatus(Enum):
+    PENDING = 'pending'  # 等待投递或重试
+    DELIVERED = 'delivered'  # 已投递
+    FAILED = 'failed'  # 超过重试次数
+
 class Order(db.Model):
     """订单数据模型"""
     __tablename__ = 'orders'
+    __table_args__ = (
+        # 批量标记过期订单
+        db.Index('ix_orders_status_expire_time', 'status', 'expire_time'),
+        # 订单列表按(创建时间, ID)分页
+        db.Index('ix_orders_create_time_id', 'create_time', 'id'),
+        # 独立收款地址不能重复, 统一收款地址模式的订单(有支付金额)共用归集地址
+        # 只在支持部分索引的数据库上创建, 其他数据库会忽略条件, 变成对所有订单的唯一约束
+        db.Index(
+            'ux_orders_deposit_address', 'address', unique=True,
+            sqlite_where=db.text('pay_amount IS NULL'),
+            postgresql_where=db.text('pay_amount IS NULL')
+        ).ddl_if(dialect=('sqlite', 'postgresql')),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     order_no = db.Column(db.String(64), unique=True, nullable=False, index=True)
@@ -21,9 +47,10 @@ class Order(db.Model):
     status = db.Column(db.Enum(OrderStatus), default=OrderStatus.UNPAID, nullable=False, index=True)
 
     # BSC相关字段
-    address = db.Column(db.String(42), nullable=False, unique=True)  # 收款地址
-    private_key = db.Column(db.String(66), nullable=False)  # 地址私钥（加密存储）
-    qr_code = db.Column(db.Text, nullable=False)  # Base64编码的二维码图片
+    address = db.Column(db.String(42), nullable=False, index=True)  # 收款地址, 统一收款地址模式下所有订单相同
+    private_key = db.Column(db.String(66))  # 地址私钥（加密存储）, 统一收款地址模式或HD钱包派生的地址为空
+    derivation_index = db.Column(db.Integer, unique=True)  # HD钱包派生索引, 私钥在归集时派生
+    pay_amount = db.Column(db.Float)  # 统一收款地址模式下需要支付的准确金额（含尾数）
 
     # 支付信息
     tx_hash = db.Column(db.String(66))  # 支付交易哈希
@@ -36,6 +63,14 @@ class Order(db.Model):
     expire_time = db.Column(db.DateTime, nullable=False)
     paid_time = db.Column(db.DateTime)  # 支付时间
 
+    # 自适应检查调度
+    next_check_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)  # 下次检查时间
+    watch_time = db.Column(db.DateTime)  # 最近一次打开订单页面的时间
+
+    # 多进程检查订单时的租约
+    lease_owner = db.Column(db.String(64))  # 持有租约的进程与批次
+    lease_expire_time = db.Column(db.DateTime, index=True)  # 租约过期时间
+
     def __repr__(self):
         return f'<Order {self.order_no}: {self.amount} USDT - {self.status.value}>'
 
@@ -45,13 +80,182 @@ class Order(db.Model):
             'id': self.id,
             'order_no': self.order_no,
             'amount': self.amount,
+            'pay_amount': self.pay_amount,
             'status': self.status.value,
             'address': self.address,
-            'qr_code': self.qr_code,
             'tx_hash': self.tx_hash,
             'paid_amount': self.paid_amount,
             'create_time': self.create_time.isoformat() if self.create_time else None,
             'update_time': self.update_time.isoformat() if self.update_time else None,
             'expire_time': self.expire_time.isoformat() if self.expire_time else None,
             'paid_time': self.paid_time.isoformat() if self.paid_time else None
-        }
\ No newline at end of file
+        }
+
+
+class Payment(db.Model):
+    """订单收到的USDT转账, 记录哪笔转账支付了哪个订单"""
+    __tablename__ = 'payments'
+    __table_args__ = (
+        # 同一笔转账只记录一次, 实时扫描与对账可以重复处理同一区块
+        db.UniqueConstraint('tx_hash', 'log_index', name='uq_payments_tx_log'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer, db.ForeignKey('orders.id'), nullable=False, index=True)
+    tx_hash = db.Column(db.String(66), nullable=False)
+    log_index = db.Column(db.Integer, nullable=False)
+    block_number = db.Column(db.Integer, nullable=False, index=True)
+    from_address = db.Column(db.String(42))
+    amount = db.Column(db.Float, nullable=False)
+    create_time = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return f'<Payment {self.tx_hash}:{self.log_index} order {self.order_id} - {self.amount}>'
+
+
+class ScanCursor(db.Model):
+    """区块扫描游标, 记录已处理到的区块高度"""
+    __tablename__ = 'scan_cursors'
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(64), unique=True, nullable=False)
+    block_number = db.Column(db.Integer, nullable=False)
+    update_time = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    # 多进程时只允许一个进程扫描
+    lease_owner = db.Column(db.String(64))
+    lease_expire_time = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f'<ScanCursor {self.name}: {self.block_number}>'
+
+
+class CollectJob(db.Model):
+    """资金归集任务, 由后台工作线程处理"""
+    __tablename__ = 'collect_jobs'
+
+    id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer, db.ForeignKey('orders.id'), nullable=False, index=True)
+    amount = db.Column(db.Float, nullable=False)  # 归集金额
+    status = db.Column(db.Enum(CollectStatus), default=CollectStatus.PENDING, nullable=False, index=True)
+
+    gas_tx_hash = db.Column(db.String(66))  # gas费交易哈希
+    tx_hash = db.Column(db.String(66))  # 归集交易哈希
+    attempts = db.Column(db.Integer, default=0, nullable=False)  # 失败次数
+    error = db.Column(db.String(255))  # 最近一次错误
+
+    # 处理中的任务由领取的进程持有租约, 状态变化时释放
+    lease_owner = db.Column(db.String(64))
+    lease_expire_time = db.Column(db.DateTime)
+
+    create_time = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    update_time = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    order = db.relationship('Order')
+
+    def __repr__(self):
+        return f'<CollectJob {self.id}: order {self.order_id} - {self.status.value}>'
+
+
+class Notification(db.Model):
+    """待投递的订单事件通知(发件箱), 与订单状态在同一事务中写入, 由通知分发器异步投递"""
+    __tablename__ = 'notifications'
+    __table_args__ = (
+        # 领取到期的待投递通知
+        db.Index('ix_notifications_status_next_attempt_at', 'status', 'next_attempt_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer, db.ForeignKey('orders.id'), nullable=False, index=True)
+    event = db.Column(db.String(32), nullable=False)  # 事件类型, 如order.paid
+    url = db.Column(db.String(512), nullable=False)  # 投递地址
+    payload = db.Column(db.Text, nullable=False)  # JSON格式的事件内容
+    status = db.Column(db.Enum(NotificationStatus), default=NotificationStatus.PENDING, nullable=False)
+    attempts = db.Column(db.Integer, default=0, nullable=False)  # 失败次数
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)  # 下次投递时间
+    error = db.Column(db.String(255))  # 最近一次错误
+
+    # 多进程投递时的租约
+    lease_owner = db.Column(db.String(64))
+    lease_expire_time = db.Column(db.DateTime)
+
+    create_time = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    delivered_time = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f'<Notification {self.id}: {self.event} order {self.order_id} - {self.status.value}>'
+
+
+class AmountSlot(db.Model):
+    """统一收款地址模式下已分配的支付金额, 主键保证多进程不会分配相同金额"""
+    __tablename__ = 'amount_slots'
+
+    amount_key = db.Column(db.BigInteger, primary_key=True, autoincrement=False)  # 支付金额, 以最小单位计
+    order_no = db.Column(db.String(64), nullable=False)
+    hold_until = db.Column(db.DateTime, nullable=False, index=True)  # 占用截止时间, 之后可分配给其他订单
+
+    def __repr__(self):
+        return f'<AmountSlot {self.amount_key}: {self.order_no}>'
+
+
+class DerivationCounter(db.Model):
+    """HD钱包下一个可用的派生索引"""
+    __tablename__ = 'derivation_counters'
+
+    name = db.Column(db.String(32), primary_key=True)
+    next_index = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return f'<DerivationCounter {self.name}: {self.next_index}>'
+
+
+class NonceCounter(db.Model):
+    """发送地址下一个可用的nonce, 多个进程共用同一个发送地址时由数据库分配"""
+    __tablename__ = 'nonce_counters'
+
+    address = db.Column(db.String(42), primary_key=True)
+    next_nonce = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return f'<NonceCounter {self.address}: {self.next_nonce}>'
+
+
+class PendingTransaction(db.Model):
+    """已发送、等待上链的交易, 由收据跟踪器批量查询"""
+    __tablename__ = 'pending_transactions'
+
+    id = db.Column(db.Integer, primary_key=True)
+    tx_hash = db.Column(db.String(66), nullable=False, unique=True)
+    kind = db.Column(db.String(32), nullable=False)  # 交易类型, 决定上链后调用的回调
+    ref_id = db.Column(db.Integer)  # 回调使用的关联记录ID, 如归集任务ID
+    create_time = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return f'<PendingTransaction {self.kind}: {self.tx_hash}>'
+
+
+class QRCode(db.Model):
+    """收款地址的二维码图片, 与订单表分开存储, 避免查询订单时加载图片"""
+    __tablename__ = 'qr_codes'
+
+    address = db.Column(db.String(42), primary_key=True)
+    png = db.Column(db.LargeBinary, nullable=False)  # PNG格式的二维码图片
+    create_time = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return f'<QRCode {self.address}>'
+
+
+class DepositAddress(db.Model):
+    """预先生成的收款地址池, 创建订单时直接领取"""
+    __tablename__ = 'deposit_addresses'
+
+    id = db.Column(db.Integer, primary_key=True)
+    address = db.Column(db.String(42), nullable=False, unique=True)
+    private_key = db.Column(db.String(66))  # HD钱包派生的地址为空
+    derivation_index = db.Column(db.Integer, unique=True)  # HD钱包派生索引
+    qr_png = db.Column(db.LargeBinary, nullable=False)  # 预先渲染的二维码图片
+    create_time = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return f'<DepositAddress {self.address}>'
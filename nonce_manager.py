@@ -0,0 +1,66 @@
+import threading
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from models import db, NonceCounter
+
+
+class NonceManager(object):
+    """
+    nonce分配器, 同一地址的多笔交易无需等待确认即可连续发送
+    计数器保存在数据库中, 多个调度进程使用同一个发送地址时不会分配到相同的nonce
+    """
+
+    def __init__(self, address):
+        self.address = address
+
+    def allocate(self, w3):
+        """以独立的短事务分配下一个nonce, 首次使用时从节点的pending nonce同步"""
+        for _ in range(3):
+            try:
+                with db.engine.begin() as connection:
+                    # UPDATE锁住计数器行直到提交, 读到的是本事务更新后的值
+                    result = connection.execute(
+                        update(NonceCounter).where(NonceCounter.address == self.address).values(
+                            next_nonce=NonceCounter.next_nonce + 1
+                        )
+                    )
+                    if result.rowcount:
+                        return connection.execute(
+                            select(NonceCounter.next_nonce).where(NonceCounter.address == self.address)
+                        ).scalar_one() - 1
+
+                    nonce = w3.eth.get_transaction_count(self.address, 'pending')
+                    connection.execute(insert(NonceCounter).values(address=self.address, next_nonce=nonce + 1))
+                    return nonce
+            except IntegrityError:
+                # 其他进程同时创建了计数器, 重试即可
+                continue
+        raise RuntimeError(f'Failed to allocate nonce for {self.address}')
+
+    def resync(self, w3):
+        """发送失败或交易被丢弃后重新从节点同步, 填补未上链的nonce"""
+        try:
+            nonce = w3.eth.get_transaction_count(self.address, 'pending')
+        except Exception:
+            nonce = None
+
+        with db.engine.begin() as connection:
+            if nonce is None:
+                # 同步失败时删除计数器, 下次分配再从节点同步
+                connection.execute(delete(NonceCounter).where(NonceCounter.address == self.address))
+            else:
+                connection.execute(
+                    update(NonceCounter).where(NonceCounter.address == self.address).values(next_nonce=nonce)
+                )
+
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+
+def get_nonce_manager(address):
+    """获取地址对应的nonce分配器"""
+    with _managers_lock:
+        if address not in _managers:
+            _managers[address] = NonceManager(address)
+        return _managers[address]
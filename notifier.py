@@ -0,0 +1,230 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+import aiohttp
+from sqlalchemy import insert, select, update, or_
+from leases import WORKER_ID
+from metrics import endpoint_label, NOTIFICATIONS, WEBHOOK_LATENCY
+from models import db, Notification, NotificationStatus
+
+# 事件类型
+ORDER_PAID = 'order.paid'
+
+
+def paid_event(order, paid_amount, paid_time):
+    """订单支付完成事件的内容"""
+    return {
+        'order_id': order.id,
+        'event': ORDER_PAID,
+        'order_no': order.order_no,
+        'amount': order.amount,
+        'pay_amount': order.pay_amount,
+        'paid_amount': paid_amount,
+        'address': order.address,
+        'tx_hash': order.tx_hash,
+        'paid_time': paid_time.isoformat()
+    }
+
+
+def enqueue_notifications(app, events):
+    """为每个投递地址写入一条待投递通知, 随调用方的事务一起提交"""
+    urls = app.config.get('WEBHOOK_URLS')
+    if not urls or not events:
+        return
+
+    now = datetime.utcnow()
+    db.session.execute(insert(Notification), [
+        {
+            'order_id': event['order_id'],
+            'event': event['event'],
+            'url': url,
+            'payload': json.dumps(event),
+            'status': NotificationStatus.PENDING,
+            'attempts': 0,
+            'next_attempt_at': now,
+            'create_time': now
+        }
+        for event in events for url in urls
+    ])
+
+
+class NotificationDispatcher(object):
+    """
+    订单事件通知分发器
+    在独立线程的事件循环中从发件箱领取到期的通知, 同一地址的通知合并为一个请求投递
+    连接池在各次投递之间复用, 每个地址的并发数单独限制, 失败后按指数退避重试
+    """
+
+    def __init__(self):
+        self.app = None
+        self._loop = None
+        self._wakeup = None
+        self._tasks = set()
+        self._semaphores = {}
+
+    def start(self, app):
+        self.app = app
+        self.batch_size = app.config.get('WEBHOOK_BATCH_SIZE', 50)
+        self.concurrency = app.config.get('WEBHOOK_CONCURRENCY_PER_DESTINATION', 4)
+        # 同时投递中的请求上限, 达到后暂停领取
+        self.max_inflight = app.config.get('WEBHOOK_POOL_SIZE', 100)
+        threading.Thread(target=lambda: asyncio.run(self._run()), name='notification-dispatcher', daemon=True).start()
+        return self
+
+    def wakeup(self):
+        """有新通知提交后立即投递, 可在任意线程调用, 未启动时忽略"""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def _run(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        connector = aiohttp.TCPConnector(limit=self.max_inflight, limit_per_host=self.concurrency)
+        timeout = aiohttp.ClientTimeout(total=self.app.config.get('WEBHOOK_TIMEOUT', 10))
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            while True:
+                self._wakeup.clear()
+                claimed = 0
+                if len(self._tasks) < self.max_inflight:
+                    try:
+                        batches = await self._loop.run_in_executor(
+                            None, self._claim, (self.max_inflight - len(self._tasks)) * self.batch_size
+                        )
+                    except Exception as e:
+                        self.app.logger.exception(f'Error claiming notifications: {e}')
+                        batches = []
+                    for url, notifications in batches:
+                        claimed += len(notifications)
+                        task = asyncio.create_task(self._deliver(session, url, notifications))
+                        self._tasks.add(task)
+                        task.add_done_callback(self._on_done)
+                if claimed:
+                    # 可能还有更多到期的通知
+                    continue
+
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.app.config.get('WEBHOOK_POLL_SECONDS', 5))
+                except asyncio.TimeoutError:
+                    pass
+
+    def _on_done(self, task):
+        self._tasks.discard(task)
+        # 腾出投递名额后继续领取
+        self._wakeup.set()
+
+    def _claim(self, limit):
+        """领取到期的待投递通知, 按地址分组并切分为批次: [(地址, [(通知ID, 失败次数, 事件)])]"""
+        with self.app.app_context():
+            now = datetime.utcnow()
+            token = f'{WORKER_ID}:{uuid.uuid4().hex[:8]}'
+            claimable = select(Notification.id).where(
+                Notification.status == NotificationStatus.PENDING,
+                Notification.next_attempt_at <= now,
+                or_(Notification.lease_expire_time.is_(None), Notification.lease_expire_time < now)
+            ).order_by(Notification.next_attempt_at, Notification.id).limit(limit)
+
+            if db.engine.dialect.name == 'sqlite':
+                ids = claimable.scalar_subquery()
+            else:
+                ids = db.session.execute(claimable.with_for_update(skip_locked=True)).scalars().all()
+                if not ids:
+                    db.session.commit()
+                    return []
+
+            db.session.execute(
+                update(Notification).where(Notification.id.in_(ids)).values(
+                    lease_owner=token,
+                    lease_expire_time=now + timedelta(seconds=self.app.config.get('WEBHOOK_LEASE_SECONDS', 120))
+                ),
+                execution_options={'synchronize_session': False}
+            )
+            db.session.commit()
+
+            rows = db.session.execute(
+                select(Notification.id, Notification.url, Notification.payload, Notification.attempts).where(
+                    Notification.lease_owner == token
+                ).order_by(Notification.id)
+            ).all()
+
+        by_url = {}
+        for row in rows:
+            by_url.setdefault(row.url, []).append((row.id, row.attempts, json.loads(row.payload)))
+        return [
+            (url, notifications[start:start + self.batch_size])
+            for url, notifications in by_url.items()
+            for start in range(0, len(notifications), self.batch_size)
+        ]
+
+    async def _deliver(self, session, url, notifications):
+        """将一批通知合并为一个请求投递, 接收方按事件ID去重"""
+        body = json.dumps({
+            'events': [dict(event, id=notification_id) for notification_id, _, event in notifications]
+        }).encode()
+        headers = {'Content-Type': 'application/json'}
+        secret = self.app.config.get('WEBHOOK_SECRET')
+        if secret:
+            headers['X-Signature'] = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+        semaphore = self._semaphores.setdefault(url, asyncio.Semaphore(self.concurrency))
+        error = None
+        async with semaphore:
+            start = time.monotonic()
+            try:
+                async with session.post(url, data=body, headers=headers) as response:
+                    if response.status >= 300:
+                        error = f'HTTP {response.status}'
+            except Exception as e:
+                error = f'{type(e).__name__}: {e}'
+            WEBHOOK_LATENCY.labels(endpoint_label(url)).observe(time.monotonic() - start)
+
+        try:
+            await self._loop.run_in_executor(None, self._save, url, notifications, error)
+        except Exception as e:
+            self.app.logger.exception(f'Error saving notification results: {e}')
+
+    def _save(self, url, notifications, error):
+        """以一次批量UPDATE写入投递结果并释放租约"""
+        now = datetime.utcnow()
+        if error is None:
+            rows = [
+                {'id': notification_id, 'status': NotificationStatus.DELIVERED, 'delivered_time': now,
+                 'error': None, 'lease_owner': None, 'lease_expire_time': None}
+                for notification_id, _, _ in notifications
+            ]
+            NOTIFICATIONS.labels('delivered').inc(len(rows))
+        else:
+            max_attempts = self.app.config.get('WEBHOOK_MAX_ATTEMPTS', 10)
+            base = self.app.config.get('WEBHOOK_BACKOFF_BASE', 5)
+            limit = self.app.config.get('WEBHOOK_BACKOFF_MAX', 3600)
+            rows = []
+            for notification_id, attempts, _ in notifications:
+                attempts += 1
+                # 指数退避并加入随机抖动, 避免接收方恢复时同时重试
+                delay = min(base * 2 ** (attempts - 1), limit) * random.uniform(0.5, 1)
+                rows.append({
+                    'id': notification_id,
+                    'status': NotificationStatus.FAILED if attempts >= max_attempts else NotificationStatus.PENDING,
+                    'attempts': attempts,
+                    'next_attempt_at': now + timedelta(seconds=delay),
+                    'error': error[:255],
+                    'lease_owner': None,
+                    'lease_expire_time': None
+                })
+            failed = sum(1 for row in rows if row['status'] == NotificationStatus.FAILED)
+            NOTIFICATIONS.labels('retry').inc(len(rows) - failed)
+            NOTIFICATIONS.labels('failed').inc(failed)
+            self.app.logger.warning(f'Failed to deliver {len(rows)} notifications to {endpoint_label(url)}: {error}')
+
+        with self.app.app_context():
+            db.session.execute(update(Notification), rows)
+            db.session.commit()
+
+
+# 进程内共享的通知分发器
+notification_dispatcher = NotificationDispatcher()
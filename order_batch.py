@@ -0,0 +1,147 @@
+import multiprocessing
+import os
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from eth_account import Account
+from sqlalchemy import delete, insert
+from address_pool import claim_addresses
+from amount_allocator import get_amount_allocator
+from hd_wallet import get_hd_wallet, reserve_indexes
+from models import db, Order, OrderStatus, QRCode, AmountSlot
+from qr_support import QRRenderer, get_logo_path
+
+_executor = None
+_executor_lock = threading.Lock()
+# 工作进程自己的二维码渲染器
+_renderer = None
+
+
+def _get_executor(app):
+    """生成私钥与渲染二维码都是CPU密集的, 使用进程池绕过GIL"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # 在多线程的Web进程中fork会把其他线程持有的锁(连接池、日志等)复制到子进程, 可能导致死锁
+            # 因此由forkserver(不支持时用spawn)启动不继承父进程状态的工作进程
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _executor = ProcessPoolExecutor(
+                max_workers=app.config.get('ORDER_BATCH_WORKERS') or os.cpu_count(),
+                mp_context=multiprocessing.get_context(method),
+                initializer=_init_worker,
+                initargs=(get_logo_path(),)
+            )
+        return _executor
+
+
+def _init_worker(logo_path):
+    # 每个工作进程创建自己的渲染器, 加载一次logo后复用
+    global _renderer
+    _renderer = QRRenderer(logo_path)
+
+
+def generate_accounts(count, wallet=None, start=None):
+    """在工作进程中生成一段收款地址及其二维码, 配置了HD钱包时从start开始按索引派生"""
+    if wallet is not None:
+        accounts = [
+            {'address': address, 'private_key': None, 'derivation_index': index}
+            for index, address in wallet.derive_range(start, count)
+        ]
+    else:
+        accounts = [
+            {'address': account.address, 'private_key': account.key.hex(), 'derivation_index': None}
+            for account in (Account.create() for _ in range(count))
+        ]
+
+    for account in accounts:
+        account['qr_png'] = _renderer.render(account['address'])
+    return accounts
+
+
+def create_accounts(app, count):
+    """优先从地址池批量领取, 不足的部分由进程池分块生成"""
+    accounts = claim_addresses(count)
+    # 先提交领取结果释放写锁, 预留派生索引使用独立的事务; 之后失败时领取的地址不再使用, 没有损失
+    db.session.commit()
+    missing = count - len(accounts)
+    if missing <= 0:
+        return accounts
+
+    wallet = get_hd_wallet(app)
+    start = reserve_indexes(missing) if wallet is not None else None
+    chunk_size = app.config.get('ORDER_BATCH_CHUNK_SIZE', 50)
+    executor = _get_executor(app)
+    futures = [
+        executor.submit(
+            generate_accounts, min(chunk_size, missing - offset),
+            wallet, start + offset if wallet is not None else None
+        )
+        for offset in range(0, missing, chunk_size)
+    ]
+    for future in futures:
+        accounts += future.result()
+    return accounts
+
+
+def create_orders(app, w3, amounts):
+    """
+    批量创建订单, 订单与二维码各用一次批量INSERT写入, 在同一事务中提交
+    :param amounts: 每个订单的金额
+    :return: 订单字典列表; 统一收款地址模式下没有可用的支付金额时返回None
+    """
+    now = datetime.utcnow()
+    expire_time = now + timedelta(hours=2)  # 2小时过期
+    order_nos = [str(uuid.uuid4()) for _ in amounts]
+
+    if app.config.get('PAYMENT_MODE') == 'amount':
+        # 统一收款到归集地址, 逐个订单分配唯一的支付金额
+        allocator = get_amount_allocator(app)
+        hold_until = expire_time + timedelta(seconds=app.config.get('AMOUNT_HOLD_SECONDS', 3600))
+        pay_amounts = []
+        for order_no, amount in zip(order_nos, amounts):
+            pay_amount = allocator.reserve(amount, order_no, hold_until)
+            if pay_amount is None:
+                # 释放本批已占用的金额
+                with db.engine.begin() as connection:
+                    connection.execute(delete(AmountSlot).where(AmountSlot.order_no.in_(order_nos)))
+                return None
+            pay_amounts.append(pay_amount)
+        accounts = [{'address': w3.collect_address, 'private_key': None, 'derivation_index': None}] * len(amounts)
+    else:
+        pay_amounts = [None] * len(amounts)
+        accounts = create_accounts(app, len(amounts))
+        db.session.execute(insert(QRCode), [
+            {'address': account['address'], 'png': account['qr_png'], 'create_time': now}
+            for account in accounts
+        ])
+
+    rows = [
+        {
+            'order_no': order_no,
+            'amount': amount,
+            'pay_amount': pay_amount,
+            'status': OrderStatus.UNPAID,
+            'address': account['address'],
+            'private_key': account['private_key'],
+            'derivation_index': account['derivation_index'],
+            'create_time': now,
+            'update_time': now,
+            'expire_time': expire_time,
+            'next_check_at': now
+        }
+        for order_no, amount, pay_amount, account in zip(order_nos, amounts, pay_amounts, accounts)
+    ]
+    db.session.execute(insert(Order), rows)
+    db.session.commit()
+
+    return [
+        {
+            'order_no': row['order_no'],
+            'amount': row['amount'],
+            'pay_amount': row['pay_amount'],
+            'address': row['address'],
+            'expire_time': expire_time.isoformat()
+        }
+        for row in rows
+    ]
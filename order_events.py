@@ -0,0 +1,86 @@
+import queue
+import threading
+import time
+from collections import defaultdict
+from sqlalchemy import select
+from models import db, Order, OrderStatus
+
+
+class OrderEventBus(object):
+    """进程内的订单状态发布订阅, 订单状态变化时立即通知等待中的页面"""
+
+    def __init__(self):
+        self.app = None
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(set)
+        self._poller = None
+
+    def init_app(self, app):
+        """
+        调度器在独立进程中运行时, 订单状态的变化不会发布到Web进程
+        有订阅时由后台线程定期查询这些订单的状态, 线程在首次订阅时启动
+        """
+        self.app = app
+
+    def subscribe(self, order_no):
+        """订阅订单状态, 返回接收状态的队列"""
+        q = queue.Queue(maxsize=16)
+        with self._lock:
+            self._subscribers[order_no].add(q)
+            if self.app is not None and self._poller is None:
+                self._poller = threading.Thread(target=self._poll, name='order-events', daemon=True)
+                self._poller.start()
+        return q
+
+    def unsubscribe(self, order_no, q):
+        """取消订阅"""
+        with self._lock:
+            subscribers = self._subscribers.get(order_no)
+            if subscribers is None:
+                return
+            subscribers.discard(q)
+            if not subscribers:
+                del self._subscribers[order_no]
+
+    def publish(self, order_no, status):
+        """发布订单的新状态"""
+        with self._lock:
+            subscribers = list(self._subscribers.get(order_no, ()))
+        for q in subscribers:
+            try:
+                q.put_nowait(status)
+            except queue.Full:
+                pass
+
+    def subscriber_count(self):
+        """当前等待中的订阅数量"""
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+    def _poll(self):
+        """一次查询所有订阅中且已不是未支付状态的订单, 发布其状态"""
+        interval = self.app.config.get('ORDER_EVENTS_POLL_SECONDS', 1)
+        while True:
+            time.sleep(interval)
+            with self._lock:
+                order_nos = list(self._subscribers)
+            if not order_nos:
+                continue
+
+            changed = []
+            try:
+                with self.app.app_context():
+                    for start in range(0, len(order_nos), 500):
+                        changed += db.session.execute(
+                            select(Order.order_no, Order.status).where(
+                                Order.order_no.in_(order_nos[start:start + 500]),
+                                Order.status != OrderStatus.UNPAID
+                            )
+                        ).all()
+            except Exception as e:
+                self.app.logger.warning(f'Error polling order status: {e}')
+            for order_no, status in changed:
+                self.publish(order_no, status)
+
+
+event_bus = OrderEventBus()
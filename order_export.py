@@ -0,0 +1,120 @@
+import base64
+import csv
+import io
+import json
+from datetime import datetime
+from enum import Enum
+from sqlalchemy import select, or_, and_
+from models import db, Order, OrderStatus
+
+# 允许列出与导出的订单字段, 不包含私钥等敏感字段
+ORDER_FIELDS = (
+    'id', 'order_no', 'amount', 'pay_amount', 'status', 'address', 'tx_hash', 'paid_amount',
+    'collect_tx_hash', 'create_time', 'update_time', 'expire_time', 'paid_time'
+)
+
+
+def parse_fields(value):
+    """解析逗号分隔的字段列表, 默认全部字段"""
+    if not value:
+        return list(ORDER_FIELDS)
+    fields = [field.strip() for field in value.split(',') if field.strip()]
+    unknown = [field for field in fields if field not in ORDER_FIELDS]
+    if unknown:
+        raise ValueError(f'Unknown fields: {", ".join(unknown)}')
+    return fields
+
+
+def parse_filters(args):
+    """
+    解析查询参数中的过滤条件
+    status: 逗号分隔的订单状态; created_after/created_before: ISO格式的UTC时间
+    """
+    filters = []
+    if args.get('status'):
+        filters.append(Order.status.in_([OrderStatus(status.strip()) for status in args['status'].split(',')]))
+    if args.get('created_after'):
+        filters.append(Order.create_time >= datetime.fromisoformat(args['created_after']))
+    if args.get('created_before'):
+        filters.append(Order.create_time < datetime.fromisoformat(args['created_before']))
+    return filters
+
+
+def encode_cursor(create_time, order_id):
+    return base64.urlsafe_b64encode(f'{create_time.isoformat()}|{order_id}'.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        create_time, order_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(create_time), int(order_id)
+    except Exception:
+        raise ValueError('Invalid cursor')
+
+
+def serialize(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Enum):
+        return value.value
+    return value
+
+
+def list_orders(filters, fields, cursor=None, limit=100):
+    """
+    按创建时间倒序分页列出订单, 以上一页最后一个订单的(创建时间, ID)作为游标
+    翻页成本与页码无关, 分页期间新建的订单不会导致重复或遗漏
+    :return: (订单字典列表, 下一页游标)
+    """
+    columns = [getattr(Order, field) for field in fields]
+    query = select(Order.create_time, Order.id, *columns).where(*filters)
+    if cursor:
+        create_time, order_id = decode_cursor(cursor)
+        query = query.where(or_(
+            Order.create_time < create_time,
+            and_(Order.create_time == create_time, Order.id < order_id)
+        ))
+
+    rows = db.session.execute(
+        query.order_by(Order.create_time.desc(), Order.id.desc()).limit(limit + 1)
+    ).all()
+    orders = [
+        {field: serialize(value) for field, value in zip(fields, row[2:])}
+        for row in rows[:limit]
+    ]
+    next_cursor = encode_cursor(rows[limit - 1][0], rows[limit - 1][1]) if len(rows) > limit else None
+    return orders, next_cursor
+
+
+def export_orders(filters, fields, format='csv', chunk_size=1000):
+    """
+    按ID顺序流式导出订单, 只查询指定的字段
+    使用服务端游标按块读取(SQLite等不支持的数据库按块获取), 内存占用与订单总数无关
+    """
+    columns = [getattr(Order, field) for field in fields]
+    result = db.session.execute(
+        select(*columns).where(*filters).order_by(Order.id).execution_options(yield_per=chunk_size)
+    )
+
+    try:
+        if format == 'csv':
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(fields)
+            for rows in result.partitions():
+                writer.writerows([serialize(value) for value in row] for row in rows)
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+            # 没有订单时只输出表头
+            if buffer.getvalue():
+                yield buffer.getvalue()
+        else:
+            for rows in result.partitions():
+                yield ''.join(
+                    json.dumps({field: serialize(value) for field, value in zip(fields, row)}) + '\n'
+                    for row in rows
+                )
+    finally:
+        # 客户端中途断开时释放游标
+        result.close()
@@ -0,0 +1,41 @@
+from sqlalchemy import insert, select
+from models import db, Payment
+
+
+def record_payments(order_transfers):
+    """
+    写入订单收款记录, 已记录过的转账(按交易哈希与日志序号)跳过, 由调用方提交
+    :param order_transfers: [(订单, 转账)], 转账为get_usdt_transfers返回的字典
+    :return: 本次新写入的 [(订单, 转账)]
+    """
+    if not order_transfers:
+        return []
+
+    tx_hashes = list({transfer['tx_hash'] for _, transfer in order_transfers})
+    seen = set()
+    for start in range(0, len(tx_hashes), 500):
+        seen.update(db.session.execute(
+            select(Payment.tx_hash, Payment.log_index).where(Payment.tx_hash.in_(tx_hashes[start:start + 500]))
+        ).tuples())
+
+    recorded = []
+    for order, transfer in order_transfers:
+        key = (transfer['tx_hash'], transfer['log_index'])
+        if key in seen:
+            continue
+        seen.add(key)
+        recorded.append((order, transfer))
+
+    if recorded:
+        db.session.execute(insert(Payment), [
+            {
+                'order_id': order.id,
+                'tx_hash': transfer['tx_hash'],
+                'log_index': transfer['log_index'],
+                'block_number': transfer['block_number'],
+                'from_address': transfer['from'],
+                'amount': transfer['amount']
+            }
+            for order, transfer in recorded
+        ])
+    return recorded
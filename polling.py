@@ -0,0 +1,46 @@
+from datetime import datetime, timedelta
+from sqlalchemy import update
+from models import db, Order, OrderStatus
+
+
+def next_check_interval(app, order, now):
+    """根据订单年龄和页面是否打开计算下次检查间隔（秒）"""
+    # 页面打开中的订单用户随时可能付款，频繁检查
+    watch_window = timedelta(seconds=app.config.get('POLL_WATCH_WINDOW', 60))
+    if order.watch_time and now - order.watch_time < watch_window:
+        return app.config.get('POLL_WATCHED_INTERVAL', 5)
+
+    # 新订单频繁检查，越旧的订单间隔越长
+    age = (now - order.create_time).total_seconds()
+    for max_age, interval in app.config.get('POLL_SCHEDULE', []):
+        if age < max_age:
+            return interval
+    return app.config.get('POLL_MAX_INTERVAL', 120)
+
+
+def mark_watched(app, order):
+    """记录订单页面被打开, 并让订单尽快被检查"""
+    if order.status != OrderStatus.UNPAID:
+        return
+
+    now = datetime.utcnow()
+    # 限制写入频率
+    throttle = timedelta(seconds=app.config.get('POLL_WATCHED_INTERVAL', 5))
+    if order.watch_time and now - order.watch_time < throttle:
+        return
+
+    order.watch_time = now
+    if order.next_check_at is None or order.next_check_at > now:
+        order.next_check_at = now
+    db.session.commit()
+
+
+def touch_watched(app, order_id):
+    """长连接保持期间刷新页面打开时间, 不占用会话"""
+    with app.app_context(), db.engine.begin() as connection:
+        connection.execute(
+            update(Order).where(
+                Order.id == order_id,
+                Order.status == OrderStatus.UNPAID
+            ).values(watch_time=datetime.utcnow(), update_time=Order.update_time)
+        )
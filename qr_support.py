@@ -0,0 +1,155 @@
+import os
+import threading
+import qrcode
+from functools import lru_cache
+from PIL import Image, ImageDraw
+from io import BytesIO
+from flask import current_app
+from models import db, QRCode
+
+# 二维码渲染方式的版本号, 渲染逻辑变化时修改以使客户端缓存失效
+QR_VERSION = 2
+# 进程内缓存的二维码图片数量
+QR_CACHE_SIZE = 1024
+
+
+class QRRenderer(object):
+    """
+    二维码渲染器, Logo徽标按尺寸只合成一次
+    二维码模块直接写入调色板图片, 徽标使用同一调色板, 整个渲染过程不转换为RGBA
+    """
+
+    # 调色板中黑白两色的位置, 其余位置留给Logo
+    BLACK = 254
+    WHITE = 255
+
+    def __init__(self, logo_path: str = None, logo_bg_shape: str = 'circle', box_size: int = 10, border: int = 4):
+        self.logo_path = logo_path
+        self.logo_bg_shape = logo_bg_shape
+        self.box_size = box_size
+        self.border = border
+        self._logo = None
+        # 按二维码尺寸缓存的徽标: (调色板, 徽标图片, 遮罩)
+        self._badges = {}
+        self._lock = threading.Lock()
+
+    def render(self, data: str) -> bytes:
+        """渲染单个二维码, 返回PNG图片"""
+        # 设置二维码参数，使用最高容错率
+        qr = qrcode.QRCode(
+            version=1,
+            error_correction=qrcode.constants.ERROR_CORRECT_H,
+            box_size=self.box_size,
+            border=self.border,
+        )
+        qr.add_data(data)
+        qr.make(fit=True)
+
+        # 每个模块一个像素, 再整体放大
+        matrix = qr.get_matrix()
+        modules = len(matrix)
+        pixels = bytes(self.BLACK if cell else self.WHITE for row in matrix for cell in row)
+        size = modules * self.box_size
+        qr_img = Image.frombytes('P', (modules, modules), pixels).resize((size, size), Image.Resampling.NEAREST)
+
+        badge = self._get_badge(size)
+        if badge is None:
+            qr_img.putpalette(self._palette([]))
+        else:
+            palette, badge_img, mask = badge
+            qr_img.putpalette(palette)
+            pos = ((size - badge_img.width) // 2, (size - badge_img.height) // 2)
+            qr_img.paste(badge_img, pos, mask)
+
+        buffered = BytesIO()
+        qr_img.save(buffered, format="PNG")
+        return buffered.getvalue()
+
+    def render_many(self, items):
+        """批量渲染, 返回 {内容: PNG图片}"""
+        return {data: self.render(data) for data in items}
+
+    def _palette(self, colors):
+        """Logo颜色在前, 黑白两色固定在最后两位"""
+        palette = list(colors)[:self.BLACK * 3]
+        palette += [0] * (self.BLACK * 3 - len(palette))
+        return palette + [0, 0, 0, 255, 255, 255]
+
+    def _get_badge(self, size):
+        """获取指定二维码尺寸的徽标, 首次使用时合成"""
+        if not self.logo_path or not os.path.exists(self.logo_path):
+            return None
+
+        with self._lock:
+            if size not in self._badges:
+                try:
+                    self._badges[size] = self._build_badge(size)
+                except Exception as e:
+                    current_app.logger.warning(f"Failed to add logo to QR code: {e}")
+                    self._badges[size] = None
+            return self._badges[size]
+
+    def _build_badge(self, size):
+        """合成带白色背景的Logo徽标, 并量化到调色板"""
+        if self._logo is None:
+            self._logo = Image.open(self.logo_path).convert('RGBA')
+
+        # 计算Logo大小（二维码的1/5）
+        logo_size = size // 5
+        logo = self._logo.copy()
+        logo.thumbnail((logo_size, logo_size), Image.Resampling.LANCZOS)
+
+        # 创建白色背景
+        bg_size = int(logo_size * 1.2)
+        bg_img = Image.new('RGB', (bg_size, bg_size), (255, 255, 255))
+        logo_pos = ((bg_size - logo.width) // 2, (bg_size - logo.height) // 2)
+        bg_img.paste(logo, logo_pos, logo)
+
+        if self.logo_bg_shape == 'circle':
+            # 圆形遮罩, 调色板图片只能整像素覆盖
+            mask = Image.new('1', (bg_size, bg_size), 0)
+            ImageDraw.Draw(mask).ellipse((0, 0, bg_size, bg_size), fill=1)
+        else:
+            mask = None
+
+        # 量化到Logo调色板, 保留最后两位给黑白两色
+        badge_img = bg_img.quantize(colors=self.BLACK)
+        palette = self._palette(badge_img.getpalette())
+        return palette, badge_img, mask
+
+
+@lru_cache(maxsize=8)
+def get_renderer(logo_path: str = None, logo_bg_shape: str = 'circle') -> QRRenderer:
+    """获取共享的二维码渲染器"""
+    return QRRenderer(logo_path, logo_bg_shape)
+
+
+def generate_qr_with_logo(data: str, logo_path: str = None, logo_bg_shape: str = 'circle') -> bytes:
+    """
+    生成一个二维码，并在中间添加带白色背景的Logo
+    :param data: 二维码内容
+    :param logo_path: Logo图片文件路径
+    :param logo_bg_shape: Logo背景形状, 'circle' 或 'square'
+    :return: PNG格式的二维码图片
+    """
+    return get_renderer(logo_path, logo_bg_shape).render(data)
+
+
+def get_logo_path():
+    """二维码中间的Logo路径"""
+    return os.path.join(current_app.root_path, 'static', 'img', 'usdt-bsc.png')
+
+
+@lru_cache(maxsize=QR_CACHE_SIZE)
+def get_qr_png(address):
+    """获取地址的二维码图片, 优先读取已保存的图片, 否则按地址重新生成"""
+    qr_code = db.session.get(QRCode, address)
+    if qr_code is not None:
+        return qr_code.png
+    return generate_qr_with_logo(address, get_logo_path())
+
+
+def qr_etag(address):
+    """二维码只由地址决定, 无需读取图片即可生成ETag"""
+    return f'{address.lower()}-v{QR_VERSION}'
+
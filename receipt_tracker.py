@@ -0,0 +1,94 @@
+import threading
+from datetime import datetime, timedelta
+from metrics import PENDING_TRANSACTIONS
+from models import db, PendingTransaction
+from web3_support import get_web3_support
+
+
+class ReceiptTracker(object):
+    """
+    交易收据跟踪器
+    待确认的交易记录在数据库中, 每个新区块用JSON-RPC批量请求一次查询全部收据, 上链或超时后调用按类型注册的回调
+    """
+
+    def __init__(self):
+        self._callbacks = {}
+        self._last_block = None
+        self._lock = threading.Lock()
+
+    def register(self, kind, callback):
+        """
+        注册交易类型的回调, 回调在跟踪器的事务中执行, 不应自行提交
+        callback(app, ref_id, tx_hash, succeeded), succeeded为True/False, 超时未上链时为None
+        """
+        self._callbacks[kind] = callback
+
+    def track(self, tx_hash, kind, ref_id=None):
+        """记录待确认的交易, 随调用方的事务一起提交"""
+        db.session.add(PendingTransaction(tx_hash=tx_hash, kind=kind, ref_id=ref_id))
+
+    def poll(self, app):
+        """查询全部待确认交易的收据, 同一区块只查询一次"""
+        # 多个调度线程同时触发时只需一个执行
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            with app.app_context():
+                try:
+                    self._poll(app)
+                except Exception as e:
+                    db.session.rollback()
+                    app.logger.exception(f'Error polling receipts: {e}')
+        finally:
+            self._lock.release()
+
+    def _poll(self, app):
+        pending = PendingTransaction.query.order_by(PendingTransaction.id).all()
+        PENDING_TRANSACTIONS.set(len(pending))
+        if not pending:
+            return
+
+        w3 = get_web3_support(app)
+        latest_block = w3.get_block_number()
+        if latest_block is None or latest_block == self._last_block:
+            # 没有新区块时收据不会变化
+            return
+
+        statuses = w3.get_transaction_statuses(
+            [tx.tx_hash for tx in pending], app.config.get('RECEIPT_BATCH_SIZE', 500)
+        )
+        if statuses is None:
+            return
+        self._last_block = latest_block
+
+        timeout = timedelta(seconds=app.config.get('RECEIPT_TIMEOUT', 600))
+        now = datetime.utcnow()
+        completed = 0
+        for tx in pending:
+            succeeded = statuses.get(tx.tx_hash)
+            if succeeded is None and tx.create_time >= now - timeout:
+                continue
+
+            callback = self._callbacks.get(tx.kind)
+            if callback is None:
+                app.logger.warning(f'No receipt callback registered for {tx.kind}, keeping {tx.tx_hash}')
+                continue
+            if succeeded is None:
+                app.logger.warning(f'Transaction {tx.tx_hash} not mined after {timeout}')
+
+            callback(app, tx.ref_id, tx.tx_hash, succeeded)
+            db.session.delete(tx)
+            completed += 1
+
+        # 本区块完成的交易与回调的修改一起提交, 回调按状态判断, 失败后重放也不会重复处理
+        db.session.commit()
+        if completed:
+            app.logger.info(f'Completed {completed}/{len(pending)} pending transactions at block {latest_block}')
+
+
+receipt_tracker = ReceiptTracker()
+
+
+def poll_receipts(app):
+    """调度任务: 批量查询待确认交易的收据"""
+    receipt_tracker.poll(app)
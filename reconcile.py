@@ -0,0 +1,224 @@
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from sqlalchemy import func, select
+from amount_allocator import get_amount_allocator
+from log_span import AdaptiveSpan
+from models import db, Order, OrderStatus, Payment, ScanCursor
+from payments import record_payments
+from scheduler import mark_paid, notify_paid
+from web3_support import get_web3_support
+
+# 对账游标名称, 记录已连续处理完成的最高区块
+RECONCILE_CURSOR = 'reconcile'
+
+
+class Reconciler(object):
+    """
+    历史区块对账
+    把区块范围切分为多个分段, 由线程池并发获取USDT Transfer事件, 再按区块顺序写入收款记录并更新订单
+    每个分段提交后推进游标, 中断后可从游标处继续; 收款记录按转账去重, 重复对账不会重复计入
+    """
+
+    def __init__(self, app, workers=8, chunk_blocks=5000, span=1000):
+        self.app = app
+        self.w3 = get_web3_support(app)
+        self.allocator = get_amount_allocator(app)
+        self.workers = workers
+        self.chunk_blocks = chunk_blocks  # 每个工作线程一次处理的区块数
+        self.span = AdaptiveSpan(span, chunk_blocks)  # 单次eth_getLogs的区块跨度, 各工作线程共用
+
+    def run(self, from_block, to_block):
+        """对账[from_block, to_block], 需要在应用上下文中调用, 返回统计信息"""
+        stats = {'from_block': from_block, 'to_block': to_block, 'transfers': 0, 'payments': 0, 'paid_orders': 0}
+        start = time.monotonic()
+        chunks = deque(
+            (block, min(block + self.chunk_blocks - 1, to_block))
+            for block in range(from_block, to_block + 1, self.chunk_blocks)
+        )
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='reconcile') as executor:
+            # 并发获取, 按提交顺序写入, 游标只推进到连续完成的区块
+            futures = deque()
+            try:
+                while chunks or futures:
+                    while chunks and len(futures) < self.workers * 2:
+                        chunk = chunks.popleft()
+                        futures.append((chunk, executor.submit(self.fetch, *chunk)))
+
+                    (chunk_from, chunk_to), future = futures.popleft()
+                    transfers = future.result()
+                    recorded, paid = self.apply(transfers, chunk_to)
+                    stats['transfers'] += len(transfers)
+                    stats['payments'] += recorded
+                    stats['paid_orders'] += paid
+
+                    elapsed = time.monotonic() - start
+                    done = chunk_to - from_block + 1
+                    self.app.logger.info(
+                        f'Reconciled blocks {chunk_from}-{chunk_to}: {len(transfers)} transfers, '
+                        f'{recorded} new payments, {done / elapsed:.0f} blocks/s'
+                    )
+            finally:
+                for _, future in futures:
+                    future.cancel()
+
+        elapsed = time.monotonic() - start
+        stats['blocks'] = to_block - from_block + 1
+        stats['seconds'] = round(elapsed, 2)
+        stats['blocks_per_second'] = round(stats['blocks'] / elapsed, 1) if elapsed else None
+        return stats
+
+    def fetch(self, from_block, to_block):
+        """获取一个分段内的全部转账, 节点拒绝过宽的区块范围时缩小跨度重试"""
+        transfers = []
+        block = from_block
+        failures = 0
+        while block <= to_block:
+            end = min(block + self.span.size - 1, to_block)
+            result = self.w3.get_usdt_transfers(block, end)
+            if result is None:
+                if end > block:
+                    self.span.resize(end - block + 1, False)
+                    continue
+                # 单个区块也失败, 不是跨度问题
+                failures += 1
+                if failures >= 3:
+                    raise RuntimeError(f'Failed to get USDT transfers in block {block}')
+                time.sleep(failures)
+                continue
+
+            transfers += result
+            failures = 0
+            self.span.resize(end - block + 1, True)
+            block = end + 1
+        return transfers
+
+    def apply(self, transfers, to_block):
+        """写入一个分段的收款记录, 补记迟到的支付, 与游标在同一事务中提交"""
+        try:
+            recorded = record_payments(self.match(transfers))
+            paid_orders = self.settle(list({order.id: order for order, _ in recorded}.values()), recorded)
+
+            cursor = ScanCursor.query.filter_by(name=RECONCILE_CURSOR).first()
+            if cursor is None:
+                cursor = ScanCursor(name=RECONCILE_CURSOR, block_number=to_block)
+                db.session.add(cursor)
+            cursor.block_number = to_block
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+        notify_paid(self.app, [(order.order_no, order.paid_amount) for order in paid_orders])
+        return len(recorded), len(paid_orders)
+
+    def match(self, transfers):
+        """找出转账对应的订单, 不限订单状态与创建时间, 返回 [(订单, 转账)]"""
+        collect_address = (self.app.config.get('BSC_COLLECT_ADDRESS') or '').lower()
+        matched = []
+
+        addresses = list({transfer['to'] for transfer in transfers if transfer['to'].lower() != collect_address})
+        address_index = {}
+        for start in range(0, len(addresses), 500):
+            for order in Order.query.filter(
+                Order.address.in_(addresses[start:start + 500]),
+                Order.pay_amount.is_(None)
+            ):
+                address_index[order.address.lower()] = order
+
+        amount_transfers = [transfer for transfer in transfers if transfer['to'].lower() == collect_address]
+        amount_index = self.amount_orders(amount_transfers)
+
+        for transfer in transfers:
+            if transfer['to'].lower() == collect_address:
+                order = self.amount_order(amount_index, transfer)
+            else:
+                order = address_index.get(transfer['to'].lower())
+            if order is not None:
+                matched.append((order, transfer))
+        return matched
+
+    def amount_orders(self, transfers):
+        """统一收款地址的订单按支付金额索引: {金额键: [订单]}, 按创建时间排序"""
+        keys = {self.allocator.transfer_key(transfer['value']) for transfer in transfers} - {None}
+        if not keys:
+            return {}
+
+        index = {}
+        pay_amounts = [self.allocator.from_key(key) for key in keys]
+        for order in Order.query.filter(Order.pay_amount.in_(pay_amounts)).order_by(Order.create_time):
+            index.setdefault(self.allocator.to_key(order.pay_amount), []).append(order)
+        return index
+
+    def amount_order(self, amount_index, transfer):
+        """同一金额过期后会分配给新订单, 取付款区块之前创建的最后一个订单"""
+        orders = amount_index.get(self.allocator.transfer_key(transfer['value']))
+        if not orders:
+            return None
+        if len(orders) == 1:
+            return orders[0]
+
+        timestamp = self.w3.get_block_timestamp(transfer['block_number'])
+        if timestamp is None:
+            return None
+        block_time = datetime.utcfromtimestamp(timestamp)
+        candidates = [order for order in orders if order.create_time <= block_time]
+        return candidates[-1] if candidates else None
+
+    def settle(self, orders, recorded):
+        """按收款记录重新计算订单的已付金额, 足额的未支付或已过期订单标记为已支付"""
+        totals = dict(db.session.execute(
+            select(Payment.order_id, func.sum(Payment.amount)).where(
+                Payment.order_id.in_([order.id for order in orders])
+            ).group_by(Payment.order_id)
+        ).all()) if orders else {}
+        last_tx = {order.id: transfer['tx_hash'] for order, transfer in recorded}
+
+        paid_orders = []
+        for order in orders:
+            if order.status == OrderStatus.PAID:
+                # 余额轮询检测到的订单没有记录交易哈希
+                order.tx_hash = order.tx_hash or last_tx[order.id]
+                continue
+
+            order.paid_amount = totals.get(order.id, 0)
+            order.tx_hash = last_tx[order.id]
+            if order.paid_amount >= order.amount:
+                self.app.logger.info(
+                    f'Reconciled late payment for {order.status.value} order {order.order_no}: {order.paid_amount} USDT'
+                )
+                mark_paid(self.app, order, order.paid_amount)
+                paid_orders.append(order)
+        return paid_orders
+
+
+def reconcile(app, from_block=None, to_block=None, workers=None):
+    """
+    对账命令的入口, 默认从上次对账的游标处继续, 到最新的已确认区块为止
+    :return: 统计信息, 包括每秒处理的区块数
+    """
+    w3 = get_web3_support(app)
+    if to_block is None:
+        latest_block = w3.get_block_number()
+        if latest_block is None:
+            raise RuntimeError('Failed to get the latest block number')
+        to_block = latest_block - app.config.get('CONFIRMATION_BLOCKS', 15)
+
+    if from_block is None:
+        cursor = ScanCursor.query.filter_by(name=RECONCILE_CURSOR).first()
+        if cursor is None:
+            raise ValueError('No reconcile cursor yet, --from-block is required')
+        from_block = cursor.block_number + 1
+
+    if from_block > to_block:
+        return {'from_block': from_block, 'to_block': to_block, 'blocks': 0}
+
+    reconciler = Reconciler(
+        app,
+        workers=workers or app.config.get('RECONCILE_WORKERS', 8),
+        chunk_blocks=app.config.get('RECONCILE_CHUNK_BLOCKS', 5000),
+        span=app.config.get('LOG_SCAN_MAX_BLOCKS', 1000)
+    )
+    return reconciler.run(from_block, to_block)
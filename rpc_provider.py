@@ -0,0 +1,190 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+from web3.providers.async_base import AsyncJSONBaseProvider
+from web3.providers.base import JSONBaseProvider
+
+from metrics import observe_rpc
+
+logger = logging.getLogger(__name__)
+
+
+class _Endpoint(object):
+    """单个节点的连接池与健康状态"""
+
+    def __init__(self, uri, session):
+        self.uri = uri
+        self.session = session
+        self.latency = 0.0  # 请求耗时的指数移动平均（秒）
+        self.failures = 0  # 连续失败次数
+        self.down_until = 0.0  # 失败后暂停使用直到该时间
+
+
+class _FailoverMixin(object):
+    """按延迟与健康状态选择节点, 同步与异步Provider共用"""
+
+    def ordered_endpoints(self):
+        """可用节点按延迟排序在前, 暂停中的节点按恢复时间排在后面"""
+        now = time.monotonic()
+        with self._lock:
+            healthy = sorted((e for e in self.endpoints if e.down_until <= now), key=lambda e: e.latency)
+            down = sorted((e for e in self.endpoints if e.down_until > now), key=lambda e: e.down_until)
+        return healthy + down
+
+    def _record_success(self, endpoint, elapsed):
+        with self._lock:
+            endpoint.latency = elapsed if endpoint.latency == 0 else endpoint.latency * 0.7 + elapsed * 0.3
+            endpoint.failures = 0
+            endpoint.down_until = 0.0
+
+    def _record_failure(self, endpoint):
+        with self._lock:
+            endpoint.failures += 1
+            # 连续失败时延长暂停时间
+            endpoint.down_until = time.monotonic() + self.cooldown * min(endpoint.failures, 10)
+
+
+class FailoverHTTPProvider(_FailoverMixin, JSONBaseProvider):
+    """
+    多节点HTTP Provider
+    每个节点使用保持连接的连接池, 优先选择延迟最低的可用节点, 请求失败时自动切换到下一个节点
+    """
+
+    def __init__(self, endpoint_uris, pool_size=20, timeout=10, cooldown=30):
+        self.timeout = timeout  # 单次请求超时（秒）
+        self.cooldown = cooldown  # 节点失败后暂停使用的时间（秒）
+        self.endpoints = [_Endpoint(uri, self._make_session(pool_size)) for uri in endpoint_uris]
+        self._lock = threading.Lock()
+        super().__init__()
+
+    def __str__(self):
+        return f"RPC connection {', '.join(endpoint.uri for endpoint in self.endpoints)}"
+
+    @staticmethod
+    def _make_session(pool_size):
+        """创建带连接池的会话"""
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def make_request(self, method, params):
+        request_data = self.encode_rpc_request(method, params)
+        return self.decode_rpc_response(self.post(request_data, method))
+
+    def make_batch_request(self, calls):
+        """
+        在一次HTTP请求中发送多个JSON-RPC调用
+        :param calls: [(方法, 参数)]
+        :return: 与calls顺序一致的响应列表, 每项包含result或error
+        """
+        request_data = json.dumps([
+            {'jsonrpc': '2.0', 'method': method, 'params': params, 'id': index}
+            for index, (method, params) in enumerate(calls)
+        ]).encode()
+        responses = json.loads(self.post(request_data, 'batch'))
+        if not isinstance(responses, list):
+            # 节点不支持批量请求时返回单个错误响应
+            raise ValueError(f'Batch request rejected: {responses.get("error")}')
+
+        by_id = {response.get('id'): response for response in responses}
+        return [by_id.get(index, {'error': {'message': 'missing response'}}) for index in range(len(calls))]
+
+    def post(self, request_data, method=None):
+        """依次尝试各节点发送请求, 返回响应内容"""
+        last_error = None
+        for endpoint in self.ordered_endpoints():
+            start = time.monotonic()
+            try:
+                response = endpoint.session.post(
+                    endpoint.uri,
+                    data=request_data,
+                    headers={'Content-Type': 'application/json'},
+                    timeout=self.timeout
+                )
+                response.raise_for_status()
+            except requests.RequestException as e:
+                observe_rpc(method, endpoint.uri, time.monotonic() - start, error=True)
+                self._record_failure(endpoint)
+                logger.warning(f'RPC {method} failed on {endpoint.uri}: {e}')
+                last_error = e
+                continue
+
+            elapsed = time.monotonic() - start
+            observe_rpc(method, endpoint.uri, elapsed)
+            self._record_success(endpoint, elapsed)
+            return response.content
+
+        raise last_error or requests.ConnectionError('No RPC endpoint configured')
+
+
+class AsyncFailoverHTTPProvider(_FailoverMixin, AsyncJSONBaseProvider):
+    """
+    多节点异步HTTP Provider
+    与FailoverHTTPProvider的节点选择一致, 每个节点的aiohttp会话在首次请求时于所在事件循环中创建并持续复用
+    """
+
+    def __init__(self, endpoint_uris, pool_size=20, timeout=10, cooldown=30):
+        self.pool_size = pool_size
+        self.timeout = timeout  # 单次请求超时（秒）
+        self.cooldown = cooldown  # 节点失败后暂停使用的时间（秒）
+        self.endpoints = [_Endpoint(uri, None) for uri in endpoint_uris]
+        self._lock = threading.Lock()
+        super().__init__()
+
+    def __str__(self):
+        return f"Async RPC connection {', '.join(endpoint.uri for endpoint in self.endpoints)}"
+
+    def _get_session(self, endpoint):
+        """获取节点的会话, 会话绑定创建时的事件循环"""
+        if endpoint.session is None or endpoint.session.closed:
+            endpoint.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        return endpoint.session
+
+    async def make_request(self, method, params):
+        request_data = self.encode_rpc_request(method, params)
+        return self.decode_rpc_response(await self.post(request_data, method))
+
+    async def post(self, request_data, method=None):
+        """依次尝试各节点发送请求, 返回响应内容"""
+        last_error = None
+        for endpoint in self.ordered_endpoints():
+            start = time.monotonic()
+            try:
+                async with self._get_session(endpoint).post(
+                    endpoint.uri,
+                    data=request_data,
+                    headers={'Content-Type': 'application/json'}
+                ) as response:
+                    response.raise_for_status()
+                    content = await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                observe_rpc(method, endpoint.uri, time.monotonic() - start, error=True)
+                self._record_failure(endpoint)
+                logger.warning(f'RPC {method} failed on {endpoint.uri}: {e!r}')
+                last_error = e
+                continue
+
+            elapsed = time.monotonic() - start
+            observe_rpc(method, endpoint.uri, elapsed)
+            self._record_success(endpoint, elapsed)
+            return content
+
+        raise last_error or aiohttp.ClientConnectionError('No RPC endpoint configured')
+
+    async def close(self):
+        """关闭各节点的会话"""
+        for endpoint in self.endpoints:
+            if endpoint.session is not None:
+                await endpoint.session.close()
+                endpoint.session = None
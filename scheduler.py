@@ -1,81 +1,403 @@
+import asyncio
+import threading
+import time
+from collections import Counter
 from datetime import datetime, timedelta
-from models import db, Order, OrderStatus
-from web3_support import Web3Support
+from sqlalchemy import select, update
+from amount_allocator import get_amount_allocator
+from async_web3_support import get_async_web3_support
+from collector import enqueue_collection, enqueue_collections
+from leases import claim_orders, renew_lease, claim_cursor, release_cursor
+from log_span import AdaptiveSpan
+from metrics import observe_sweep, ORDER_TRANSITIONS, DETECTION_LATENCY
+from models import db, Order, OrderStatus, ScanCursor
+from order_events import event_bus
+from notifier import enqueue_notifications, paid_event, notification_dispatcher
+from payments import record_payments
+from polling import next_check_interval
+from web3_support import get_web3_support
+
+# 事件扫描游标名称
+TRANSFER_CURSOR = 'usdt_transfer'
+
+_scan_span = None
+_scan_span_lock = threading.Lock()
 
 
 def check_orders(app):
     """检测订单是否已经收到资金"""
     with app.app_context():
+        detection_mode = app.config.get('DETECTION_MODE')
+        if app.config.get('PAYMENT_MODE') == 'amount':
+            # 统一收款地址的订单只能通过Transfer事件按金额识别
+            detection_mode = 'logs'
+        start = time.monotonic()
+        checked = 0
         try:
             app.logger.info(f'Checking unpaid orders at {datetime.now()}')
 
             # 获取Web3实例
-            w3 = Web3Support(app)
+            w3 = get_web3_support(app)
+
+            # 一条语句标记所有过期订单
+            expire_due_orders(app)
+            if app.config.get('PAYMENT_MODE') == 'amount':
+                # 清理已到期的金额占用
+                get_amount_allocator(app).purge()
+                db.session.commit()
 
-            # 查询过去2小时内的未支付订单
+            # 只检查过去2小时内的未支付订单
             two_hours_ago = datetime.utcnow() - timedelta(hours=2)
-            unpaid_orders = Order.query.filter(
-                Order.status == OrderStatus.UNPAID,
-                Order.create_time >= two_hours_ago
-            ).all()
-
-            app.logger.info(f'Found {len(unpaid_orders)} unpaid orders')
-
-            for order in unpaid_orders:
-                try:
-                    # 检查订单是否已过期
-                    if order.expire_time < datetime.utcnow():
-                        order.status = OrderStatus.EXPIRED
-                        db.session.commit()
-                        app.logger.info(f'Order {order.order_no} expired')
-                        continue
-
-                    app.logger.info(f'Checking order {order.order_no} - {order.address}')
-
-                    # 检查USDT余额
-                    usdt_balance = w3.get_usdt_balance(order.address)
-
-                    if usdt_balance >= order.amount:
-                        # 更新订单状态
-                        order.status = OrderStatus.PAID
-                        order.paid_amount = usdt_balance
-                        order.paid_time = datetime.utcnow()
-                        order.update_time = datetime.utcnow()
-                        db.session.commit()
-
-                        app.logger.info(
-                            f'Order {order.order_no} paid: {usdt_balance} USDT'
-                        )
-
-                        # TODO: 在这里添加您的业务逻辑
-                        # 例如：发送邮件通知、开通会员、发货等
-
-                        # 尝试归集资金（如果配置了归集地址）
-                        if w3.collect_address:
-                            try:
-                                collect_tx = w3.collect_usdt(
-                                    order.address,
-                                    order.private_key,
-                                    usdt_balance
-                                )
-                                if collect_tx:
-                                    order.collect_tx_hash = collect_tx
-                                    db.session.commit()
-                                    app.logger.info(
-                                        f'Collected {usdt_balance} USDT from order {order.order_no}'
-                                    )
-                            except Exception as e:
-                                app.logger.error(
-                                    f'Failed to collect USDT from order {order.order_no}: {e}'
-                                )
+
+            if detection_mode == 'logs':
+                # 事件扫描由持有游标租约的进程完成，按转账的收款地址与金额查找订单
+                checked = check_orders_by_logs(app, w3, two_hours_ago)
+                return
+
+            # 按批领取已到检查时间的订单租约，多个进程同时运行时各自处理不同的订单
+            batch_size = app.config.get('ORDER_LEASE_BATCH_SIZE', 1000)
+            while True:
+                token, unpaid_orders = claim_orders(app, two_hours_ago, batch_size)
+                if not unpaid_orders:
+                    break
+
+                app.logger.info(f'Claimed {len(unpaid_orders)} unpaid orders')
+                checked += len(unpaid_orders)
+
+                with renew_lease(app, token):
+                    active_orders = active_orders_of(unpaid_orders)
+                    if detection_mode == 'async':
+                        payments = check_orders_async(app, w3, active_orders)
                     else:
-                        app.logger.info(
-                            f'Order {order.order_no} balance: {usdt_balance}/{order.amount} USDT'
-                        )
+                        payments = check_orders_by_balances(app, w3, active_orders)
 
-                except Exception as e:
-                    app.logger.error(f'Error checking order {order.order_no}: {e}')
-                    continue
+                # 支付结果、下次检查时间与租约释放在同一事务中批量写入
+                paid = save_sweep(app, unpaid_orders, payments)
+                db.session.commit()
+                notify_paid(app, paid)
 
         except Exception as e:
-            app.logger.exception(f'Error in check_orders: {e}')
\ No newline at end of file
+            db.session.rollback()
+            app.logger.exception(f'Error in check_orders: {e}')
+        finally:
+            observe_sweep(detection_mode, time.monotonic() - start, checked)
+
+
+def expire_due_orders(app):
+    """通过一条UPDATE将所有已过期的未支付订单标记为过期"""
+    due = (Order.status == OrderStatus.UNPAID, Order.expire_time < datetime.utcnow())
+
+    if db.engine.dialect.update_returning:
+        order_nos = db.session.execute(
+            update(Order).where(*due).values(status=OrderStatus.EXPIRED).returning(Order.order_no),
+            execution_options={'synchronize_session': False}
+        ).scalars().all()
+    else:
+        order_nos = db.session.execute(select(Order.order_no).where(*due)).scalars().all()
+        if order_nos:
+            db.session.execute(
+                update(Order).where(*due).values(status=OrderStatus.EXPIRED),
+                execution_options={'synchronize_session': False}
+            )
+    db.session.commit()
+
+    for order_no in order_nos:
+        event_bus.publish(order_no, OrderStatus.EXPIRED)
+    if order_nos:
+        ORDER_TRANSITIONS.labels(OrderStatus.EXPIRED.value).inc(len(order_nos))
+        app.logger.info(f'Expired {len(order_nos)} orders')
+
+
+def active_orders_of(orders):
+    """过滤掉刚刚过期的订单，由下一轮统一标记"""
+    now = datetime.utcnow()
+    return [order for order in orders if order.expire_time >= now]
+
+
+def save_sweep(app, orders, payments):
+    """
+    以按主键的批量UPDATE写入一批订单的检查结果，由调用方提交
+    :param payments: {订单ID: 余额}，余额足够的订单
+    :return: [(订单号, 支付金额)]
+    """
+    now = datetime.utcnow()
+    paid_rows = []
+    unpaid_rows = []
+    paid = []
+    for order in orders:
+        if order.id in payments:
+            paid_rows.append({
+                'id': order.id,
+                'status': OrderStatus.PAID,
+                'paid_amount': payments[order.id],
+                'paid_time': now,
+                'update_time': now,
+                'lease_owner': None,
+                'lease_expire_time': None
+            })
+            paid.append((order.order_no, payments[order.id]))
+        else:
+            unpaid_rows.append({
+                'id': order.id,
+                'next_check_at': now + timedelta(seconds=next_check_interval(app, order, now)),
+                'update_time': order.update_time,
+                'lease_owner': None,
+                'lease_expire_time': None
+            })
+
+    # 相同字段的行放在一起，各用一次executemany
+    for rows in (paid_rows, unpaid_rows):
+        if rows:
+            db.session.execute(update(Order), rows)
+
+    # 归集资金交由后台任务处理（如果配置了归集地址）
+    enqueue_collections(app, [(row['id'], row['paid_amount']) for row in paid_rows])
+    # 支付通知写入发件箱，与订单状态一起提交
+    enqueue_notifications(app, [paid_event(order, payments[order.id], now) for order in orders if order.id in payments])
+    return paid
+
+
+def mark_paid(app, order, amount):
+    """更新订单为已支付并创建归集任务，由调用方提交"""
+    order.status = OrderStatus.PAID
+    order.paid_amount = amount
+    order.paid_time = datetime.utcnow()
+    order.update_time = datetime.utcnow()
+    # 归集资金交由后台任务处理（如果配置了归集地址），统一收款地址的订单无需归集
+    if order.pay_amount is None:
+        enqueue_collection(app, order, amount)
+    enqueue_notifications(app, [paid_event(order, amount, order.paid_time)])
+
+
+def notify_paid(app, paid):
+    """支付状态提交后通知订单页面，paid为[(订单号, 支付金额)]"""
+    ORDER_TRANSITIONS.labels(OrderStatus.PAID.value).inc(len(paid))
+    for order_no, amount in paid:
+        event_bus.publish(order_no, OrderStatus.PAID)
+        app.logger.info(f'Order {order_no} paid: {amount} USDT')
+
+    # 业务逻辑（发送邮件、开通会员、发货等）通过WEBHOOK_URLS接收支付通知，
+    # 由通知分发器在后台投递，不阻塞订单检查
+    if paid:
+        notification_dispatcher.wakeup()
+
+
+def check_orders_by_balances(app, w3, orders):
+    """通过批量查询余额检测订单支付，返回 {订单ID: 余额}"""
+    # 批量查询USDT余额
+    balances = w3.get_usdt_balances([order.address for order in orders])
+    return match_balances(app, orders, balances)
+
+
+def check_orders_async(app, w3, orders):
+    """并发查询余额检测订单支付，返回 {订单ID: 余额}"""
+    aw3 = get_async_web3_support(app)
+    balances = aw3.run(fetch_usdt_balances_async(app, aw3, [order.address for order in orders]))
+    return match_balances(app, orders, balances)
+
+
+def match_balances(app, orders, balances):
+    """找出余额足够的订单"""
+    payments = {}
+    for order in orders:
+        usdt_balance = balances.get(order.address)
+        if usdt_balance is None:
+            # 本轮查询失败，下次再检查
+            continue
+
+        if usdt_balance >= order.amount:
+            payments[order.id] = usdt_balance
+        else:
+            app.logger.debug(
+                f'Order {order.order_no} balance: {usdt_balance}/{order.amount} USDT'
+            )
+    return payments
+
+
+async def fetch_usdt_balances_async(app, aw3, addresses):
+    """通过信号量限制并发数, 并发查询多个地址的USDT余额"""
+    semaphore = asyncio.Semaphore(app.config.get('CHECK_CONCURRENCY', 20))
+
+    async def fetch(address):
+        async with semaphore:
+            return address, await aw3.get_usdt_balance(address)
+
+    results = await asyncio.gather(*(fetch(address) for address in addresses))
+    return {address: balance for address, balance in results if balance is not None}
+
+
+def get_scan_span(app):
+    """进程内共享的事件扫描跨度, 各轮检查之间保留探测到的节点限制"""
+    global _scan_span
+    with _scan_span_lock:
+        if _scan_span is None:
+            max_blocks = app.config.get('LOG_SCAN_MAX_BLOCKS', 1000)
+            _scan_span = AdaptiveSpan(max_blocks, max_blocks)
+        return _scan_span
+
+
+def check_orders_by_logs(app, w3, since):
+    """
+    通过扫描USDT Transfer事件检测订单支付, 成本取决于链上活动而非订单数量
+    :return: 匹配到转账的订单数量
+    """
+    latest_block = w3.get_block_number()
+    if latest_block is None:
+        return 0
+
+    # 只处理已确认的区块
+    safe_block = latest_block - app.config.get('CONFIRMATION_BLOCKS', 15)
+    max_blocks = app.config.get('LOG_SCAN_MAX_BLOCKS', 1000)
+
+    cursor = ScanCursor.query.filter_by(name=TRANSFER_CURSOR).first()
+    if cursor is None:
+        # 首次运行，从最近的一个扫描窗口开始
+        cursor = ScanCursor(name=TRANSFER_CURSOR, block_number=max(safe_block - max_blocks, 0))
+        db.session.add(cursor)
+        db.session.commit()
+    elif cursor.block_number > safe_block:
+        # 链发生回滚或切换到了落后的节点，回退游标重新扫描
+        app.logger.warning(
+            f'Cursor {cursor.block_number} ahead of safe block {safe_block}, rewinding'
+        )
+        cursor.block_number = safe_block
+        db.session.commit()
+
+    # 同一时间只允许一个进程扫描，避免重复计入
+    if not claim_cursor(app, cursor):
+        app.logger.info('Transfer cursor is leased by another worker')
+        return 0
+
+    try:
+        return scan_transfers(app, w3, cursor, since, safe_block)
+    finally:
+        release_cursor(cursor)
+
+
+def watched_addresses(app, since):
+    """
+    未支付订单的收款地址(统一收款地址模式的订单为归集地址), 事件扫描只获取转入这些地址的转账
+    地址数量超过LOG_SCAN_MAX_ADDRESSES时返回None, 获取全部转账
+    """
+    limit = app.config.get('LOG_SCAN_MAX_ADDRESSES', 1000)
+    addresses = db.session.execute(
+        select(Order.address).where(
+            Order.status == OrderStatus.UNPAID,
+            Order.create_time >= since
+        ).distinct().limit(limit + 1)
+    ).scalars().all()
+    return addresses if len(addresses) <= limit else None
+
+
+def match_transfers(app, transfers, since):
+    """
+    查找转账对应的未支付订单, 返回 [(订单, 转账)]
+    独立收款地址的订单按地址匹配，统一收款地址的订单按准确金额匹配, 只查询转账涉及的订单
+    """
+    allocator = get_amount_allocator(app)
+    collect_address = (app.config.get('BSC_COLLECT_ADDRESS') or '').lower()
+    unpaid = (Order.status == OrderStatus.UNPAID, Order.create_time >= since, Order.expire_time >= datetime.utcnow())
+
+    address_index = {}
+    addresses = list({transfer['to'] for transfer in transfers if transfer['to'].lower() != collect_address})
+    for start in range(0, len(addresses), 500):
+        for order in Order.query.filter(
+            Order.address.in_(addresses[start:start + 500]), Order.pay_amount.is_(None), *unpaid
+        ):
+            address_index[order.address.lower()] = order
+
+    amount_index = {}
+    keys = list({
+        allocator.transfer_key(transfer['value'])
+        for transfer in transfers if transfer['to'].lower() == collect_address
+    } - {None})
+    for start in range(0, len(keys), 500):
+        pay_amounts = [allocator.from_key(key) for key in keys[start:start + 500]]
+        for order in Order.query.filter(Order.pay_amount.in_(pay_amounts), *unpaid):
+            amount_index[allocator.to_key(order.pay_amount)] = order
+
+    matched = []
+    for transfer in transfers:
+        if transfer['to'].lower() == collect_address:
+            order = amount_index.get(allocator.transfer_key(transfer['value']))
+        else:
+            order = address_index.get(transfer['to'].lower())
+        if order is not None:
+            matched.append((order, transfer))
+    return matched
+
+
+def scan_transfers(app, w3, cursor, since, safe_block):
+    """
+    从游标处扫描到安全区块，匹配订单收款, 返回匹配到转账的订单数量
+    节点拒绝过宽的区块范围时缩小跨度重试, 成功后逐步扩大
+    """
+    span = get_scan_span(app)
+    # 在获取安全区块之后查询: 之后创建的订单, 其付款不会出现在安全区块之前
+    to_addresses = watched_addresses(app, since)
+    checked = set()
+
+    while cursor.block_number < safe_block:
+        from_block = cursor.block_number + 1
+        to_block = min(from_block + span.size - 1, safe_block)
+
+        if to_addresses == []:
+            # 没有等待付款的订单, 无需获取这些区块的事件
+            to_block = safe_block
+            transfers = []
+        else:
+            transfers = w3.get_usdt_transfers(from_block, to_block, to_addresses)
+            if transfers is None:
+                if to_block > from_block:
+                    span.resize(to_block - from_block + 1, False)
+                    continue
+                # 单个区块也失败, 不是跨度问题, 下次从游标处继续
+                break
+            span.resize(to_block - from_block + 1, True)
+
+        matched = match_transfers(app, transfers, since)
+        checked.update(order.id for order, _ in matched)
+
+        paid_orders = []
+        # 付款区块: 该区块中支付完成的订单数
+        paid_blocks = Counter()
+        # 只累计首次记录的转账, 游标回退后重新扫描到的转账不会重复计入
+        for order, transfer in record_payments(matched):
+            if order.status != OrderStatus.UNPAID:
+                continue
+
+            order.paid_amount = (order.paid_amount or 0) + transfer['amount']
+            order.tx_hash = transfer['tx_hash']
+            order.update_time = datetime.utcnow()
+            app.logger.info(
+                f'Order {order.order_no} received {transfer["amount"]} USDT in block {transfer["block_number"]}'
+            )
+
+            if order.paid_amount >= order.amount:
+                mark_paid(app, order, order.paid_amount)
+                paid_orders.append(order)
+                paid_blocks[transfer['block_number']] += 1
+
+        paid = [(order.order_no, order.paid_amount) for order in paid_orders]
+
+        # 订单状态与游标在同一事务中提交，避免重复计入
+        cursor.block_number = to_block
+        cursor.lease_expire_time = datetime.utcnow() + timedelta(seconds=app.config.get('ORDER_LEASE_SECONDS', 25))
+        db.session.commit()
+
+        notify_paid(app, paid)
+        observe_detection_latency(w3, paid_blocks)
+
+    return len(checked)
+
+
+def observe_detection_latency(w3, paid_blocks):
+    """记录付款所在区块到订单标记为已支付的时间, 只有事件扫描知道付款区块"""
+    now = time.time()
+    for block_number, count in paid_blocks.items():
+        timestamp = w3.get_block_timestamp(block_number)
+        if timestamp is None:
+            continue
+        for _ in range(count):
+            DETECTION_LATENCY.labels('logs').observe(max(now - timestamp, 0))
+
@@ -1,8 +1,86 @@
 import json
+import threading
 from web3 import Web3
 from eth_account import Account
 from decimal import Decimal
 
+from gas_oracle import get_gas_oracle
+from hd_wallet import get_hd_wallet, reserve_indexes
+from nonce_manager import get_nonce_manager
+from rpc_provider import FailoverHTTPProvider
+
+# ERC-20 Transfer(address,address,uint256)事件签名
+TRANSFER_EVENT_TOPIC = Web3.to_hex(Web3.keccak(text='Transfer(address,address,uint256)'))
+
+# USDT在BSC上的地址
+# https://bscscan.com/token/0x55d398326f99059fF775485246999027B3197955
+USDT_ADDRESS = Web3.to_checksum_address('0x55d398326f99059fF775485246999027B3197955')
+# USDT在BSC上的合约ABI, 只需要balanceOf和transfer函数
+USDT_ABI = json.loads('''[
+    {
+        "constant": true,
+        "inputs": [{"name": "_owner", "type": "address"}],
+        "name": "balanceOf",
+        "outputs": [{"name": "balance", "type": "uint256"}],
+        "type": "function"
+    },
+    {
+        "constant": false,
+        "inputs": [
+            {"name": "_to", "type": "address"},
+            {"name": "_value", "type": "uint256"}
+        ],
+        "name": "transfer",
+        "outputs": [{"name": "", "type": "bool"}],
+        "type": "function"
+    }
+]''')
+
+# Multicall3在BSC上的地址, 用于批量查询余额
+# https://www.multicall3.com/deployments
+MULTICALL_ADDRESS = Web3.to_checksum_address('0xcA11bde05977b3631167028862bE2a173976CA11')
+# Multicall3合约ABI, 只需要aggregate3函数
+MULTICALL_ABI = json.loads('''[
+    {
+        "inputs": [
+            {
+                "components": [
+                    {"name": "target", "type": "address"},
+                    {"name": "allowFailure", "type": "bool"},
+                    {"name": "callData", "type": "bytes"}
+                ],
+                "name": "calls",
+                "type": "tuple[]"
+            }
+        ],
+        "name": "aggregate3",
+        "outputs": [
+            {
+                "components": [
+                    {"name": "success", "type": "bool"},
+                    {"name": "returnData", "type": "bytes"}
+                ],
+                "name": "returnData",
+                "type": "tuple[]"
+            }
+        ],
+        "stateMutability": "payable",
+        "type": "function"
+    }
+]''')
+
+_registry_lock = threading.Lock()
+
+
+def get_web3_support(app):
+    """获取进程内共享的Web3Support, 复用节点连接池与合约对象"""
+    with _registry_lock:
+        support = app.extensions.get('web3_support')
+        if support is None:
+            support = Web3Support(app)
+            app.extensions['web3_support'] = support
+        return support
+
 
 class Web3Support(object):
     """Web3交互支持类"""
@@ -10,33 +88,17 @@ class Web3Support(object):
     def __init__(self, app=None):
         self.app = app
         self.w3 = None
-        # USDT在BSC上的地址
-        # https://bscscan.com/token/0x55d398326f99059fF775485246999027B3197955
-        self.usdt_address = Web3.to_checksum_address('0x55d398326f99059fF775485246999027B3197955')
-        # USDT在BSC上的合约ABI, 只需要balanceOf和transfer函数
-        self.usdt_abi = json.loads('''[
-            {
-                "constant": true,
-                "inputs": [{"name": "_owner", "type": "address"}],
-                "name": "balanceOf",
-                "outputs": [{"name": "balance", "type": "uint256"}],
-                "type": "function"
-            },
-            {
-                "constant": false,
-                "inputs": [
-                    {"name": "_to", "type": "address"},
-                    {"name": "_value", "type": "uint256"}
-                ],
-                "name": "transfer",
-                "outputs": [{"name": "", "type": "bool"}],
-                "type": "function"
-            }
-        ]''')
+        self.usdt_address = USDT_ADDRESS
+        self.usdt_abi = USDT_ABI
         self.usdt_contract = None
+        self.multicall_address = MULTICALL_ADDRESS
+        self.multicall_abi = MULTICALL_ABI
+        self.multicall_contract = None
+        self.multicall_chunk_size = 500
         self.collect_address = None
         self.gas_address = None
         self.gas_address_private_key = None
+        self.gas_oracle = None
 
         if app is not None:
             self.init_app(app)
@@ -44,16 +106,24 @@ class Web3Support(object):
     def init_app(self, app):
         """初始化应用"""
         self.app = app
-        bsc_endpoint = app.config.get('BSC_ENDPOINT')
-        if bsc_endpoint:
+        self.gas_oracle = get_gas_oracle(app)
+        bsc_endpoints = app.config.get('BSC_ENDPOINTS') or [app.config.get('BSC_ENDPOINT')]
+        bsc_endpoints = [endpoint for endpoint in bsc_endpoints if endpoint]
+        if bsc_endpoints:
             try:
-                # 连接到BSC节点
-                self.w3 = Web3(Web3.HTTPProvider(bsc_endpoint))
-                if self.w3.is_connected():
-                    app.logger.info(f'Connected to BSC node: {bsc_endpoint}')
-                else:
-                    app.logger.error('Failed to connect to BSC node')
-                    return
+                # 连接到BSC节点, 不在初始化时检查连接, 请求失败时自动切换节点
+                self.w3 = Web3(FailoverHTTPProvider(
+                    bsc_endpoints,
+                    pool_size=app.config.get('RPC_POOL_SIZE', 20),
+                    timeout=app.config.get('RPC_TIMEOUT', 10)
+                ))
+                app.logger.info(f'Using BSC nodes: {", ".join(bsc_endpoints)}')
+
+                # 允许覆盖合约地址, 便于连接本地测试链
+                if app.config.get('BSC_USDT_ADDRESS'):
+                    self.usdt_address = Web3.to_checksum_address(app.config['BSC_USDT_ADDRESS'])
+                if app.config.get('BSC_MULTICALL_ADDRESS'):
+                    self.multicall_address = Web3.to_checksum_address(app.config['BSC_MULTICALL_ADDRESS'])
 
                 # 初始化USDT合约
                 self.usdt_contract = self.w3.eth.contract(
@@ -61,6 +131,13 @@ class Web3Support(object):
                     abi=self.usdt_abi
                 )
 
+                # 初始化Multicall3合约
+                self.multicall_contract = self.w3.eth.contract(
+                    address=self.multicall_address,
+                    abi=self.multicall_abi
+                )
+                self.multicall_chunk_size = app.config.get('MULTICALL_CHUNK_SIZE') or self.multicall_chunk_size
+
                 # 设置地址
                 self.collect_address = app.config.get('BSC_COLLECT_ADDRESS')
                 self.gas_address = app.config.get('BSC_GAS_ADDRESS')
@@ -75,13 +152,34 @@ class Web3Support(object):
             except Exception as e:
                 app.logger.error(f'Failed to initialize Web3: {e}')
 
+    def is_connected(self):
+        """检查节点连接"""
+        if not self.w3:
+            return False
+        try:
+            return self.w3.is_connected()
+        except Exception:
+            return False
+
     def create_account(self):
         """创建一个新的账户"""
-        account = Account.create()
-        return {
-            'address': account.address,
-            'private_key': account.key.hex()
-        }
+        return self.create_accounts(1)[0]
+
+    def create_accounts(self, count):
+        """批量创建收款账户, 配置了HD钱包时按连续索引派生, 只返回派生索引而不返回私钥"""
+        wallet = get_hd_wallet(self.app) if self.app else None
+        if wallet is not None:
+            start = reserve_indexes(count)
+            return [
+                {'address': address, 'private_key': None, 'derivation_index': index}
+                for index, address in wallet.derive_range(start, count)
+            ]
+
+        accounts = [Account.create() for _ in range(count)]
+        return [
+            {'address': account.address, 'private_key': account.key.hex(), 'derivation_index': None}
+            for account in accounts
+        ]
 
     def get_usdt_balance(self, address):
         """获取指定地址的USDT余额"""
@@ -93,12 +191,114 @@ class Web3Support(object):
             address = Web3.to_checksum_address(address)
             balance_wei = self.usdt_contract.functions.balanceOf(address).call()
             balance = balance_wei / 10 ** 18  # USDT在BSC上是18位小数
-            self.app.logger.info(f'USDT balance for {address}: {balance}')
+            self.app.logger.debug(f'USDT balance for {address}: {balance}')
             return float(balance)
         except Exception as e:
             self.app.logger.error(f'Error getting USDT balance for {address}: {e}')
             return 0
 
+    def get_usdt_balances(self, addresses, chunk_size=None):
+        """批量获取多个地址的USDT余额, 通过Multicall3合并为少量eth_call"""
+        if not self.w3 or not self.usdt_contract or not self.multicall_contract:
+            self.app.logger.error('Web3 not initialized')
+            return {}
+
+        chunk_size = chunk_size or self.multicall_chunk_size
+        balances = {}
+        addresses = list(addresses)
+
+        for i in range(0, len(addresses), chunk_size):
+            chunk = addresses[i:i + chunk_size]
+            try:
+                calls = [
+                    (
+                        self.usdt_address,
+                        True,  # 单个地址失败不影响整批
+                        self.usdt_contract.encodeABI(
+                            fn_name='balanceOf',
+                            args=[Web3.to_checksum_address(address)]
+                        )
+                    )
+                    for address in chunk
+                ]
+                results = self.multicall_contract.functions.aggregate3(calls).call()
+            except Exception as e:
+                self.app.logger.error(f'Error getting USDT balances via multicall: {e}')
+                continue
+
+            for address, (success, return_data) in zip(chunk, results):
+                if not success or len(return_data) < 32:
+                    self.app.logger.error(f'Error getting USDT balance for {address}: call failed')
+                    continue
+                balance_wei = self.w3.codec.decode(['uint256'], return_data)[0]
+                balances[address] = float(balance_wei / 10 ** 18)  # USDT在BSC上是18位小数
+
+        self.app.logger.info(f'Fetched USDT balances for {len(balances)}/{len(addresses)} addresses')
+        return balances
+
+    def get_block_number(self):
+        """获取最新区块高度"""
+        if not self.w3:
+            self.app.logger.error('Web3 not initialized')
+            return None
+
+        try:
+            return self.w3.eth.block_number
+        except Exception as e:
+            self.app.logger.error(f'Error getting block number: {e}')
+            return None
+
+    def get_block_timestamp(self, block_number):
+        """获取区块时间戳（秒）, 失败时返回None"""
+        if not self.w3:
+            self.app.logger.error('Web3 not initialized')
+            return None
+
+        try:
+            return self.w3.eth.get_block(block_number)['timestamp']
+        except Exception as e:
+            self.app.logger.error(f'Error getting block {block_number}: {e}')
+            return None
+
+    def get_usdt_transfers(self, from_block, to_block, to_addresses=None):
+        """获取区块范围内的USDT Transfer事件, 可只获取转入指定地址(列表)的事件, 失败时返回None"""
+        if not self.w3:
+            self.app.logger.error('Web3 not initialized')
+            return None
+
+        topics = [TRANSFER_EVENT_TOPIC]
+        if to_addresses:
+            # 第三个topic为收款地址, 左侧补零到32字节, 多个地址之间为或的关系
+            topics += [None, ['0x' + '0' * 24 + address[2:].lower() for address in to_addresses]]
+
+        try:
+            logs = self.w3.eth.get_logs({
+                'address': self.usdt_address,
+                'fromBlock': from_block,
+                'toBlock': to_block,
+                'topics': topics
+            })
+        except Exception as e:
+            self.app.logger.error(f'Error getting USDT transfers in blocks {from_block}-{to_block}: {e}')
+            return None
+
+        transfers = []
+        for log in logs:
+            topics = log['topics']
+            if len(topics) < 3:
+                continue
+            value = int.from_bytes(bytes(log['data']), 'big')
+            transfers.append({
+                'tx_hash': Web3.to_hex(log['transactionHash']),
+                'block_number': log['blockNumber'],
+                'log_index': log['logIndex'],
+                'from': Web3.to_checksum_address('0x' + Web3.to_hex(topics[1])[-40:]),
+                'to': Web3.to_checksum_address('0x' + Web3.to_hex(topics[2])[-40:]),
+                'value': value,
+                'amount': float(value / 10 ** 18)  # USDT在BSC上是18位小数
+            })
+        return transfers
+
     def get_bnb_balance(self, address):
         """查询指定地址的BNB余额"""
         if not self.w3:
@@ -109,7 +309,7 @@ class Web3Support(object):
             address = Web3.to_checksum_address(address)
             balance_wei = self.w3.eth.get_balance(address)
             balance = self.w3.from_wei(balance_wei, 'ether')
-            self.app.logger.info(f'BNB balance for {address}: {balance}')
+            self.app.logger.debug(f'BNB balance for {address}: {balance}')
             return float(balance)
         except Exception as e:
             self.app.logger.error(f'Error getting BNB balance for {address}: {e}')
@@ -121,10 +321,13 @@ class Web3Support(object):
             from_address = Web3.to_checksum_address(from_address)
             amount_wei = int(amount_usdt * 10 ** 18)
 
-            # 估算gas用量
-            gas_estimate = self.usdt_contract.functions.transfer(
-                self.collect_address, amount_wei
-            ).estimate_gas({'from': from_address})
+            # 估算gas用量, 同一归集地址的transfer用量基本不变, 按调用形态缓存
+            gas_estimate = self.gas_oracle.get_gas_limit(
+                ('transfer', self.usdt_address, self.collect_address),
+                lambda: self.usdt_contract.functions.transfer(
+                    self.collect_address, amount_wei
+                ).estimate_gas({'from': from_address})
+            )
         except Exception as e:
             self.app.logger.error(f'Error estimating gas: {e}')
             # 使用默认值
@@ -132,7 +335,7 @@ class Web3Support(object):
 
         # 获取当前gas价格
         try:
-            gas_price = self.w3.eth.gas_price
+            gas_price = self.gas_oracle.get_gas_price(self.w3)
         except:
             gas_price = self.w3.to_wei('5', 'gwei')  # 默认5 Gwei
 
@@ -141,7 +344,7 @@ class Web3Support(object):
         total_gas_cost_bnb = self.w3.from_wei(total_gas_cost_wei, 'ether')
         safe_gas_cost_bnb = float(total_gas_cost_bnb) * 1.2  # 增加20%缓冲
 
-        self.app.logger.info(
+        self.app.logger.debug(
             f'Gas estimate: {gas_estimate} units, '
             f'price: {gas_price} wei, '
             f'total: {safe_gas_cost_bnb} BNB'
@@ -155,17 +358,20 @@ class Web3Support(object):
             'safe_gas_cost_bnb': safe_gas_cost_bnb
         }
 
-    def transfer_bnb_for_gas(self, to_address, amount_bnb):
-        """转账BNB作为gas费用"""
+    def send_bnb_for_gas(self, to_address, amount_bnb):
+        """发送BNB作为gas费用, 不等待确认, 返回交易哈希"""
         if not all([self.w3, self.gas_address, self.gas_address_private_key]):
             self.app.logger.error('Gas address not configured')
             return None
 
         try:
             to_address = Web3.to_checksum_address(to_address)
-            nonce = self.w3.eth.get_transaction_count(self.gas_address)
             amount_wei = self.w3.to_wei(amount_bnb, 'ether')
-            gas_price = self.w3.eth.gas_price
+            gas_price = self.gas_oracle.get_gas_price(self.w3)
+
+            # 多个归集任务与调度进程并发使用gas地址, 由数据库分配nonce, 无需等待上一笔确认
+            nonce_manager = get_nonce_manager(self.gas_address)
+            nonce = nonce_manager.allocate(self.w3)
 
             # 构建交易
             transaction = {
@@ -177,60 +383,35 @@ class Web3Support(object):
                 'chainId': 56  # BSC主网
             }
 
-            # 签名并发送交易
-            signed_txn = self.w3.eth.account.sign_transaction(
-                transaction,
-                private_key=self.gas_address_private_key
-            )
-
-            tx_hash = self.w3.eth.send_raw_transaction(signed_txn.rawTransaction)
-
-            # 等待交易确认
-            receipt = self.w3.eth.wait_for_transaction_receipt(tx_hash, timeout=120)
-            tx_hash_hex = tx_hash.hex()
-
-            if receipt.status == 1:
-                self.app.logger.info(
-                    f'BNB transfer successful: {amount_bnb} BNB to {to_address}, '
-                    f'tx: {tx_hash_hex}'
+            try:
+                # 签名并发送交易
+                signed_txn = self.w3.eth.account.sign_transaction(
+                    transaction,
+                    private_key=self.gas_address_private_key
                 )
-                return tx_hash_hex
-            else:
-                self.app.logger.error(f'BNB transfer failed: {tx_hash_hex}')
-                return None
+                tx_hash = self.w3.eth.send_raw_transaction(signed_txn.rawTransaction)
+            except Exception:
+                nonce_manager.resync(self.w3)
+                raise
+
+            tx_hash_hex = Web3.to_hex(tx_hash)
+            self.app.logger.info(
+                f'BNB transfer sent: {amount_bnb} BNB to {to_address}, tx: {tx_hash_hex}'
+            )
+            return tx_hash_hex
 
         except Exception as e:
             self.app.logger.error(f'Error transferring BNB: {e}')
             return None
 
-    def collect_usdt(self, from_address, from_private_key, amount_usdt):
-        """归集USDT到指定地址"""
+    def send_usdt_transfer(self, from_address, from_private_key, amount_usdt, gas_info):
+        """发送USDT归集交易, 不等待确认, 返回交易哈希"""
         if not all([self.w3, self.usdt_contract, self.collect_address]):
             self.app.logger.error('Collection address not configured')
             return None
 
         try:
             from_address = Web3.to_checksum_address(from_address)
-
-            # 检查BNB余额是否足够支付gas
-            current_bnb_balance = self.get_bnb_balance(from_address)
-            gas_info = self.estimate_gas(from_address, amount_usdt)
-            required_bnb = gas_info['safe_gas_cost_bnb']
-
-            if current_bnb_balance < required_bnb:
-                # 转账BNB作为gas费
-                bnb_to_transfer = required_bnb - current_bnb_balance
-                self.app.logger.info(
-                    f'Transferring {bnb_to_transfer} BNB for gas to {from_address}'
-                )
-                gas_tx = self.transfer_bnb_for_gas(from_address, bnb_to_transfer)
-                if not gas_tx:
-                    return None
-                # 等待一下确保到账
-                import time
-                time.sleep(5)
-
-            # 执行USDT转账
             nonce = self.w3.eth.get_transaction_count(from_address)
             amount_wei = int(amount_usdt * 10 ** 18)
 
@@ -251,20 +432,39 @@ class Web3Support(object):
             )
             tx_hash = self.w3.eth.send_raw_transaction(signed_txn.rawTransaction)
 
-            # 等待交易确认
-            receipt = self.w3.eth.wait_for_transaction_receipt(tx_hash, timeout=120)
-            tx_hash_hex = tx_hash.hex()
+            tx_hash_hex = Web3.to_hex(tx_hash)
+            self.app.logger.info(
+                f'USDT collection sent: {amount_usdt} USDT from {from_address}, tx: {tx_hash_hex}'
+            )
+            return tx_hash_hex
 
-            if receipt.status == 1:
-                self.app.logger.info(
-                    f'USDT collection successful: {amount_usdt} USDT from {from_address}, '
-                    f'tx: {tx_hash_hex}'
-                )
-                return tx_hash_hex
-            else:
-                self.app.logger.error(f'USDT collection failed: {tx_hash_hex}')
-                return None
+        except Exception as e:
+            self.app.logger.error(f'Error sending USDT transfer: {e}')
+            return None
+
+    def get_transaction_statuses(self, tx_hashes, chunk_size=500):
+        """
+        通过JSON-RPC批量请求查询多笔交易的收据, 每批只需一次HTTP请求
+        :return: {交易哈希: None表示尚未上链, True成功, False失败}, 请求失败时返回None
+        """
+        if not self.w3:
+            self.app.logger.error('Web3 not initialized')
+            return None
 
+        statuses = {}
+        try:
+            for start in range(0, len(tx_hashes), chunk_size):
+                chunk = tx_hashes[start:start + chunk_size]
+                responses = self.w3.provider.make_batch_request(
+                    [('eth_getTransactionReceipt', [tx_hash]) for tx_hash in chunk]
+                )
+                for tx_hash, response in zip(chunk, responses):
+                    if 'error' in response:
+                        self.app.logger.warning(f'Error getting receipt for {tx_hash}: {response["error"]}')
+                        continue
+                    receipt = response.get('result')
+                    statuses[tx_hash] = None if receipt is None else int(receipt['status'], 16) == 1
         except Exception as e:
-            self.app.logger.error(f'Error collecting USDT: {e}')
-            return None
\ No newline at end of file
+            self.app.logger.error(f'Error getting transaction receipts: {e}')
+            return None
+        return statuses